@@ -1,72 +1,688 @@
 import itertools
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from .barcode_cache import BarcodeTableCache, cache_key
+from .sketch import SpaceSaving
+
+# Lookup results for barcodes that do not give a sample
+UNASSIGNED = -1
+AMBIGUOUS = -2
+QUALITY_REJECTED = -3
+
+# Quality scores are encoded as Phred + 33
+QUALITY_OFFSET = 33
+
+QUALITY_CHECKS = ("bases", "mismatches")
+
+if np is not None:
+    _BASE_CODES = np.full(256, 4, dtype=np.uint8)
+    _BASE_CODES[list(b"ACGT")] = np.arange(4)
+
+# Packed barcode tables for barcodes up to 12 bases are looked up in a
+# dense array indexed by the packed barcode, taking 32 MiB at most.
+# Tables for longer barcodes are searched as sorted arrays.
+_DENSE_TABLE_SIZE = 1 << 24
 
 
 class BarcodeAssigner(object):
-    def __init__(self, samples, mismatches=0, revcomp=True):
+    """Assign reads to samples by barcode, allowing for mismatches.
+
+    Every barcode within the mismatch budget of a sample's barcode is
+    precomputed, so assignment is a single dict lookup. A read barcode
+    closer to one sample than any other goes to that sample. A read
+    barcode equally close to two samples is ambiguous and counted as
+    unassigned.
+
+    The most frequent unassigned barcodes are tracked in a fixed-size
+    sketch, and the top_unassigned of them are reported.
+
+    If min_quality is set and the quality of the read barcode is given,
+    reads are rejected as unassigned when an index base has a lower
+    Phred score. With quality_check set to "mismatches", only bases
+    that differ from the sample barcode are checked.
+
+    With cache_dir, the barcode tables are saved there once built, and
+    loaded from there by later assigners for the same samples and
+    options. Loaded tables are memory mapped, and only turned into
+    dicts if a barcode has to be looked up one at a time.
+    """
+    # Barcode tables kept in the cache
+    _table_names = ("_barcodes",)
+
+    def __init__(self, samples, mismatches=0, revcomp=True,
+                 top_unassigned=20, sketch_size=1000, min_quality=None,
+                 quality_check="bases", cache_dir=None):
         self.samples = samples
-        if mismatches not in [0]:
+        if mismatches < 0:
             raise ValueError(
-                "Only 0 mismatches allowed (got %s)" % mismatches)
+                "Number of mismatches must not be negative (got %s)" % (
+                    mismatches))
         self.mismatches = mismatches
         self.revcomp = revcomp
+        self._set_options(
+            top_unassigned, sketch_size, min_quality, quality_check,
+            cache_dir)
+        self._init_counts()
+        self._init_tables()
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set: the tables of a
+        # cached assigner are loaded on first use.
+        cache = self.__dict__.get("_table_cache")
+        if cache is None or name not in self._table_names:
+            raise AttributeError(name)
+        table = self._load_table(name)
+        setattr(self, name, table)
+        return table
+
+    def _set_options(self, top_unassigned, sketch_size, min_quality,
+                     quality_check, cache_dir=None):
+        if quality_check not in QUALITY_CHECKS:
+            raise ValueError(
+                "Unknown quality check: %s (expected one of %s)" % (
+                    quality_check, ", ".join(QUALITY_CHECKS)))
+        self.top_unassigned = top_unassigned
+        self.sketch_size = sketch_size
+        self.min_quality = min_quality
+        self.quality_check = quality_check
+        self.cache_dir = cache_dir
+        # Barcodes of each sample as they appear in the reads
+        self._read_barcodes = dict(
+            (s.name, reverse_complement(s.barcode) if self.revcomp
+             else s.barcode)
+            for s in self.samples)
+
+    def _init_counts(self):
         # Sample names assumed to be unique after validating input data
         self.read_counts = dict((s.name, 0) for s in self.samples)
         self.read_counts['unassigned'] = 0
-        self._init_hash()
+        self.ambiguous_reads = 0
+        self.quality_rejected = 0
+        self.unassigned_barcodes = SpaceSaving(self.sketch_size)
+
+    def _init_tables(self):
+        start = time.time()
+        self._table_cache = None
+        self._packed = None
+        cache = None
+        if self.cache_dir is not None and np is not None:
+            cache = BarcodeTableCache(self.cache_dir, cache_key(
+                self.samples, self.mismatches, self.revcomp))
+        if cache is not None and cache.exists():
+            self._table_cache = cache
+            self._cache_meta = cache.load_meta()
+            self.index_stats = dict(self._cache_meta["index_stats"])
+            self.index_stats["cached"] = True
+        else:
+            self._init_hash()
+            self.index_stats["cached"] = False
+            if cache is not None:
+                self._save_tables(cache)
+        self.index_stats["build_seconds"] = time.time() - start
+
+    def _save_tables(self, cache):
+        arrays = {}
+        meta = {"index_stats": self.index_stats, "lengths": {}}
+        ids = self._value_ids()
+        for name in self._table_names:
+            table = getattr(self, name)
+            key = name.strip("_")
+            arrays[key + "_barcodes"] = np.array(
+                list(table), dtype="S%d" % max(map(len, table), default=1))
+            arrays[key + "_values"] = np.array(
+                [AMBIGUOUS if v is None else (v if ids is None else ids[id(v)])
+                 for v in table.values()], dtype=np.int32)
+            length = _barcode_length(table)
+            meta["lengths"][name] = length
+            if length is not None:
+                packed = PackedBarcodeTable(table, ids)
+                for array_name, array in packed.arrays().items():
+                    arrays[key + "_packed_" + array_name] = array
+        cache.save(arrays, meta)
+
+    def _load_table(self, name):
+        key = name.strip("_")
+        barcodes = self._table_cache.load(key + "_barcodes")
+        values = self._table_cache.load(key + "_values")
+        # Negative values pick None from the end of the list
+        lookup = list(self._cache_values()) + [None, None, None]
+        return dict(zip(
+            barcodes.astype("U").tolist(),
+            map(lookup.__getitem__, values.tolist())))
+
+    def _cache_values(self):
+        # Values of the barcode tables, saved as positions in this list
+        return self.samples
+
+    def _value_ids(self):
+        # Positions of the table values, by id(), as for PackedBarcodeTable
+        return dict((id(s), n) for n, s in enumerate(self.samples))
+
+    def _table_length(self, name):
+        if self._table_cache is not None:
+            return self._cache_meta["lengths"][name]
+        return _barcode_length(getattr(self, name))
+
+    def _packed_table(self, name):
+        if self._table_cache is None:
+            return PackedBarcodeTable(getattr(self, name), self._value_ids())
+        key = name.strip("_") + "_packed_"
+        return PackedBarcodeTable.from_arrays(dict(
+            (array_name, self._table_cache.load(key + array_name))
+            for array_name in PackedBarcodeTable.array_names
+            if self._table_cache.has(key + array_name)))
 
     def _init_hash(self):
-        self._barcodes = {}
+        sample_barcodes = []
         for s in self.samples:
             # Barcodes assumed to be present after validating input data
             if self.revcomp:
                 bc = reverse_complement(s.barcode)
             else:
                 bc = s.barcode
-
             # Barcodes assumed to be unique after validating input data
-            self._barcodes[bc] = s
-
-            for error_bc in self._error_barcodes(bc):
-                # Barcodes not guaranteed to be unique after
-                # accounting for errors
-                if error_bc in self._barcodes:
-                    raise ValueError(
-                        "Barcode %s for sample %s matches barcode for "
-                        "sample %s with %s mismatches" % (
-                            error_bc, self._barcodes[error_bc], s,
-                            self.mismatches))
-                else:
-                    self._barcodes[error_bc] = s
-
-    def _error_barcodes(self, barcode):
-        # If the number of mismatches is set to 0, there will be no
-        # error barcodes. Immediately stop the iteration.
-        if self.mismatches == 0:
-            raise StopIteration
-        # Each item in idx_sets is a set of indices where mismatches
-        # should occur.
-        idx_sets = itertools.combinations(range(len(barcode)), self.mismatches)
-        for idx_set in idx_sets:
-            # Change to list because strings are immutable
-            bc = list(barcode)
-            # Replace the base at each mismatch position with an
-            # ambiguous base specifying all possibilities BUT the one
-            # we see.
-            for idx in idx_set:
-                bc[idx] = AMBIGUOUS_BASES_COMPLEMENT[bc[idx]]
-            # Expand to all possibilities for mismatching at this
-            # particular set of positions
-            for error_bc in deambiguate(bc):
-                yield error_bc
-        
-    def assign(self, seq):
+            sample_barcodes.append((bc, s))
+        self._barcodes = build_barcode_table(
+            sample_barcodes, self.mismatches)
+        self.index_stats = table_stats(self._barcodes)
+        self.index_stats["barcodes"] = len(self.samples)
+        self.index_stats["mismatches"] = self.mismatches
+
+    def _error_barcodes(self, barcode, mismatches=None):
+        if mismatches is None:
+            mismatches = self.mismatches
+        return error_barcodes(barcode, mismatches)
+
+    def assign(self, seq, qual=None):
         sample = self._barcodes.get(seq)
+        if sample is not None and self._low_quality(seq, qual, sample):
+            self.read_counts['unassigned'] += 1
+            self.quality_rejected += 1
+            return None
+        if sample is not None:
+            self.read_counts[sample.name] += 1
+        else:
+            self.read_counts['unassigned'] += 1
+            self.unassigned_barcodes.add(seq)
+            if seq in self._barcodes:
+                self.ambiguous_reads += 1
+        return sample
+
+    def _low_quality(self, seq, qual, sample):
+        if qual is None or self.min_quality is None:
+            return False
+        threshold = chr(self.min_quality + QUALITY_OFFSET)
+        if self.quality_check == "mismatches":
+            expected = self._read_barcodes[sample.name]
+            qual = [q for q, a, b in zip(qual, seq, expected) if a != b]
+        return any(q < threshold for q in qual)
+
+    def assign_batch(self, seqs, quals=None):
+        """Assign a list of read barcodes, giving the same result as assign.
+
+        With numpy, barcodes are packed two bits per base and looked up
+        for the whole batch at once. Barcodes that cannot be packed
+        (other lengths or bases) go through assign.
+        """
+        if self._packed is None:
+            self._packed = self._pack_tables()
+        if not self._packed:
+            return self._assign_each(seqs, quals)
+        table, length = self._packed
+        digits, valid = encode_barcodes(seqs, length)
+        idx = table.lookup(pack_digits(digits))
+        return self._finish_batch(seqs, quals, idx, digits, valid)
+
+    def _assign_each(self, seqs, quals):
+        if quals is None:
+            return list(map(self.assign, seqs))
+        return list(map(self.assign, seqs, quals))
+
+    def _pack_tables(self):
+        if np is None:
+            return ()
+        length = self._table_length("_barcodes")
+        if length is None:
+            return ()
+        self._pack_read_barcodes(length)
+        return self._packed_table("_barcodes"), length
+
+    def _pack_read_barcodes(self, length):
+        self._read_digits = encode_barcodes(
+            [self._read_barcodes[s.name] for s in self.samples], length)[0]
+
+    def _finish_batch(self, seqs, quals, idx, digits, valid):
+        # Entries for valid barcodes are final, the others are filled
+        # in by assign.
+        if quals is not None and self.min_quality is not None:
+            self._reject_low_quality(quals, idx, digits, valid)
+        n_samples = len(self.samples)
+        counts = np.bincount(idx[(idx >= 0) & valid], minlength=n_samples)
+        for s, n in zip(self.samples, counts.tolist()):
+            self.read_counts[s.name] += n
+        missing = (idx < 0) & valid
+        rejected = missing & (idx == QUALITY_REJECTED)
+        self.read_counts['unassigned'] += int(missing.sum())
+        self.ambiguous_reads += int((missing & (idx == AMBIGUOUS)).sum())
+        self.quality_rejected += int(rejected.sum())
+        for i in np.flatnonzero(missing & ~rejected).tolist():
+            self.unassigned_barcodes.add(seqs[i])
+        # Negative indices pick None from the end of the list
+        samples = list(self.samples) + [None, None, None]
+        result = list(map(samples.__getitem__, idx.tolist()))
+        for i in np.flatnonzero(~valid).tolist():
+            result[i] = self.assign(
+                seqs[i], None if quals is None else quals[i])
+        return result
+
+    def _reject_low_quality(self, quals, idx, digits, valid):
+        rows = _byte_rows(quals, digits.shape[1], "~")[0]
+        assigned = np.flatnonzero((idx >= 0) & valid)
+        low = rows[assigned] < self.min_quality + QUALITY_OFFSET
+        if self.quality_check == "mismatches":
+            low &= digits[assigned] != self._read_digits[idx[assigned]]
+        idx[assigned[low.any(axis=1)]] = QUALITY_REJECTED
+
+    def reset_counts(self):
+        self._init_counts()
+
+    def get_counts(self):
+        """Counts collected since the last reset, for merge_counts."""
+        return {
+            "read_counts": self.read_counts,
+            "ambiguous_reads": self.ambiguous_reads,
+            "quality_rejected": self.quality_rejected,
+            "unassigned_barcodes": self.unassigned_barcodes,
+            }
+
+    def merge_counts(self, counts):
+        for name, n in counts["read_counts"].items():
+            self.read_counts[name] += n
+        self.ambiguous_reads += counts["ambiguous_reads"]
+        self.quality_rejected += counts["quality_rejected"]
+        self.unassigned_barcodes.merge(counts["unassigned_barcodes"])
+
+    def get_stats(self):
+        stats = dict(self.index_stats)
+        stats["ambiguous_reads"] = self.ambiguous_reads
+        stats["quality_rejected"] = self.quality_rejected
+        stats["unassigned_barcodes"] = [
+            {"barcode": bc, "count": count, "max_error": error}
+            for bc, count, error in self.unassigned_barcodes.top(
+                self.top_unassigned)]
+        return stats
+
+
+class DualBarcodeAssigner(BarcodeAssigner):
+    """Assign reads to samples by a pair of index barcodes, i7 and i5.
+
+    The read barcode holds both indices, in the order they appear in
+    the read. Each index is looked up in its own table with its own
+    mismatch budget, giving a small integer for each index. The pair
+    of integers is then looked up to find the sample. Reads where both
+    indices are recognized are counted in an i7 x i5 matrix, which
+    shows index hopping between samples.
+    """
+    _table_names = ("_first", "_second")
+
+    def __init__(self, samples, mismatches=0, revcomp=True,
+                 top_unassigned=20, sketch_size=1000, min_quality=None,
+                 quality_check="bases", cache_dir=None):
+        if isinstance(mismatches, int):
+            mismatches = (mismatches, mismatches)
+        self.samples = samples
+        self.mismatches = tuple(mismatches)
+        if len(self.mismatches) != 2 or min(self.mismatches) < 0:
+            raise ValueError(
+                "Mismatches must be one or two non-negative numbers "
+                "(got %s)" % (mismatches,))
+        self.revcomp = revcomp
+        self._set_options(
+            top_unassigned, sketch_size, min_quality, quality_check,
+            cache_dir)
+        self._init_indices()
+        self._init_tables()
+        self._init_counts()
+
+    def _init_indices(self):
+        for s in self.samples:
+            if len(s.barcodes) != 2:
+                raise ValueError(
+                    "Sample %s does not have a dual-index barcode: %s" % (
+                        s.name, s.barcode))
+        self.i7_barcodes = _unique(s.barcodes[0] for s in self.samples)
+        self.i5_barcodes = _unique(s.barcodes[1] for s in self.samples)
+        i7_ids = dict((bc, n) for n, bc in enumerate(self.i7_barcodes))
+        i5_ids = dict((bc, n) for n, bc in enumerate(self.i5_barcodes))
+        self._n_i5 = len(self.i5_barcodes)
+        # Reads are split after the index that comes first in the read
+        first = self.i5_barcodes if self.revcomp else self.i7_barcodes
+        lengths = set(map(len, first))
+        if len(lengths) != 1:
+            raise ValueError(
+                "Index barcodes must all have the same length: %s" % (
+                    [reverse_complement(bc) for bc in first]
+                    if self.revcomp else first))
+        self._split = lengths.pop()
+
+        # Both index numbers are combined into one integer
+        self._pairs = {}
+        for s in self.samples:
+            i7, i5 = s.barcodes
+            self._pairs[i7_ids[i7] * self._n_i5 + i5_ids[i5]] = s
+
+    def _init_hash(self):
+        i7_ids = dict((bc, n) for n, bc in enumerate(self.i7_barcodes))
+        i5_ids = dict((bc, n) for n, bc in enumerate(self.i5_barcodes))
+        if self.revcomp:
+            # The whole barcode is reverse complemented, so the i5
+            # index comes first in the read.
+            first = [(reverse_complement(bc), i5_ids[bc])
+                     for bc in self.i5_barcodes]
+            second = [(reverse_complement(bc), i7_ids[bc])
+                      for bc in self.i7_barcodes]
+            first_mismatches = self.mismatches[1]
+            second_mismatches = self.mismatches[0]
+        else:
+            first = [(bc, i7_ids[bc]) for bc in self.i7_barcodes]
+            second = [(bc, i5_ids[bc]) for bc in self.i5_barcodes]
+            first_mismatches, second_mismatches = self.mismatches
+        self._first = build_barcode_table(first, first_mismatches)
+        self._second = build_barcode_table(second, second_mismatches)
+
+        first_stats = table_stats(self._first)
+        second_stats = table_stats(self._second)
+        self.index_stats = dict(
+            (k, first_stats[k] + second_stats[k]) for k in first_stats)
+        self.index_stats["barcodes"] = len(self.samples)
+        self.index_stats["mismatches"] = list(self.mismatches)
+
+    def _cache_values(self):
+        return range(max(len(self.i7_barcodes), self._n_i5))
+
+    def _value_ids(self):
+        # The table values are already index numbers
+        return None
+
+    def assign(self, seq, qual=None):
+        n1 = self._first.get(seq[:self._split])
+        n2 = self._second.get(seq[self._split:])
+        sample = None
+        if n1 is not None and n2 is not None:
+            if self.revcomp:
+                i7, i5 = n2, n1
+            else:
+                i7, i5 = n1, n2
+            self.pair_counts[i7][i5] += 1
+            sample = self._pairs.get(i7 * self._n_i5 + i5)
+        if sample is not None and self._low_quality(seq, qual, sample):
+            self.read_counts['unassigned'] += 1
+            self.quality_rejected += 1
+            return None
         if sample is not None:
             self.read_counts[sample.name] += 1
         else:
             self.read_counts['unassigned'] += 1
+            self.unassigned_barcodes.add(seq)
+            if (seq[:self._split] in self._first and n1 is None) or (
+                    seq[self._split:] in self._second and n2 is None):
+                self.ambiguous_reads += 1
         return sample
 
+    def assign_batch(self, seqs, quals=None):
+        if self._packed is None:
+            self._packed = self._pack_tables()
+        if not self._packed:
+            return self._assign_each(seqs, quals)
+        first, second, pairs, length = self._packed
+        digits, valid = encode_barcodes(seqs, length)
+        n1 = first.lookup(pack_digits(digits[:, :self._split]))
+        n2 = second.lookup(pack_digits(digits[:, self._split:]))
+        if self.revcomp:
+            i7, i5 = n2, n1
+        else:
+            i7, i5 = n1, n2
+        known = (i7 >= 0) & (i5 >= 0)
+        pair = np.where(known, i7 * self._n_i5 + i5, 0)
+        idx = np.where(known, pairs[pair], UNASSIGNED)
+        idx[(n1 == AMBIGUOUS) | (n2 == AMBIGUOUS)] = AMBIGUOUS
+        pair_counts = np.bincount(pair[known & valid], minlength=len(pairs))
+        pair_counts = pair_counts.reshape(-1, self._n_i5).tolist()
+        for row, new_row in zip(self.pair_counts, pair_counts):
+            for j, n in enumerate(new_row):
+                row[j] += n
+        return self._finish_batch(seqs, quals, idx, digits, valid)
+
+    def _pack_tables(self):
+        if np is None:
+            return ()
+        length1 = self._table_length("_first")
+        length2 = self._table_length("_second")
+        if length1 is None or length2 is None:
+            return ()
+        self._pack_read_barcodes(length1 + length2)
+        ids = dict((id(s), n) for n, s in enumerate(self.samples))
+        pairs = np.full(
+            len(self.i7_barcodes) * self._n_i5, UNASSIGNED, dtype=np.int64)
+        for key, s in self._pairs.items():
+            pairs[key] = ids[id(s)]
+        first = self._packed_table("_first")
+        second = self._packed_table("_second")
+        return first, second, pairs, length1 + length2
+
+    def _init_counts(self):
+        super(DualBarcodeAssigner, self)._init_counts()
+        self.pair_counts = [[0] * self._n_i5 for _ in self.i7_barcodes]
+
+    def get_counts(self):
+        counts = super(DualBarcodeAssigner, self).get_counts()
+        counts["pair_counts"] = self.pair_counts
+        return counts
+
+    def merge_counts(self, counts):
+        super(DualBarcodeAssigner, self).merge_counts(counts)
+        for row, other_row in zip(self.pair_counts, counts["pair_counts"]):
+            for i, n in enumerate(other_row):
+                row[i] += n
+
+    def get_stats(self):
+        stats = super(DualBarcodeAssigner, self).get_stats()
+        stats["index_pairs"] = {
+            "i7": self.i7_barcodes,
+            "i5": self.i5_barcodes,
+            "counts": self.pair_counts,
+            }
+        return stats
+
+
+class PackedBarcodeTable(object):
+    """Barcode table keyed by barcodes packed into integers.
+
+    All barcodes in the table must have the same length. Values are
+    mapped to small integers with ids, a dict keyed by the id() of each
+    value. Without ids, values must already be integers. Missing
+    barcodes give UNASSIGNED, and ambiguous ones AMBIGUOUS.
+    """
+    def __init__(self, table, ids=None):
+        barcodes = list(table)
+        values = [AMBIGUOUS if v is None else
+                  (v if ids is None else ids[id(v)])
+                  for v in table.values()]
+        length = len(barcodes[0])
+        digits, valid = encode_barcodes(barcodes, length)
+        # Barcodes with other bases are never matched by a lookup
+        keys = pack_digits(digits)[valid]
+        values = np.array(values, dtype=np.int64)[valid]
+        size = 4 ** length
+        if size <= _DENSE_TABLE_SIZE:
+            dtype = np.int16 if values.max(initial=0) < (1 << 15) else np.int32
+            self._dense = np.full(size, UNASSIGNED, dtype=dtype)
+            self._dense[keys] = values
+        else:
+            self._dense = None
+            order = np.argsort(keys)
+            self._keys = keys[order]
+            self._values = values[order]
+
+    # Arrays that hold the table, for saving it
+    array_names = ("dense", "keys", "values")
+
+    def arrays(self):
+        if self._dense is not None:
+            return {"dense": self._dense}
+        return {"keys": self._keys, "values": self._values}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Make a table from the arrays of another, as given by arrays."""
+        table = cls.__new__(cls)
+        table._dense = arrays.get("dense")
+        if table._dense is None:
+            table._keys = arrays["keys"]
+            table._values = arrays["values"]
+        return table
+
+    def lookup(self, codes):
+        if self._dense is not None:
+            return self._dense[codes].astype(np.int64)
+        if not len(self._keys):
+            return np.full(len(codes), UNASSIGNED, dtype=np.int64)
+        pos = np.searchsorted(self._keys, codes)
+        pos[pos == len(self._keys)] = 0
+        return np.where(
+            self._keys[pos] == codes, self._values[pos], UNASSIGNED)
+
+
+def encode_barcodes(seqs, length):
+    """Convert barcodes to an array of 2-bit base codes.
+
+    Returns an array with a row of codes for each barcode, and an array
+    that is False for barcodes of another length or with bases other
+    than A, C, G and T. The rows for those barcodes are all zero.
+    """
+    rows, same_length = _byte_rows(seqs, length, "N")
+    digits = _BASE_CODES[rows]
+    # Other bases have code 4, so they set the third bit
+    seen = np.zeros(len(seqs), dtype=np.uint8)
+    for column in digits.T:
+        seen |= column
+    digits &= 3
+    return digits, same_length & (seen < 4)
+
+
+def _byte_rows(strs, length, fill):
+    # Array with one row of bytes for each string. Strings of another
+    # length are replaced by the fill character.
+    n = len(strs)
+    # Each non-ASCII character is replaced by a single "?"
+    data = ("\n".join(strs) + "\n").encode("ascii", "replace")
+    if len(data) == n * (length + 1):
+        rows = np.frombuffer(data, dtype=np.uint8).reshape(n, length + 1)
+        # The strings do not hold newlines, so if every newline is in
+        # the last column, all strings have the right length.
+        if (rows[:, length] == ord("\n")).all():
+            return rows[:, :length], True
+    same_length = np.fromiter(
+        map(len, strs), dtype=np.int64, count=n) == length
+    data = "".join(s if len(s) == length else fill * length for s in strs)
+    rows = np.frombuffer(data.encode("ascii", "replace"), dtype=np.uint8)
+    return rows.reshape(n, length), same_length
+
+
+def pack_digits(digits):
+    """Pack rows of 2-bit base codes into one integer per row."""
+    packed = np.zeros(len(digits), dtype=np.int64)
+    for column in digits.T:
+        packed <<= 2
+        packed |= column
+    return packed
+
+
+def _barcode_length(table):
+    # Barcodes up to 31 bases fit in a signed 64-bit integer
+    lengths = set(map(len, table))
+    if len(lengths) == 1:
+        length = lengths.pop()
+        if 0 < length <= 31:
+            return length
+    return None
+
+
+def _unique(xs):
+    seen = set()
+    return [x for x in xs if not (x in seen or seen.add(x))]
+
+
+def make_assigner(samples, mismatches=0, revcomp=True, **kwargs):
+    """Return a dual-index assigner if the samples have two indices."""
+    if samples and all(len(s.barcodes) == 2 for s in samples):
+        return DualBarcodeAssigner(samples, mismatches, revcomp, **kwargs)
+    if not isinstance(mismatches, int):
+        raise ValueError(
+            "Separate mismatches for each index need dual-index "
+            "barcodes (got %s)" % (mismatches,))
+    return BarcodeAssigner(samples, mismatches, revcomp, **kwargs)
+
+
+def build_barcode_table(barcodes, mismatches):
+    """Map every barcode within the mismatch budget to a value.
+
+    barcodes is a list of (barcode, value) pairs with unique barcodes.
+    A barcode goes to the value of the closest listed barcode. If two
+    listed barcodes with different values are equally close, the entry
+    is ambiguous and maps to None.
+    """
+    table = dict(barcodes)
+    # Number of mismatches for each entry in the table
+    distances = dict.fromkeys(table, 0)
+    for bc, value in barcodes:
+        for n in range(1, mismatches + 1):
+            for error_bc in error_barcodes(bc, n):
+                d = distances.get(error_bc)
+                if d is None or n < d:
+                    table[error_bc] = value
+                    distances[error_bc] = n
+                elif n == d and table[error_bc] != value:
+                    table[error_bc] = None
+    return table
+
+
+def table_stats(table):
+    return {
+        "entries": len(table),
+        "ambiguous_entries": sum(1 for v in table.values() if v is None),
+        "size_bytes": sys.getsizeof(table) + sum(
+            sys.getsizeof(bc) for bc in table),
+        }
+
+
+def error_barcodes(barcode, mismatches):
+    # If the number of mismatches is set to 0, there will be no
+    # error barcodes. Immediately stop the iteration.
+    if mismatches == 0:
+        return
+    # Each item in idx_sets is a set of indices where mismatches
+    # should occur.
+    idx_sets = itertools.combinations(range(len(barcode)), mismatches)
+    for idx_set in idx_sets:
+        # Change to list because strings are immutable
+        bc = list(barcode)
+        # Replace the base at each mismatch position with an
+        # ambiguous base specifying all possibilities BUT the one
+        # we see.
+        for idx in idx_set:
+            bc[idx] = AMBIGUOUS_BASES_COMPLEMENT[bc[idx]]
+        # Expand to all possibilities for mismatching at this
+        # particular set of positions
+        for error_bc in deambiguate(bc):
+            yield error_bc
+
 
 AMBIGUOUS_BASES = {
     "T": "T",
@@ -0,0 +1,76 @@
+"""On-disk cache of compiled barcode tables.
+
+Building the barcode table of an assigner means listing every barcode
+within the mismatch budget of each sample, which takes seconds to
+minutes for thousands of samples and two or more mismatches. The
+tables are saved as numpy arrays in a directory named by a hash of the
+samples and options, and loaded back through a memory map, so later
+runs, other lanes with the same samples and worker processes start
+without building them again.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+_CACHE_VERSION = 1
+
+_META_FILENAME = "meta.json"
+
+
+def cache_key(samples, mismatches, revcomp):
+    """Hash of everything the barcode tables are built from."""
+    data = json.dumps([
+        _CACHE_VERSION, [[s.name, s.barcode] for s in samples],
+        mismatches, revcomp])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class BarcodeTableCache(object):
+    """Named arrays and metadata saved for one set of barcode tables."""
+
+    def __init__(self, cache_dir, key):
+        self.cache_dir = cache_dir
+        self.fp = os.path.join(cache_dir, key)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.fp, _META_FILENAME))
+
+    def save(self, arrays, meta):
+        """Save the arrays, unless another process saved them first.
+
+        The files are written to a temporary directory and renamed
+        into place, so a cache entry is either complete or missing.
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        temp_fp = tempfile.mkdtemp(
+            dir=self.cache_dir, prefix=os.path.basename(self.fp) + ".tmp")
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_fp, name + ".npy"), array)
+            with open(os.path.join(temp_fp, _META_FILENAME), "w") as f:
+                json.dump(meta, f)
+            os.rename(temp_fp, self.fp)
+        except OSError:
+            if not self.exists():
+                raise
+        finally:
+            if os.path.exists(temp_fp):
+                shutil.rmtree(temp_fp)
+
+    def load_meta(self):
+        with open(os.path.join(self.fp, _META_FILENAME)) as f:
+            return json.load(f)
+
+    def has(self, name):
+        return os.path.exists(os.path.join(self.fp, name + ".npy"))
+
+    def load(self, name):
+        return np.load(os.path.join(self.fp, name + ".npy"), mmap_mode="r")
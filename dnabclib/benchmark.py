@@ -0,0 +1,323 @@
+"""Throughput benchmarks on synthetic sequencing runs.
+
+A run is generated with known barcodes, read errors and unassigned
+reads. Parsing, barcode assignment, each writer and the whole program
+are then timed on it. Results are saved as JSON and can be compared
+with the results of an earlier version.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from .assigner import BarcodeAssigner, reverse_complement
+from .main import main as dnabc_main
+from .sample import Sample
+from .seqfile import parse_fastq
+from .version import __version__
+from .writer import (
+    FastaWriter, FastqWriter, PairedFastqWriter, InterleavedFastqWriter,
+    )
+
+DEFAULT_PARAMS = {
+    "reads": 100000,
+    "read_length": 150,
+    "samples": 96,
+    "barcode_length": 12,
+    # Chance of a sequencing error at each barcode base
+    "error_rate": 0.01,
+    # Reads with a barcode not belonging to any sample
+    "unassigned_fraction": 0.05,
+    "seed": 0,
+}
+
+LAYOUTS = ("index", "header")
+
+BASES = "ACGT"
+
+
+def make_barcodes(rng, n, length, min_distance=3):
+    """Random barcodes differing from each other at min_distance bases."""
+    barcodes = []
+    tries = 0
+    while len(barcodes) < n:
+        tries += 1
+        if tries > 1000 * n:
+            raise ValueError(
+                "Could not find %s barcodes of length %s" % (n, length))
+        bc = "".join(rng.choice(BASES) for _ in range(length))
+        if all(_distance(bc, other) >= min_distance for other in barcodes):
+            barcodes.append(bc)
+    return barcodes
+
+
+def _distance(a, b):
+    return sum(x != y for x, y in zip(a, b))
+
+
+def _add_errors(rng, seq, error_rate):
+    seq = list(seq)
+    for i, base in enumerate(seq):
+        if rng.random() < error_rate:
+            seq[i] = rng.choice(BASES.replace(base, ""))
+    return "".join(seq)
+
+
+def make_run(output_dir, layout="index", reads=100000, read_length=150,
+             samples=96, barcode_length=12, error_rate=0.01,
+             unassigned_fraction=0.05, seed=0):
+    """Write a synthetic run to output_dir.
+
+    With the "index" layout, the barcodes are written to an index reads
+    file as the reverse complement, as the MiSeq does. With the
+    "header" layout, they are written at the end of the description
+    line of each read. Returns the file paths.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout: %s" % layout)
+    rng = random.Random(seed)
+    barcodes = make_barcodes(rng, samples + 1, barcode_length)
+    # The extra barcode is used for unassigned reads, so that they are
+    # not corrected to a sample.
+    unassigned_barcode = barcodes.pop()
+    # Reads are drawn from a pool to keep generation fast
+    seqs = ["".join(rng.choice(BASES) for _ in range(read_length))
+            for _ in range(1000)]
+    quals = ["".join(rng.choice("#,:FFFF") for _ in range(read_length))
+             for _ in range(100)]
+
+    fps = {
+        "barcode_file": os.path.join(output_dir, "barcodes.txt"),
+        "forward_reads": os.path.join(output_dir, "run_R1.fastq"),
+        "reverse_reads": os.path.join(output_dir, "run_R2.fastq"),
+        }
+    if layout == "index":
+        fps["index_reads"] = os.path.join(output_dir, "run_I1.fastq")
+    with open(fps["barcode_file"], "w") as f:
+        for n, bc in enumerate(barcodes):
+            f.write("Sample%d\t%s\n" % (n + 1, bc))
+
+    files = dict((key, open(fp, "w")) for key, fp in fps.items()
+                 if key != "barcode_file")
+    try:
+        for n in range(reads):
+            if rng.random() < unassigned_fraction:
+                bc = unassigned_barcode
+            else:
+                bc = rng.choice(barcodes)
+            bc = _add_errors(rng, bc, error_rate)
+            desc = "M00001:1:000000000-A0000:1:1101:%d:%d" % (
+                n // 1000, n % 1000)
+            if layout == "index":
+                files["index_reads"].write("@%s 1:N:0:0\n%s\n+\n%s\n" % (
+                    desc, reverse_complement(bc),
+                    rng.choice(quals)[:barcode_length]))
+                fwd_desc = "%s 1:N:0:0" % desc
+                rev_desc = "%s 2:N:0:0" % desc
+            else:
+                fwd_desc = "%s 1:N:0:%s" % (desc, bc)
+                rev_desc = "%s 2:N:0:%s" % (desc, bc)
+            files["forward_reads"].write("@%s\n%s\n+\n%s\n" % (
+                fwd_desc, rng.choice(seqs), rng.choice(quals)))
+            files["reverse_reads"].write("@%s\n%s\n+\n%s\n" % (
+                rev_desc, rng.choice(seqs), rng.choice(quals)))
+    finally:
+        for f in files.values():
+            f.close()
+    return fps
+
+
+def _best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmarks(work_dir, params=None, layout="index", repeat=3):
+    """Time each part of dnabc on a synthetic run in work_dir.
+
+    Each benchmark is run repeat times, and the best time is kept.
+    """
+    run_params = dict(DEFAULT_PARAMS)
+    run_params.update(params or {})
+    fps = make_run(work_dir, layout, **run_params)
+    n = run_params["reads"]
+    revcomp = layout == "index"
+    with open(fps["barcode_file"]) as f:
+        samples = Sample.load(f)
+    with open(fps["forward_reads"]) as f:
+        fwds = list(parse_fastq(f))
+    with open(fps["reverse_reads"]) as f:
+        revs = list(parse_fastq(f))
+    if layout == "index":
+        with open(fps["index_reads"]) as f:
+            barcodes = [r.seq for r in parse_fastq(f)]
+    else:
+        barcodes = [r.desc.rpartition(":")[2] for r in fwds]
+    assigned = list(map(
+        BarcodeAssigner(samples, mismatches=1, revcomp=revcomp).assign,
+        barcodes))
+
+    def parse():
+        with open(fps["forward_reads"], "rb") as f:
+            for _ in parse_fastq(f):
+                pass
+
+    # Lookup tables are built before timing starts
+    assigner = BarcodeAssigner(samples, mismatches=1, revcomp=revcomp)
+    assigner.assign_batch(barcodes[:1])
+
+    def assign():
+        list(map(assigner.assign, barcodes))
+
+    def assign_batch():
+        assigner.assign_batch(barcodes)
+
+    def write(writer_cls, reads):
+        def func():
+            out_dir = tempfile.mkdtemp(dir=work_dir)
+            writer = writer_cls(out_dir)
+            try:
+                for read, sample in zip(reads, assigned):
+                    writer.write(read, sample)
+            finally:
+                writer.close()
+            shutil.rmtree(out_dir)
+        return func
+
+    def end_to_end():
+        out_dir = tempfile.mkdtemp(dir=work_dir)
+        argv = [
+            "--forward-reads", fps["forward_reads"],
+            "--reverse-reads", fps["reverse_reads"],
+            "--barcode-file", fps["barcode_file"],
+            "--output-dir", os.path.join(out_dir, "output"),
+            "--summary-file", os.path.join(out_dir, "summary.json"),
+            "--config-file", config_fp,
+            ]
+        if layout == "index":
+            argv += ["--index-reads", fps["index_reads"]]
+        dnabc_main(argv)
+        shutil.rmtree(out_dir)
+
+    # Keep the user's ~/.dnabc.json out of the end-to-end run
+    config_fp = os.path.join(work_dir, "config.json")
+    with open(config_fp, "w") as f:
+        json.dump({"mismatches": 1}, f)
+
+    benchmarks = [
+        ("parse_fastq", parse),
+        ("assign", assign),
+        ("assign_batch", assign_batch),
+        ("FastaWriter", write(FastaWriter, fwds)),
+        ("FastqWriter", write(FastqWriter, fwds)),
+        ("PairedFastqWriter",
+         write(PairedFastqWriter, list(zip(fwds, revs)))),
+        ("InterleavedFastqWriter",
+         write(InterleavedFastqWriter, list(zip(fwds, revs)))),
+        ("end_to_end", end_to_end),
+        ]
+    results = {}
+    for name, func in benchmarks:
+        seconds = _best_time(func, repeat)
+        results[name] = {
+            "seconds": seconds,
+            "reads_per_second": n / seconds if seconds else 0.0,
+            }
+    return {
+        "program": "dnabc-benchmark",
+        "version": __version__,
+        "python": sys.version.split()[0],
+        "layout": layout,
+        "params": run_params,
+        "repeat": repeat,
+        "results": results,
+        }
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """Benchmarks slower than the baseline by more than tolerance.
+
+    Returns a list of (name, seconds, baseline seconds) tuples.
+    Benchmarks missing from either set of results are skipped.
+    """
+    for key in ["layout", "params"]:
+        if results[key] != baseline.get(key):
+            raise ValueError(
+                "Baseline was run with a different %s: %s" % (
+                    key, baseline.get(key)))
+    slower = []
+    for name, res in sorted(results["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        if res["seconds"] > base["seconds"] * (1 + tolerance):
+            slower.append((name, res["seconds"], base["seconds"]))
+    return slower
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description="Benchmark dnabc on a synthetic sequencing run")
+    p.add_argument(
+        "--layout", choices=LAYOUTS, default="index",
+        help=(
+            "Barcodes in an index reads file or in the read headers "
+            "(default: %(default)s)"))
+    for key, value in sorted(DEFAULT_PARAMS.items()):
+        p.add_argument(
+            "--" + key.replace("_", "-"), type=type(value), default=value,
+            help="(default: %(default)s)")
+    p.add_argument(
+        "--repeat", type=int, default=3,
+        help="Times to run each benchmark (default: %(default)s)")
+    p.add_argument(
+        "--output-file", type=argparse.FileType("w"),
+        help="Write the results to this file (JSON format)")
+    p.add_argument(
+        "--baseline-file", type=argparse.FileType("r"),
+        help="Compare against results saved from an earlier run")
+    p.add_argument(
+        "--tolerance", type=float, default=0.1,
+        help=(
+            "Fraction a benchmark may be slower than the baseline "
+            "(default: %(default)s)"))
+    p.add_argument(
+        "--work-dir",
+        help="Directory for the synthetic run (default: a temporary one)")
+    args = p.parse_args(argv)
+
+    params = dict((key, getattr(args, key)) for key in DEFAULT_PARAMS)
+    baseline = None
+    if args.baseline_file is not None:
+        baseline = json.load(args.baseline_file)
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        results = run_benchmarks(work_dir, params, args.layout, args.repeat)
+    finally:
+        shutil.rmtree(work_dir)
+
+    for name, res in sorted(results["results"].items()):
+        sys.stdout.write("%-24s %10.3f s %12.0f reads/s\n" % (
+            name, res["seconds"], res["reads_per_second"]))
+    if args.output_file is not None:
+        json.dump(results, args.output_file, indent=2)
+    if baseline is not None:
+        try:
+            slower = compare_results(results, baseline, args.tolerance)
+        except ValueError as e:
+            p.error(str(e))
+        for name, seconds, base_seconds in slower:
+            sys.stdout.write(
+                "Slower than baseline: %s %.3f s (baseline %.3f s)\n" % (
+                    name, seconds, base_seconds))
+        if slower:
+            return 1
+    return 0
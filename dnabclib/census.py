@@ -0,0 +1,73 @@
+"""Count the reads of each sample without demultiplexing them.
+
+Only the barcodes are read: the sequences of the index reads file, or
+the headers of the forward reads file when there is no index file.
+Nothing is written. Counting can stop after a number of reads, giving
+a quick look at the distribution of reads between samples, such as to
+catch a wrong sample sheet before a full run.
+"""
+import io
+import os
+
+from .compression import input_position, open_input
+from .seqfile import DEFAULT_BLOCK_SIZE
+from .timing import StageTimer
+
+
+def count_barcodes(seq_file, assigner, max_reads=None, timer=None,
+                   block_size=DEFAULT_BLOCK_SIZE):
+    """Assign the barcodes of the reads, returning census statistics.
+
+    The counts are kept by the assigner. If counting stops at
+    max_reads before the end of the input, the number of reads in the
+    whole file is projected from the share of the barcode file read
+    so far, and the counts of each sample are scaled up to match.
+    """
+    timer = timer or StageTimer()
+    stream = open_input(seq_file.barcode_file(), seq_file.threads)
+    reads = 0
+    # Reads parsed, including any past max_reads in the last batch
+    scanned = 0
+    stopped = False
+    batches = timer.iterate(
+        "parse", seq_file.barcode_batches(block_size, stream), len)
+    for barcodes in batches:
+        scanned += len(barcodes)
+        if max_reads is not None and reads + len(barcodes) >= max_reads:
+            barcodes = barcodes[:max_reads - reads]
+            stopped = True
+        with timer.stage("assign", len(barcodes)):
+            assigner.assign_batch(barcodes)
+        reads += len(barcodes)
+        if stopped:
+            break
+    batches.close()
+    stats = {
+        "reads": reads,
+        "max_reads": max_reads,
+        "complete": not stopped,
+        }
+    if stopped:
+        projected_reads = _project_reads(
+            seq_file.barcode_file(), stream, scanned)
+        stats["projected_reads"] = projected_reads
+        if projected_reads is not None and reads:
+            scale = float(projected_reads) / reads
+            stats["projected_counts"] = dict(
+                (name, int(round(n * scale)))
+                for name, n in assigner.read_counts.items())
+    return stats
+
+
+def _project_reads(f, stream, scanned):
+    # The position runs ahead of the reads parsed by at most one block,
+    # which is small next to a whole lane. Gzip input is assumed to
+    # compress evenly.
+    try:
+        size = os.fstat(f.fileno()).st_size
+        position = input_position(stream)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+    if not position:
+        return None
+    return int(round(scanned * float(size) / position))
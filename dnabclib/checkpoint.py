@@ -0,0 +1,157 @@
+import os
+import pickle
+
+from .parallel import DEFAULT_CHUNK_READS, _as_file, chunk_reads_count
+from .seqfile import read_record_chunks, use_passthrough
+from .timing import StageTimer
+
+CHECKPOINT_FILENAME = ".dnabc_checkpoint"
+
+# Reads demultiplexed between checkpoints
+DEFAULT_CHECKPOINT_READS = 10000000
+
+_CHECKPOINT_VERSION = 2
+
+
+class Checkpointer(object):
+    """Saves the progress of a run now and then, so it can be resumed.
+
+    A checkpoint holds the position reached in each input file, the
+    counts of the assigner and QC, and the size of every output file
+    once all output for the reads so far is written, along with the
+    number of unassigned reads written. To resume, output
+    files are truncated back to those sizes and reading starts again
+    from the saved positions, so the counts and output come out the
+    same as for an uninterrupted run.
+
+    Positions are in decompressed bytes. Uncompressed input is seeked
+    to them, while gzip input has to be decompressed up to them again.
+    """
+    def __init__(self, fp, assigner, writer, qc=None,
+                 every_reads=DEFAULT_CHECKPOINT_READS, inputs=None,
+                 timer=None):
+        if every_reads < 1:
+            raise ValueError("Checkpoint interval must be at least 1 read")
+        self.fp = fp
+        self.assigner = assigner
+        self.writer = writer
+        self.qc = qc
+        self.every_reads = every_reads
+        self.inputs = inputs
+        self.timer = timer or StageTimer()
+        self.offsets = None
+        self.reads = 0
+        self.resumed_reads = 0
+        self.saves = 0
+        self._unsaved = 0
+
+    def resume(self):
+        """Restore the state of the last checkpoint, if there is one."""
+        state = load_checkpoint(self.fp)
+        if state is None:
+            return
+        if state["inputs"] != self.inputs:
+            raise ValueError(
+                "Checkpoint was saved for other input files: %s"
+                % state["inputs"])
+        if (state["qc"] is None) != (self.qc is None):
+            raise ValueError(
+                "Checkpoint was saved with QC statistics turned %s"
+                % ("off" if state["qc"] is None else "on"))
+        self.writer.restore(state["outputs"], state["unassigned_written"])
+        self.assigner.merge_counts(state["counts"])
+        if self.qc is not None:
+            self.qc.merge_counts(state["qc"])
+        self.offsets = state["offsets"]
+        self.reads = self.resumed_reads = state["reads"]
+
+    @staticmethod
+    def progress(chunk):
+        """Bytes of each file and number of reads in a chunk of records."""
+        return [len(text) for text in chunk], chunk_reads_count(chunk)
+
+    def advance(self, sizes, reads):
+        """Record that a chunk was demultiplexed and handed to the writer.
+
+        A checkpoint is saved once every_reads reads have gone by.
+        """
+        if self.offsets is None:
+            self.offsets = [0] * len(sizes)
+        self.offsets = [
+            offset + size for offset, size in zip(self.offsets, sizes)]
+        self.reads += reads
+        self._unsaved += reads
+        if self._unsaved >= self.every_reads:
+            self.save()
+
+    def save(self):
+        with self.timer.stage("checkpoint"):
+            state = {
+                "version": _CHECKPOINT_VERSION,
+                "inputs": self.inputs,
+                "offsets": self.offsets,
+                "reads": self.reads,
+                "counts": self.assigner.get_counts(),
+                "qc": self.qc.get_counts() if self.qc is not None else None,
+                "outputs": self.writer.sync(),
+                "unassigned_written": self.writer.unassigned_written,
+                }
+            save_checkpoint(self.fp, state)
+        self.saves += 1
+        self._unsaved = 0
+
+    def finish(self):
+        """Remove the checkpoint once the run is complete."""
+        if os.path.exists(self.fp):
+            os.remove(self.fp)
+
+    def get_stats(self):
+        return {
+            "every_reads": self.every_reads,
+            "saves": self.saves,
+            "resumed_reads": self.resumed_reads,
+            }
+
+
+def save_checkpoint(fp, state):
+    # Written to a temporary file and renamed, so an interruption
+    # never leaves a partial checkpoint behind.
+    temp_fp = fp + ".tmp"
+    with open(temp_fp, "wb") as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_fp, fp)
+
+
+def load_checkpoint(fp):
+    if not os.path.exists(fp):
+        return None
+    with open(fp, "rb") as f:
+        state = pickle.load(f)
+    if state.get("version") != _CHECKPOINT_VERSION:
+        raise ValueError("Unsupported checkpoint version: %s" % fp)
+    return state
+
+
+def demultiplex_checkpointed(seq_file, assigner, writer, checkpoint,
+                             timer=None, qc=None):
+    """Demultiplex in the main process, saving checkpoints as we go.
+
+    The input is read in chunks of raw records, as for worker
+    processes, so the position in each file is known after every
+    chunk. Reading starts from the checkpoint's positions, if any.
+    """
+    timer = timer or StageTimer()
+    chunk_reads = min(DEFAULT_CHUNK_READS, checkpoint.every_reads)
+    chunks = timer.iterate("read", read_record_chunks(
+        seq_file.input_files(), chunk_reads, threads=seq_file.threads,
+        offsets=checkpoint.offsets), chunk_reads_count)
+    passthrough = use_passthrough(writer, qc)
+    for chunk in chunks:
+        batches = seq_file.parse_batches(
+            [_as_file(text) for text in chunk], passthrough)
+        seq_file.demultiplex_reads(
+            assigner, writer, batches, timer, qc, passthrough)
+        checkpoint.advance(*checkpoint.progress(chunk))
+    return assigner.read_counts
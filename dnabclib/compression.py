@@ -0,0 +1,375 @@
+import collections
+import concurrent.futures
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Size of the fixed part of a gzip member header
+_GZIP_HEADER_SIZE = 12
+
+# BGZF blocks are at most 64 KiB, so several are inflated per task to
+# keep the thread pool overhead small.
+_BGZF_BLOCKS_PER_TASK = 16
+
+_CHUNK_SIZE = 1 << 20
+
+
+def default_threads():
+    return min(4, os.cpu_count() or 1)
+
+
+def open_input(f, threads=None):
+    """Return a binary stream for f, decompressing gzip data if found.
+
+    Compression is detected by magic bytes. BGZF files are inflated
+    block by block on a thread pool. Other gzip files, including
+    multi-member files, are inflated on a background thread.
+    """
+    stream = getattr(f, "buffer", f)
+    if isinstance(stream, io.TextIOBase):
+        return f
+    if not hasattr(stream, "peek"):
+        stream = io.BufferedReader(stream)
+    head = stream.peek(_GZIP_HEADER_SIZE + 6)
+    if not head.startswith(GZIP_MAGIC):
+        return stream
+    if threads is None:
+        threads = default_threads()
+    if is_bgzf(head):
+        chunks = _inflate_bgzf(stream, threads)
+    else:
+        chunks = iter_in_thread(_inflate_gzip(stream))
+    return io.BufferedReader(_ChunkStream(chunks), _CHUNK_SIZE)
+
+
+def input_position(stream):
+    """Bytes of the input file behind the data read from a stream.
+
+    The stream is one returned by open_input. For gzip input, the
+    position is estimated from the compression ratio of the data
+    inflated so far, and data inflated ahead of the reader is not
+    counted.
+    """
+    raw = getattr(stream, "raw", None)
+    if isinstance(raw, _ChunkStream):
+        return raw.input_position(stream.tell())
+    return stream.tell()
+
+
+def is_bgzf(head):
+    # BGZF is gzip with an extra field holding the block size in a
+    # subfield tagged "BC"
+    if len(head) < 18 or not head.startswith(GZIP_MAGIC):
+        return False
+    flags = head[3]
+    return bool(flags & 4) and head[12:14] == b"BC"
+
+
+def _inflate_gzip(stream):
+    # Each chunk is yielded with the input position reached
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    in_member = False
+    position = 0
+    while True:
+        data = stream.read(_CHUNK_SIZE)
+        if not data:
+            break
+        position += len(data)
+        if not in_member:
+            # Some archiving tools pad the file with NUL bytes after
+            # the last member.
+            data = data.lstrip(b"\x00")
+        while data:
+            in_member = True
+            try:
+                chunk = d.decompress(data)
+            except zlib.error as e:
+                raise ValueError("Invalid gzip input: %s" % e)
+            data = d.unused_data
+            yield chunk, position - len(data)
+            if d.eof:
+                # Any unused data is the start of the next gzip member
+                d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                in_member = False
+                data = data.lstrip(b"\x00")
+    if in_member:
+        yield d.flush(), position
+        if not d.eof:
+            raise ValueError("Truncated gzip input")
+
+
+def _bgzf_blocks(stream):
+    while True:
+        header = stream.read(_GZIP_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) < _GZIP_HEADER_SIZE or not header.startswith(
+                GZIP_MAGIC):
+            raise ValueError("Invalid BGZF block header")
+        xlen, = struct.unpack("<H", header[10:12])
+        extra = stream.read(xlen)
+        if len(extra) != xlen:
+            raise ValueError("Truncated BGZF block")
+        bsize = _bgzf_block_size(extra)
+        rest_size = bsize + 1 - _GZIP_HEADER_SIZE - xlen
+        rest = stream.read(rest_size)
+        if rest_size < 8 or len(rest) != rest_size:
+            raise ValueError("Truncated BGZF block")
+        yield bsize + 1, rest
+
+
+def _bgzf_block_size(extra):
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag = extra[pos:pos + 2]
+        slen, = struct.unpack("<H", extra[pos + 2:pos + 4])
+        if tag == b"BC" and slen == 2:
+            bsize, = struct.unpack("<H", extra[pos + 4:pos + 6])
+            return bsize
+        pos += 4 + slen
+    raise ValueError("gzip member without BGZF block size")
+
+
+def _inflate_bgzf_blocks(blocks):
+    out = []
+    for block in blocks:
+        # Each block holds raw deflate data followed by CRC32 and size
+        try:
+            data = zlib.decompress(block[:-8], -zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise ValueError("Invalid BGZF block: %s" % e)
+        crc, size = struct.unpack("<II", block[-8:])
+        if len(data) != size or zlib.crc32(data) != crc:
+            raise ValueError("BGZF block failed integrity check")
+        out.append(data)
+    return b"".join(out)
+
+
+def _inflate_bgzf(stream, threads):
+    # zlib releases the GIL while inflating, so threads run in parallel
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        blocks = _bgzf_blocks(stream)
+        position = 0
+        while True:
+            task = [b for _, b in zip(range(_BGZF_BLOCKS_PER_TASK), blocks)]
+            if task:
+                position += sum(size for size, _ in task)
+                future = pool.submit(
+                    _inflate_bgzf_blocks, [block for _, block in task])
+                pending.append((future, position))
+            if pending and (not task or len(pending) >= 2 * threads):
+                future, end = pending.popleft()
+                yield future.result(), end
+            elif not task:
+                return
+
+
+def iter_in_thread(iterable, maxsize=8):
+    """Run an iterator on a background thread, yielding its items.
+
+    Items are passed through a bounded queue, so the background thread
+    stops producing when the consumer falls behind. Exceptions raised
+    in the background thread are raised again in the consumer.
+    """
+    q = queue.Queue(maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(q, (None, item), stop):
+                    return
+        except Exception as e:
+            _put(q, (e, None), stop)
+        else:
+            _put(q, (None, done), stop)
+
+    t = threading.Thread(target=produce, daemon=True)
+    t.start()
+    try:
+        while True:
+            err, item = q.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class _ChunkStream(io.RawIOBase):
+    """Read-only binary stream over an iterator of inflated chunks.
+
+    Each chunk comes with the position reached in the compressed input,
+    which gives the compression ratio of the data so far.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+        # Bytes out and in up to the end of the current chunk
+        self._out_position = 0
+        self._in_position = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._out_position - len(self._chunk)
+
+    def input_position(self, position):
+        if not self._out_position:
+            return self._in_position
+        return int(position * float(self._in_position) / self._out_position)
+
+    def readinto(self, b):
+        while not self._chunk:
+            item = next(self._chunks, None)
+            if item is None:
+                return 0
+            chunk, self._in_position = item
+            self._out_position += len(chunk)
+            self._chunk = memoryview(chunk)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+class CompressionPool(object):
+    """Thread pool shared by the compressed output files of a writer.
+
+    Uncompressed data held for all files, whether buffered or waiting
+    to be compressed, is kept under max_buffered bytes. Over budget,
+    the file with the largest buffer is submitted first, then the
+    files with the most pending data are written out.
+    """
+
+    def __init__(self, threads=None, compresslevel=6,
+                 chunk_size=_CHUNK_SIZE, max_buffered=256 << 20):
+        if threads is None:
+            threads = default_threads()
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.compresslevel = compresslevel
+        self.chunk_size = chunk_size
+        self.max_buffered = max_buffered
+        self.buffered = 0
+        self._files = set()
+
+    def open(self, f):
+        gz = ThreadedGzipWriter(f, self)
+        self._files.add(gz)
+        return gz
+
+    def submit(self, data):
+        return self._executor.submit(gzip_compress, data, self.compresslevel)
+
+    def check_budget(self):
+        if self.buffered <= self.max_buffered:
+            return
+        largest = max(self._files, key=lambda gz: gz.buffer_size)
+        largest.submit()
+        while self.buffered > self.max_buffered:
+            largest = max(self._files, key=lambda gz: gz.pending_size)
+            if not largest.pending_size:
+                break
+            largest.write_pending(wait=True)
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class ThreadedGzipWriter(io.BufferedIOBase):
+    """Binary file writer compressing data on a CompressionPool.
+
+    Data is collected into chunks, and each chunk is compressed as a
+    separate gzip member. Concatenated gzip members form a valid gzip
+    file. Compressed chunks are written to the file in order.
+    """
+
+    def __init__(self, f, pool):
+        self._f = f
+        self._pool = pool
+        self._parts = []
+        self.buffer_size = 0
+        self.pending_size = 0
+        self._pending = collections.deque()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._parts.append(bytes(data))
+        self.buffer_size += len(data)
+        self._pool.buffered += len(data)
+        if self.buffer_size >= self._pool.chunk_size:
+            self.submit()
+            self.write_pending()
+        self._pool.check_budget()
+        return len(data)
+
+    def submit(self):
+        if self._parts:
+            data = b"".join(self._parts)
+            self._parts = []
+            self.buffer_size = 0
+            self.pending_size += len(data)
+            self._pending.append(
+                (self._pool.submit(data), len(data)))
+
+    def write_pending(self, wait=False):
+        # Without waiting, only chunks that are already compressed are
+        # written, so the main loop does not stall.
+        while self._pending and (wait or self._pending[0][0].done()):
+            future, size = self._pending.popleft()
+            self._f.write(future.result())
+            self.pending_size -= size
+            self._pool.buffered -= size
+
+    def flush(self):
+        # Partial chunks are kept until close, so that a flush does not
+        # block or produce tiny gzip members.
+        if not self.closed and not self._f.closed:
+            self.write_pending()
+            self._f.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.submit()
+            self.write_pending(wait=True)
+        finally:
+            self._pool._files.discard(self)
+            self._pool.buffered -= self.buffer_size + self.pending_size
+            try:
+                self._f.close()
+            finally:
+                super(ThreadedGzipWriter, self).close()
+
+
+def gzip_compress(data, compresslevel=6):
+    # Compressing with zlib directly releases the GIL for the whole
+    # chunk, and gives a gzip member with no file name or timestamp.
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return c.compress(data) + c.flush()
@@ -0,0 +1,55 @@
+import csv
+import os
+import re
+
+from .sample import Sample
+
+# Reads files written by bcl2fastq for reads not assigned to a sample,
+# such as Undetermined_S0_L001_R1_001.fastq.gz
+_LANE_FILE = re.compile(
+    r"^Undetermined_S\d+_L(\d+)_(I1|R1|R2)_\d+\.fastq(\.gz)?$")
+
+
+def find_lane_files(input_dir):
+    """Find the undetermined reads files of each lane in a directory.
+
+    Returns {lane: {"R1": fp, "R2": fp, "I1": fp}}, with lanes as
+    numbers. The index reads file may be missing, in which case the
+    barcodes are taken from the read headers.
+    """
+    lanes = {}
+    for fn in sorted(os.listdir(input_dir)):
+        m = _LANE_FILE.match(fn)
+        if m is None:
+            continue
+        lane, read = int(m.group(1)), m.group(2)
+        files = lanes.setdefault(lane, {})
+        if read in files:
+            raise ValueError(
+                "More than one %s file for lane %s: %s, %s" % (
+                    read, lane, os.path.basename(files[read]), fn))
+        files[read] = os.path.join(input_dir, fn)
+    for lane, files in sorted(lanes.items()):
+        for read in ["R1", "R2"]:
+            if read not in files:
+                raise ValueError("No %s file for lane %s" % (read, lane))
+    return lanes
+
+
+def load_sample_sheet(f):
+    """Read the samples of each lane from a sample sheet.
+
+    As for split_samplelanes.py, the lane is in the second column, the
+    sample name in the third and the barcode in the fifth. Spaces are
+    removed from names and "-" from barcodes. Other rows, such as the
+    header, are skipped. Returns {lane: [Sample, ...]}.
+    """
+    records = {}
+    for row in csv.reader(f):
+        if len(row) < 5 or not row[1].strip().isdigit():
+            continue
+        records.setdefault(int(row[1]), []).append(
+            (row[2].replace(" ", ""), row[4].replace("-", "")))
+    return dict(
+        (lane, Sample.from_records(lane_records))
+        for lane, lane_records in records.items())
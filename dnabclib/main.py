@@ -1,17 +1,39 @@
 import argparse
+import collections
+import contextlib
+import cProfile
 import json
 import os
+import resource
+import time
 
-from .writer import FastaWriter, PairedFastqWriter
+from .compression import default_threads
+from .writer import (
+    FastaWriter, PairedFastqWriter, InterleavedFastqWriter,
+    default_max_open_files,
+    )
 from .sample import Sample
 from .seqfile import IndexFastqSequenceFile
 from .seqfile import NoIndexFastqSequenceFile
-from .assigner import BarcodeAssigner
+from .assigner import make_assigner
+from .parallel import (
+    demultiplex_parallel, demultiplex_jobs_parallel, DemultiplexJob,
+    DEFAULT_CHUNK_READS,
+    )
+from .lanes import find_lane_files, load_sample_sheet
+from .census import count_barcodes
+from .checkpoint import (
+    Checkpointer, demultiplex_checkpointed, CHECKPOINT_FILENAME,
+    DEFAULT_CHECKPOINT_READS,
+    )
+from .qc import ReadQC
+from .timing import StageTimer, peak_rss_bytes
 from .version import __version__
 
 writers = {
     "fastq": PairedFastqWriter,
     "fasta": FastaWriter,
+    "interleaved_fastq": InterleavedFastqWriter,
 }
 
 
@@ -35,7 +57,63 @@ def get_sample_names_main(argv=None):
 
 def get_config(user_config_file):
     config = {
-        "output_format": "fastq"
+        # "fastq" for R1 and R2 files per sample, "interleaved_fastq"
+        # for one file per sample holding each pair in turn, or "fasta"
+        "output_format": "fastq",
+        # Threads used to decompress each gzip input file (None: auto)
+        "decompress_threads": None,
+        # Read uncompressed input files through a memory map
+        "mmap_input": False,
+        # Parse each input file on a thread of its own. Only used
+        # without worker processes or checkpoints.
+        "reader_threads": False,
+        # Per-sample output compression: None or "gzip"
+        "output_compression": None,
+        "compression_level": 6,
+        # Threads used to compress output files (None: auto)
+        "compress_threads": None,
+        # Memory for per-sample output buffers, shared by all samples
+        "write_buffer_mb": 64,
+        # Memory for output waiting to be compressed, on top of
+        # write_buffer_mb. Only used with output_compression.
+        "compress_buffer_mb": 256,
+        # Output files kept open at once (None: based on ulimit -n)
+        "max_open_files": None,
+        # Split the output of each sample into numbered chunks of this
+        # many reads or megabytes of uncompressed output (None: no
+        # limit). The chunks are listed in the summary.
+        "output_chunk_reads": None,
+        "output_chunk_mb": None,
+        # Write this fraction of the unassigned reads, picked by a hash
+        # of the read ID, to an "unassigned" output, keeping at most
+        # unassigned_max_reads of them. Neither set: no unassigned
+        # output. Only a limit set: all reads up to the limit.
+        "unassigned_fraction": None,
+        "unassigned_max_reads": None,
+        # Mismatches allowed between the read and sample barcodes. For
+        # dual-index barcodes, a list gives the mismatches for i7 and i5.
+        "mismatches": 0,
+        # Directory where barcode tables are saved once built, to be
+        # loaded by later runs with the same samples and mismatches
+        # (None: no cache). Needs numpy.
+        "barcode_cache_dir": None,
+        # Most frequent unassigned barcodes reported in the summary
+        "top_unassigned": 20,
+        # Reads with an index base below this Phred score are counted
+        # as unassigned (None: no check). Only used with an index
+        # reads file, as barcodes in read headers have no quality.
+        "min_index_quality": None,
+        # Index bases checked against min_index_quality: "bases" for
+        # all of them, "mismatches" for those differing from the sample
+        "index_quality_check": "bases",
+        # Per-sample read length, quality, GC and N statistics
+        "qc_stats": False,
+        # Longest read length kept apart in the QC statistics
+        "qc_max_length": 500,
+        # Reads between checkpoints saved in the output directory, for
+        # resuming an interrupted run with --resume (None: no
+        # checkpoints unless resuming)
+        "checkpoint_reads": None,
     }
 
     if user_config_file is None:
@@ -54,16 +132,21 @@ def main(argv=None):
     # Input
     p.add_argument(
         "--forward-reads", required=True,
-        type=argparse.FileType("r"),
-        help="Forward reads file (FASTQ format)")
+        type=argparse.FileType("rb"),
+        help=(
+            "Forward reads file (FASTQ format, optionally gzip or BGZF "
+            "compressed)"))
     p.add_argument(
         "--reverse-reads", required=True,
-        type=argparse.FileType("r"),
-        help="Reverse reads file (FASTQ format)")
+        type=argparse.FileType("rb"),
+        help=(
+            "Reverse reads file (FASTQ format, optionally gzip or BGZF "
+            "compressed)"))
     p.add_argument(
         "--index-reads",
-        type=argparse.FileType("r"), help=(
-            "Index reads file (FASTQ format). If this file is not provided, "
+        type=argparse.FileType("rb"), help=(
+            "Index reads file (FASTQ format, optionally gzip or BGZF "
+            "compressed). If this file is not provided, "
             "the index reads will be taken from the description lines in the "
             "forward reads file."))
     p.add_argument(
@@ -78,6 +161,20 @@ def main(argv=None):
         "--summary-file", required=True,
         type=argparse.FileType("w"),
         help="Summary filepath")
+    # Performance
+    p.add_argument(
+        "--workers", type=int, default=1,
+        help=(
+            "Number of worker processes for parsing and barcode assignment "
+            "(default: %(default)s, no worker processes)"))
+    p.add_argument(
+        "--resume", action="store_true",
+        help=(
+            "Continue an interrupted run from its last checkpoint, or "
+            "start from the beginning if there is none"))
+    p.add_argument(
+        "--profile",
+        help="Write cProfile statistics for the run to this file")
     # Config
     p.add_argument("--config-file",
         type=argparse.FileType("r"),
@@ -88,30 +185,381 @@ def main(argv=None):
 
     samples = list(Sample.load(args.barcode_file))
 
-    writer_cls = writers[config["output_format"]]
     if not os.path.exists(args.output_dir):
        #p.error("Output directory already exists")
        os.mkdir(args.output_dir)
-    writer = writer_cls(args.output_dir)
+    writer = make_writer(config, args.output_dir)
+    seq_file, assigner = make_seq_file(
+        config, samples, args.forward_reads, args.reverse_reads,
+        args.index_reads)
+    qc = make_qc(config, samples)
+
+    timer = StageTimer()
+    checkpoint = None
+    checkpoint_reads = config["checkpoint_reads"]
+    if args.resume and checkpoint_reads is None:
+        checkpoint_reads = DEFAULT_CHECKPOINT_READS
+    if checkpoint_reads is not None and writer.chunked:
+        p.error("Checkpoints are not supported with chunked output")
+    if checkpoint_reads is not None:
+        checkpoint = Checkpointer(
+            os.path.join(args.output_dir, CHECKPOINT_FILENAME),
+            assigner, writer, qc=qc, every_reads=checkpoint_reads,
+            inputs=[getattr(f, "name", None) for f in seq_file.input_files()],
+            timer=timer)
+        if args.resume:
+            checkpoint.resume()
+    chunk_reads = DEFAULT_CHUNK_READS
+    if checkpoint is not None:
+        # Checkpoints are only taken between chunks
+        chunk_reads = min(chunk_reads, checkpoint.every_reads)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if args.workers > 1:
+            summary_data = demultiplex_parallel(
+                seq_file, assigner, writer, args.workers, chunk_reads,
+                timer=timer, qc=qc, checkpoint=checkpoint)
+        elif checkpoint is not None:
+            summary_data = demultiplex_checkpointed(
+                seq_file, assigner, writer, checkpoint, timer=timer, qc=qc)
+        else:
+            summary_data = seq_file.demultiplex(assigner, writer, timer, qc)
+    finally:
+        try:
+            with timer.stage("close"):
+                writer.close()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+    reads = sum(summary_data.values())
+    if checkpoint is not None:
+        # Reads done before resuming took no time in this run
+        reads -= checkpoint.resumed_reads
+    stats = {
+        "assigner": assigner.get_stats(),
+        "writer": writer.get_stats(),
+        "run": run_stats(
+            timer, start_wall, start_cpu, reads, seq_file.input_files()),
+        }
+    if qc is not None:
+        stats["qc"] = qc.get_stats()
+    if checkpoint is not None:
+        stats["checkpoint"] = checkpoint.get_stats()
+    manifest = writer.get_manifest() if writer.chunked else None
+    save_summary(args.summary_file, config, summary_data, stats, manifest)
+    if checkpoint is not None:
+        checkpoint.finish()
+
+
+def lanes_main(argv=None):
+    p = argparse.ArgumentParser(
+        description="Demultiplex all lanes of a run in one go")
+    # Input
+    p.add_argument(
+        "--sample-sheet", required=True,
+        type=argparse.FileType("r"),
+        help="Sample sheet with the samples of every lane")
+    p.add_argument(
+        "--input-dir", required=True,
+        help="Directory of Undetermined_*_L00N_* reads files")
+    p.add_argument(
+        "--lanes", type=int, nargs="+",
+        help=(
+            "Lanes to demultiplex (default: all lanes with samples and "
+            "reads files)"))
+    # Output
+    p.add_argument(
+        "--output-dir", required=True,
+        help=(
+            "Output sequence data directory, with a subdirectory per lane "
+            "unless lanes are merged"))
+    p.add_argument(
+        "--merge-lanes", action="store_true",
+        help="Write the reads of each sample from all lanes to one output")
+    p.add_argument(
+        "--summary-file", required=True,
+        type=argparse.FileType("w"),
+        help="Summary filepath, with counts for all lanes and for each lane")
+    # Performance
+    p.add_argument(
+        "--workers", type=int, default=1,
+        help=(
+            "Number of worker processes, shared by all lanes "
+            "(default: %(default)s, no worker processes)"))
+    # Config
+    p.add_argument("--config-file",
+        type=argparse.FileType("r"),
+        help="Configuration file (JSON format)")
+    args = p.parse_args(argv)
+
+    config = get_config(args.config_file)
+
+    lane_samples = load_sample_sheet(args.sample_sheet)
+    lane_files = find_lane_files(args.input_dir)
+    lanes = args.lanes or sorted(set(lane_samples) & set(lane_files))
+    if not lanes:
+        p.error("No lane has both samples and reads files")
+    for lane in lanes:
+        if lane not in lane_samples:
+            p.error("No samples for lane %s in the sample sheet" % lane)
+        if lane not in lane_files:
+            p.error("No reads files for lane %s" % lane)
+
+    if not os.path.exists(args.output_dir):
+        os.mkdir(args.output_dir)
+    # The memory, file and thread budgets of the config are shared by
+    # all writers
+    merged_writer = None
+    if args.merge_lanes:
+        merged_writer = make_writer(config, args.output_dir)
+    jobs = []
+    with contextlib.ExitStack() as stack:
+        for lane in lanes:
+            writer = merged_writer
+            if writer is None:
+                lane_dir = os.path.join(args.output_dir, "L%03d" % lane)
+                if not os.path.exists(lane_dir):
+                    os.mkdir(lane_dir)
+                writer = make_writer(config, lane_dir, share=len(lanes))
+            fps = lane_files[lane]
+            fwd, rev, idx = [
+                stack.enter_context(open(fps[read], "rb"))
+                if read in fps else None
+                for read in ["R1", "R2", "I1"]]
+            samples = lane_samples[lane]
+            seq_file, assigner = make_seq_file(config, samples, fwd, rev, idx)
+            jobs.append(DemultiplexJob(
+                seq_file, assigner, writer, make_qc(config, samples)))
+
+        timer = StageTimer()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        writers_used = list(collections.OrderedDict(
+            (id(job.writer), job.writer) for job in jobs).values())
+        try:
+            if args.workers > 1:
+                demultiplex_jobs_parallel(jobs, args.workers, timer=timer)
+            else:
+                for job in jobs:
+                    job.seq_file.demultiplex(
+                        job.assigner, job.writer, timer, job.qc)
+        finally:
+            with timer.stage("close"):
+                _close_writers(writers_used)
+
+        summary_data = collections.Counter()
+        lane_stats = {}
+        for lane, job in zip(lanes, jobs):
+            summary_data.update(job.assigner.read_counts)
+            lane_stats[str(lane)] = {
+                "data": job.assigner.read_counts,
+                "assigner": job.assigner.get_stats(),
+                }
+            if job.qc is not None:
+                lane_stats[str(lane)]["qc"] = job.qc.get_stats()
+            if merged_writer is None:
+                lane_stats[str(lane)]["writer"] = job.writer.get_stats()
+        input_files = [
+            f for job in jobs for f in job.seq_file.input_files()]
+        stats = {
+            "lanes": lane_stats,
+            "run": run_stats(
+                timer, start_wall, start_cpu, sum(summary_data.values()),
+                input_files),
+            }
+    if merged_writer is not None:
+        stats["writer"] = merged_writer.get_stats()
+    manifest = None
+    if writers_used[0].chunked:
+        manifest = collections.OrderedDict()
+        for writer in writers_used:
+            for name, chunks in writer.get_manifest().items():
+                manifest.setdefault(name, []).extend(chunks)
+    save_summary(
+        args.summary_file, config, dict(summary_data), stats, manifest)
 
-    if args.index_reads is None:
+
+def census_main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Count the reads of each sample from the barcodes alone, "
+            "without writing any reads"))
+    # Input
+    reads = p.add_mutually_exclusive_group(required=True)
+    reads.add_argument(
+        "--index-reads",
+        type=argparse.FileType("rb"),
+        help=(
+            "Index reads file (FASTQ format, optionally gzip or BGZF "
+            "compressed)"))
+    reads.add_argument(
+        "--forward-reads",
+        type=argparse.FileType("rb"),
+        help=(
+            "Forward reads file with barcodes in the read headers, used "
+            "when there is no index reads file"))
+    p.add_argument(
+        "--barcode-file", required=True,
+        help="Barcode information file",
+        type=argparse.FileType("r"))
+    p.add_argument(
+        "--max-reads", type=int,
+        help=(
+            "Stop after this many reads, and project the counts for the "
+            "whole file (default: count all reads)"))
+    # Output
+    p.add_argument(
+        "--summary-file", required=True,
+        type=argparse.FileType("w"),
+        help="Summary filepath")
+    # Config
+    p.add_argument("--config-file",
+        type=argparse.FileType("r"),
+        help="Configuration file (JSON format)")
+    args = p.parse_args(argv)
+
+    config = get_config(args.config_file)
+    samples = list(Sample.load(args.barcode_file))
+    # Quality lines are skipped, so min_index_quality is not applied
+    seq_file, assigner = make_seq_file(
+        config, samples, args.forward_reads, None, args.index_reads)
+
+    timer = StageTimer()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    census = count_barcodes(seq_file, assigner, args.max_reads, timer)
+    stats = {
+        "assigner": assigner.get_stats(),
+        "census": census,
+        "run": run_stats(
+            timer, start_wall, start_cpu, census["reads"],
+            [seq_file.barcode_file()]),
+        }
+    save_summary(args.summary_file, config, assigner.read_counts, stats)
+
+
+def _close_writers(writers):
+    # Every writer is closed even if closing one of them fails
+    error = None
+    for writer in writers:
+        try:
+            writer.close()
+        except Exception as e:
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+
+
+def make_writer(config, output_dir, share=1):
+    """Make the writer given by the config.
+
+    When several writers run at once, each gets 1/share of the buffer
+    and compression memory, open files and compression threads in the
+    config.
+    """
+    writer_cls = writers[config["output_format"]]
+    max_open_files = config["max_open_files"] or default_max_open_files()
+    threads = config["compress_threads"] or default_threads()
+    chunk_bytes = None
+    if config["output_chunk_mb"] is not None:
+        chunk_bytes = int(config["output_chunk_mb"] * (1 << 20))
+    unassigned_fraction = config["unassigned_fraction"]
+    if unassigned_fraction is None and (
+            config["unassigned_max_reads"] is not None):
+        unassigned_fraction = 1.0
+    return writer_cls(
+        output_dir,
+        compression=config["output_compression"],
+        compresslevel=config["compression_level"],
+        threads=max(1, threads // share),
+        max_buffered=int(config["write_buffer_mb"] * (1 << 20) / share),
+        max_open_files=max(1, max_open_files // share),
+        chunk_reads=config["output_chunk_reads"],
+        chunk_bytes=chunk_bytes,
+        unassigned_fraction=unassigned_fraction,
+        unassigned_max_reads=config["unassigned_max_reads"],
+        compress_buffered=int(
+            config["compress_buffer_mb"] * (1 << 20) / share))
+
+
+def make_seq_file(config, samples, fwd, rev, idx=None):
+    """Make the sequence file and assigner for a set of input files.
+
+    Without an index reads file, barcodes are read from the headers of
+    the forward reads.
+    """
+    if idx is None:
         seq_file = NoIndexFastqSequenceFile(
-            args.forward_reads, args.reverse_reads)
-        assigner = BarcodeAssigner(samples, revcomp=False)
+            fwd, rev,
+            threads=config["decompress_threads"],
+            use_mmap=config["mmap_input"],
+            reader_threads=config["reader_threads"])
+        assigner = make_assigner(
+            samples, mismatches=config["mismatches"], revcomp=False,
+            top_unassigned=config["top_unassigned"],
+            cache_dir=config["barcode_cache_dir"])
     else:
         seq_file = IndexFastqSequenceFile(
-            args.forward_reads, args.reverse_reads, args.index_reads)
-        assigner = BarcodeAssigner(samples, revcomp=True)
+            fwd, rev, idx,
+            threads=config["decompress_threads"],
+            use_mmap=config["mmap_input"],
+            reader_threads=config["reader_threads"])
+        assigner = make_assigner(
+            samples, mismatches=config["mismatches"], revcomp=True,
+            top_unassigned=config["top_unassigned"],
+            min_quality=config["min_index_quality"],
+            quality_check=config["index_quality_check"],
+            cache_dir=config["barcode_cache_dir"])
+    return seq_file, assigner
+
+
+def make_qc(config, samples):
+    if not config["qc_stats"]:
+        return None
+    return ReadQC(samples, max_length=config["qc_max_length"])
+
+
+def run_stats(timer, start_wall, start_cpu, reads, files):
+    wall = time.perf_counter() - start_wall
+    return {
+        "wall_seconds": wall,
+        "cpu_seconds": time.process_time() - start_cpu,
+        "reads": reads,
+        "reads_per_second": reads / wall if wall else 0.0,
+        "bytes_read": _bytes_read(files),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "peak_worker_rss_bytes": peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        "stages": timer.get_stats(),
+        }
+
 
-    summary_data = seq_file.demultiplex(assigner, writer)
-    save_summary(args.summary_file, config, summary_data)
+def _bytes_read(files):
+    # Position of each input file after the run, or None if it can't
+    # be found, as for a pipe.
+    try:
+        return sum(f.tell() for f in files)
+    except (OSError, ValueError):
+        return None
 
 
-def save_summary(f, config, data):
+def save_summary(f, config, data, stats=None, manifest=None):
     result = {
         "program": "dnabc",
         "version": __version__,
         "config": config,
         "data": data,
         }
+    # Run statistics are kept out of "data", which holds only the read
+    # counts per sample.
+    if stats is not None:
+        result["stats"] = stats
+    # Output chunks of each sample, for jobs that process them
+    if manifest is not None:
+        result["manifest"] = manifest
     json.dump(result, f)
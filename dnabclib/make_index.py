@@ -0,0 +1,122 @@
+"""Create an index reads file from barcodes in the read headers.
+
+Illumina software can write the index read at the end of each header
+line, for example "@M03543:47:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGTAC".
+The reverse complement of that barcode is written as the sequence of
+an index read with the same header, so the run can be demultiplexed
+with an index reads file.
+
+Only the header lines are kept when parsing, and the records of a
+whole block are formatted and written at once. Headers from one run
+hold a few hundred distinct barcodes, so each index record tail is
+built once and looked up afterwards. Reads with errors in the barcode
+add many more, so only the first MAX_CACHED_BARCODES are kept.
+"""
+import argparse
+import itertools
+import operator
+
+from .compression import CompressionPool
+from .seqfile import (
+    DEFAULT_BLOCK_SIZE, _open_blocks, _parse_blocks, _raise_bad_record,
+    )
+
+# Quality character given to every index base
+INDEX_QUALITY = "E"
+
+# Distinct barcodes whose index record tails are kept for reuse
+MAX_CACHED_BARCODES = 100000
+
+# Spaces are dropped from the barcode
+_COMPLEMENT = str.maketrans("ACGTN", "TGCAN", " ")
+
+_BARCODE_BASES = frozenset("ACGTN ")
+
+
+def reverse_complement(seq):
+    if not _BARCODE_BASES.issuperset(seq):
+        raise ValueError("Unexpected character in barcode: %s" % seq)
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+class _IndexRecordTails(dict):
+    """Maps a barcode to the rest of its index record after the header."""
+    __slots__ = ()
+
+    def __missing__(self, barcode):
+        rc = reverse_complement(barcode)
+        tail = "\n%s\n+\n%s\n" % (rc, INDEX_QUALITY * len(rc))
+        if len(self) < MAX_CACHED_BARCODES:
+            self[barcode] = tail
+        return tail
+
+
+def _header_batch(lines, n):
+    descs = lines[0:n:4]
+    seps = lines[2:n:4]
+    if not all(map(str.startswith, descs, itertools.repeat("@"))):
+        _raise_bad_record(descs, lines[1:n:4], seps, lines[3:n:4])
+    if not all(map(str.startswith, seps, itertools.repeat("+"))):
+        _raise_bad_record(descs, lines[1:n:4], seps, lines[3:n:4])
+    return list(map(str.rstrip, descs))
+
+
+def _header_barcode(desc):
+    return desc.rsplit(":", 1)[-1]
+
+
+def index_blocks(f, block_size=DEFAULT_BLOCK_SIZE, threads=None,
+                 tails=None):
+    """Yield the index records for a FASTQ file, one text per block."""
+    if tails is None:
+        tails = _IndexRecordTails()
+    blocks = _open_blocks(f, block_size, threads, False)
+    for descs in _parse_blocks(blocks, _header_batch):
+        barcodes = map(_header_barcode, descs)
+        yield "".join(map(
+            operator.add, descs, map(tails.__getitem__, barcodes)))
+
+
+def write_index(reads, out, threads=None):
+    """Write index records for the reads to a binary file.
+
+    Returns the number of distinct barcodes seen, counting at most
+    MAX_CACHED_BARCODES.
+    """
+    tails = _IndexRecordTails()
+    for text in index_blocks(reads, threads=threads, tails=tails):
+        out.write(text.encode("utf-8"))
+    return len(tails)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description="Create an index reads file for demultiplexing")
+    p.add_argument(
+        "--reads", required=True,
+        type=argparse.FileType("rb"),
+        help=(
+            "Reads file with barcodes in the headers (FASTQ format, "
+            "optionally gzip or BGZF compressed)"))
+    p.add_argument(
+        "--output", required=True,
+        help="Index reads file, gzip compressed if the name ends in .gz")
+    p.add_argument(
+        "--threads", type=int,
+        help="Threads for decompression and compression (default: auto)")
+    args = p.parse_args(argv)
+
+    pool = None
+    out = open(args.output, "wb")
+    if args.output.endswith(".gz"):
+        pool = CompressionPool(args.threads)
+        out = pool.open(out)
+    try:
+        write_index(args.reads, out, args.threads)
+    finally:
+        try:
+            out.close()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            args.reads.close()
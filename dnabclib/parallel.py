@@ -0,0 +1,161 @@
+import collections
+import concurrent.futures
+import io
+
+from .seqfile import read_record_chunks, use_passthrough
+from .timing import StageTimer
+from .writer import UNASSIGNED_SAMPLE
+
+# Reads sent to a worker process at a time
+DEFAULT_CHUNK_READS = 50000
+
+# Worker process state, set once by _init_worker
+_worker = {}
+
+
+class DemultiplexJob(collections.namedtuple(
+        "DemultiplexJob", "seq_file assigner writer qc checkpoint")):
+    """One set of input files to demultiplex, such as one lane of a run.
+
+    Jobs run together on a pool may share a writer.
+    """
+    __slots__ = ()
+
+    def __new__(cls, seq_file, assigner, writer, qc=None, checkpoint=None):
+        return super(DemultiplexJob, cls).__new__(
+            cls, seq_file, assigner, writer, qc, checkpoint)
+
+
+def demultiplex_parallel(seq_file, assigner, writer, workers,
+                         chunk_reads=DEFAULT_CHUNK_READS, timer=None,
+                         qc=None, checkpoint=None):
+    """Demultiplex using a pool of worker processes.
+
+    The main process cuts the input files into chunks of the same
+    records. Workers parse each chunk, assign reads to samples and
+    format the output. The main process writes the formatted output
+    and adds up the read counts. Results are handled in the order the
+    chunks were read, so reads keep their order in every sample file.
+
+    Stage times from the workers are added to the timer, next to the
+    "read" and "merge" stages of the main process.
+
+    With a Checkpointer, reading starts from its saved positions, and
+    it is told about each chunk once the chunk's output is merged.
+    """
+    job = DemultiplexJob(seq_file, assigner, writer, qc, checkpoint)
+    demultiplex_jobs_parallel([job], workers, chunk_reads, timer)
+    return assigner.read_counts
+
+
+def demultiplex_jobs_parallel(jobs, workers, chunk_reads=DEFAULT_CHUNK_READS,
+                              timer=None):
+    """Demultiplex several jobs at once on one pool of worker processes.
+
+    Chunks are taken from each job in turn, so all jobs move forward
+    together and share the workers, as in demultiplex_parallel.
+    """
+    timer = timer or StageTimer()
+    samples = [
+        dict(((s.name, s) for s in job.assigner.samples),
+             unassigned=UNASSIGNED_SAMPLE)
+        for job in jobs]
+    readers = [
+        timer.iterate("read", read_record_chunks(
+            job.seq_file.input_files(), chunk_reads,
+            threads=job.seq_file.threads,
+            offsets=(
+                job.checkpoint.offsets if job.checkpoint is not None
+                else None)),
+            chunk_reads_count)
+        for job in jobs]
+    init_args = [
+        (type(job.seq_file), job.assigner, type(job.writer),
+         job.writer.output_dir, job.writer.unassigned_fraction, job.qc)
+        for job in jobs]
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(init_args,)) as pool:
+        # Only a few chunks per worker are read ahead, to bound memory
+        pending = collections.deque()
+        for i, chunk in _round_robin(readers):
+            checkpoint = jobs[i].checkpoint
+            progress = (
+                checkpoint.progress(chunk) if checkpoint is not None
+                else None)
+            pending.append(
+                (i, pool.submit(_demultiplex_chunk, i, chunk), progress))
+            if len(pending) >= 2 * workers:
+                _merge_result(pending.popleft(), jobs, samples, timer)
+        while pending:
+            _merge_result(pending.popleft(), jobs, samples, timer)
+
+
+def _round_robin(iterables):
+    # Yield (index, item) taking one item from each iterable in turn,
+    # until all of them are used up
+    iterators = [iter(iterable) for iterable in iterables]
+    active = list(range(len(iterators)))
+    done = object()
+    while active:
+        for i in list(active):
+            item = next(iterators[i], done)
+            if item is done:
+                active.remove(i)
+            else:
+                yield i, item
+
+
+def _merge_result(item, jobs, samples, timer):
+    i, future, progress = item
+    job = jobs[i]
+    counts, output, stages, qc_counts = future.result()
+    timer.merge(*stages)
+    with timer.stage("merge", sum(counts["read_counts"].values())):
+        job.assigner.merge_counts(counts)
+        if job.qc is not None:
+            job.qc.merge_counts(qc_counts)
+        for name, texts in output.items():
+            job.writer.write_buffered(samples[i][name], texts)
+    if job.checkpoint is not None:
+        job.checkpoint.advance(*progress)
+
+
+def _init_worker(jobs):
+    # Never writes to disk: the buffered output is sent back instead.
+    # Unassigned reads are sampled here, but any limit on their number
+    # is applied by the main writer.
+    _worker["jobs"] = [
+        (seq_file_cls, assigner, writer_cls(
+            output_dir, max_buffered=float("inf"),
+            unassigned_fraction=unassigned_fraction), qc)
+        for seq_file_cls, assigner, writer_cls, output_dir,
+        unassigned_fraction, qc in jobs]
+
+
+def _demultiplex_chunk(i, chunk):
+    seq_file_cls, assigner, writer, qc = _worker["jobs"][i]
+    assigner.reset_counts()
+    if qc is not None:
+        qc.reset_counts()
+    timer = StageTimer()
+    passthrough = use_passthrough(writer, qc)
+    batches = seq_file_cls.parse_batches(
+        [_as_file(text) for text in chunk], passthrough)
+    seq_file_cls.demultiplex_reads(
+        assigner, writer, batches, timer, qc, passthrough)
+    output = writer.take_buffered()
+    qc_counts = qc.get_counts() if qc is not None else None
+    stages = timer.stages, timer.reads
+    return assigner.get_counts(), output, stages, qc_counts
+
+
+def chunk_reads_count(chunk):
+    """Number of reads in a chunk from read_record_chunks."""
+    newline = b"\n" if isinstance(chunk[0], bytes) else "\n"
+    return chunk[0].count(newline) // 4
+
+
+def _as_file(text):
+    if isinstance(text, bytes):
+        return io.BytesIO(text)
+    return io.StringIO(text)
@@ -0,0 +1,146 @@
+import itertools
+import operator
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+_get_seq = operator.attrgetter("seq")
+_get_qual = operator.attrgetter("qual")
+
+
+def _as_rows(strs, width, fill):
+    # Each non-ASCII character is replaced by a single "?", so there is
+    # one byte for each character.
+    data = "".join(map(str.ljust, strs, itertools.repeat(width),
+                       itertools.repeat(fill)))
+    return np.frombuffer(
+        data.encode("ascii", "replace"), dtype=np.uint8).reshape(
+            len(strs), width)
+
+
+class ReadQC(object):
+    """Per-sample read statistics, collected a batch at a time.
+
+    For each sample and each read in a pair, keeps a read length
+    histogram, the total quality at each cycle, and the number of G, C
+    and N bases. All counts are held in arrays of a fixed size, so the
+    memory used does not depend on the number of reads. Reads longer
+    than max_length are counted in the last bin of the histogram, and
+    their later cycles are not counted.
+    """
+    def __init__(self, samples, mates=2, max_length=500, quality_offset=33):
+        if np is None:
+            raise ValueError("Read QC statistics need numpy")
+        self.samples = samples
+        self.mates = mates
+        self.max_length = max_length
+        self.quality_offset = quality_offset
+        self._index = dict((s, n) for n, s in enumerate(samples))
+        # Unassigned reads are counted after the samples
+        self._index[None] = len(samples)
+        self.reset_counts()
+
+    def reset_counts(self):
+        shape = (self.mates, len(self.samples) + 1, self.max_length + 1)
+        self.lengths = np.zeros(shape, dtype=np.int64)
+        self.cycle_quality = np.zeros(shape, dtype=np.int64)
+        self.cycle_reads = np.zeros(shape, dtype=np.int64)
+        self.bases = np.zeros(shape[:2] + (3,), dtype=np.int64)
+
+    def add_batch(self, samples, *mates):
+        """Add reads, given the sample of each read and each mate."""
+        n_groups = len(self.samples) + 1
+        groups = np.fromiter(
+            map(self._index.__getitem__, samples), dtype=np.int64,
+            count=len(samples))
+        if not len(groups):
+            return
+        # Reads are sorted by group, so that the rows for each group
+        # can be summed in one pass.
+        order = np.argsort(groups, kind="stable")
+        starts = np.flatnonzero(np.diff(groups[order], prepend=-1))
+        present = groups[order][starts]
+        for mate, reads in enumerate(mates):
+            seqs = list(map(_get_seq, reads))
+            lengths = np.fromiter(
+                map(len, seqs), dtype=np.int64, count=len(seqs))
+            hist = np.bincount(
+                groups * (self.max_length + 1) +
+                np.minimum(lengths, self.max_length),
+                minlength=n_groups * (self.max_length + 1)).reshape(
+                    n_groups, self.max_length + 1)
+            self.lengths[mate] += hist
+            # Reads reaching each cycle: those longer than the cycle
+            self.cycle_reads[mate, :, :-1] += np.cumsum(
+                hist[:, :0:-1], axis=1)[:, ::-1]
+
+            # Shorter reads are padded, with qualities that add zero
+            width = int(lengths.max())
+            seq = _as_rows(seqs, width, " ")
+            qual = _as_rows(
+                list(map(_get_qual, reads)), width,
+                chr(self.quality_offset))
+
+            upper = seq & 0xDF
+            gc = (upper == ord("G")) | (upper == ord("C"))
+            n = upper == ord("N")
+            self.bases[mate, :, 0] += np.bincount(
+                groups, weights=lengths, minlength=n_groups).astype(np.int64)
+            self.bases[mate, :, 1] += np.bincount(
+                groups, weights=gc.sum(axis=1, dtype=np.int32),
+                minlength=n_groups).astype(np.int64)
+            self.bases[mate, :, 2] += np.bincount(
+                groups, weights=n.sum(axis=1, dtype=np.int32),
+                minlength=n_groups).astype(np.int64)
+
+            cycles = min(width, self.max_length)
+            quality = np.add.reduceat(
+                qual[order, :cycles], starts, axis=0, dtype=np.int32)
+            rows = np.diff(np.append(starts, len(groups)))
+            self.cycle_quality[mate, present, :cycles] += (
+                quality - self.quality_offset * rows[:, None])
+
+    def get_counts(self):
+        """Counts collected since the last reset, for merge_counts."""
+        return {
+            "lengths": self.lengths,
+            "cycle_quality": self.cycle_quality,
+            "cycle_reads": self.cycle_reads,
+            "bases": self.bases,
+            }
+
+    def merge_counts(self, counts):
+        self.lengths += counts["lengths"]
+        self.cycle_quality += counts["cycle_quality"]
+        self.cycle_reads += counts["cycle_reads"]
+        self.bases += counts["bases"]
+
+    def get_stats(self):
+        names = [s.name for s in self.samples] + ["unassigned"]
+        stats = {}
+        for group, name in enumerate(names):
+            # Mates are named as in the output files
+            stats[name] = dict(
+                ("R%d" % (mate + 1), self._mate_stats(mate, group))
+                for mate in range(self.mates))
+        return stats
+
+    def _mate_stats(self, mate, group):
+        lengths = self.lengths[mate, group]
+        cycle_reads = self.cycle_reads[mate, group]
+        n_cycles = len(np.trim_zeros(cycle_reads, "b"))
+        mean_quality = (
+            self.cycle_quality[mate, group, :n_cycles] /
+            np.maximum(cycle_reads[:n_cycles], 1))
+        bases, gc, n = self.bases[mate, group].tolist()
+        return {
+            "reads": int(lengths.sum()),
+            "length_histogram": dict(
+                (str(length), count)
+                for length, count in enumerate(lengths.tolist()) if count),
+            "mean_quality": [round(q, 2) for q in mean_quality.tolist()],
+            "gc_fraction": float(gc) / bases if bases else 0.0,
+            "n_fraction": float(n) / bases if bases else 0.0,
+            }
@@ -1,21 +1,39 @@
+import re
+
+
 class Sample(object):
-    """Class representing one demultiplexable unit."""
+    """Class representing one demultiplexable unit.
+
+    Dual-index barcodes are written as i7 and i5 joined by "-" or "+".
+    They are kept apart in the barcodes attribute; the barcode
+    attribute holds the two indices joined together.
+    """
     def __init__(self, name, barcode):
         self.name = name
         self.barcode = barcode
+        self.barcodes = None
         if self.barcode is not None:
             self.barcode = self.barcode.upper()
+            self.barcodes = tuple(re.split("[-+]", self.barcode))
+            self.barcode = "".join(self.barcodes)
 
     @classmethod
     def load(cls, f):
-        records = list(parse_barcode_file(f))
+        return cls.from_records(parse_barcode_file(f))
+
+    @classmethod
+    def from_records(cls, records):
+        """Make samples from (name, barcode) pairs, checking for duplicates.
+        """
+        records = list(records)
         names, bcs = zip(*records)
 
         dup_names = duplicates(names)
         if dup_names:
             raise ValueError("Duplicate sample names: %s" % dup_names)
 
-        dup_bcs = duplicates(bcs)
+        # Dual-index barcodes are compared without the separator
+        dup_bcs = duplicates(re.sub("[-+]", "", bc.upper()) for bc in bcs)
         if dup_bcs:
             raise ValueError("Duplicate barcodes: %s" % dup_bcs)
 
@@ -1,4 +1,24 @@
+import collections
+import functools
+import io
 import itertools
+import mmap
+import operator
+import os
+import stat
+import time
+
+from .compression import GZIP_MAGIC, iter_in_thread, open_input
+from .timing import StageTimer
+
+# Bytes requested from the input file per read call. Large blocks keep
+# the number of read calls and Python-level loop iterations small.
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+# Parsed batches each reader thread may hold before it waits for the
+# main thread to catch up
+READ_AHEAD_BATCHES = 4
+
 
 class IndexFastqSequenceFile(object):
     """Illumina data, 3 file format: forward, reverse, index.
@@ -6,20 +26,76 @@ class IndexFastqSequenceFile(object):
     This format is used by the MiSeq but not supported by newer HiSeq
     machines.
     """
-    def __init__(self, fwd, rev, idx):
+    # Names of the input files, in the order of input_files
+    input_labels = ("I1", "R1", "R2")
+
+    def __init__(self, fwd, rev, idx, threads=None, use_mmap=False,
+                 reader_threads=False):
         self.forward_file = fwd
         self.reverse_file = rev
         self.index_file = idx
+        self.threads = threads
+        self.use_mmap = use_mmap
+        self.reader_threads = reader_threads
+
+    def input_files(self):
+        return [self.index_file, self.forward_file, self.reverse_file]
+
+    def barcode_file(self):
+        """The input file that barcode_batches reads."""
+        return self.index_file
 
-    def demultiplex(self, assigner, writer):
-        idxs = (FastqRead(x) for x in parse_fastq(self.index_file))
-        fwds = (FastqRead(x) for x in parse_fastq(self.forward_file))
-        revs = (FastqRead(x) for x in parse_fastq(self.reverse_file))
-        for idx, fwd, rev in zip(idxs, fwds, revs):
-            sample = assigner.assign(idx.seq)
-            writer.write((fwd, rev), sample)
+    def barcode_batches(self, block_size=DEFAULT_BLOCK_SIZE, stream=None):
+        """Yield lists of read barcodes, reading only the index file.
+
+        If given, stream is the barcode file as opened by open_input,
+        such as to follow the position reached in the file.
+        """
+        return parse_fastq_lines(
+            stream or self.index_file, 1, block_size, threads=self.threads)
+
+    def demultiplex(self, assigner, writer, timer=None, qc=None):
+        timer = timer or StageTimer()
+        passthrough = use_passthrough(writer, qc)
+        batches = self.parse_batches(
+            self.input_files(), passthrough, threads=self.threads,
+            use_mmap=self.use_mmap)
+        if self.reader_threads:
+            batches = _parse_in_threads(batches, self.input_labels, timer)
+        self.demultiplex_reads(
+            assigner, writer, batches, timer, qc, passthrough)
         return assigner.read_counts
 
+    @staticmethod
+    def parse_batches(files, passthrough=False, **kwargs):
+        """Start parsing the input files, as listed by input_files.
+
+        With passthrough, forward and reverse reads are kept as raw
+        record texts, to be copied to the output as they are.
+        """
+        idx, fwd, rev = files
+        parse = parse_fastq_records if passthrough else parse_fastq_batches
+        return [
+            parse_fastq_batches(idx, **kwargs),
+            parse(fwd, **kwargs), parse(rev, **kwargs)]
+
+    @staticmethod
+    def demultiplex_reads(assigner, writer, batches, timer=None, qc=None,
+                          passthrough=False):
+        timer = timer or StageTimer()
+        write = writer.write_raw if passthrough else writer.write
+        for idxs, fwds, revs in timer.iterate(
+                "parse", _read_batches(batches), _batch_reads):
+            n = len(idxs)
+            with timer.stage("assign", n):
+                samples = assigner.assign_batch(
+                    list(map(_get_seq, idxs)), list(map(_get_qual, idxs)))
+            if qc is not None:
+                with timer.stage("qc", n):
+                    qc.add_batch(samples, fwds, revs)
+            with timer.stage("write", n):
+                _consume(map(write, zip(fwds, revs), samples))
+
 
 class NoIndexFastqSequenceFile(object):
     """Illumina data, 2 file format: forward, reverse.
@@ -27,19 +103,67 @@ class NoIndexFastqSequenceFile(object):
     This format is used by the newer HiSeq machines.  Barcodes are
     found in the description lines of each read.
     """
-    def __init__(self, fwd, rev):
+    # Names of the input files, in the order of input_files
+    input_labels = ("R1", "R2")
+
+    def __init__(self, fwd, rev, threads=None, use_mmap=False,
+                 reader_threads=False):
         self.forward_file = fwd
         self.reverse_file = rev
+        self.threads = threads
+        self.use_mmap = use_mmap
+        self.reader_threads = reader_threads
+
+    def input_files(self):
+        return [self.forward_file, self.reverse_file]
+
+    def barcode_file(self):
+        return self.forward_file
 
-    def demultiplex(self, assigner, writer):
-        fwds = (FastqRead(x) for x in parse_fastq(self.forward_file))
-        revs = (FastqRead(x) for x in parse_fastq(self.reverse_file))
-        for fwd, rev in zip(fwds, revs):
-            barcode_seq = self._parse_barcode(fwd.desc)
-            sample = assigner.assign(barcode_seq)
-            writer.write((fwd, rev), sample)
+    def barcode_batches(self, block_size=DEFAULT_BLOCK_SIZE, stream=None):
+        """Yield lists of read barcodes from the forward read headers."""
+        parse_barcode = self._parse_barcode
+        for descs in parse_fastq_lines(
+                stream or self.forward_file, 0, block_size,
+                threads=self.threads):
+            yield list(map(parse_barcode, descs))
+
+    def demultiplex(self, assigner, writer, timer=None, qc=None):
+        timer = timer or StageTimer()
+        passthrough = use_passthrough(writer, qc)
+        batches = self.parse_batches(
+            self.input_files(), passthrough, threads=self.threads,
+            use_mmap=self.use_mmap)
+        if self.reader_threads:
+            batches = _parse_in_threads(batches, self.input_labels, timer)
+        self.demultiplex_reads(
+            assigner, writer, batches, timer, qc, passthrough)
         return assigner.read_counts
 
+    @staticmethod
+    def parse_batches(files, passthrough=False, **kwargs):
+        parse = parse_fastq_records if passthrough else parse_fastq_batches
+        return [parse(f, **kwargs) for f in files]
+
+    @classmethod
+    def demultiplex_reads(cls, assigner, writer, batches, timer=None,
+                          qc=None, passthrough=False):
+        timer = timer or StageTimer()
+        parse_barcode = cls._parse_barcode
+        get_descs = _raw_descs if passthrough else _descs
+        write = writer.write_raw if passthrough else writer.write
+        for fwds, revs in timer.iterate(
+                "parse", _read_batches(batches), _batch_reads):
+            n = len(fwds)
+            with timer.stage("assign", n):
+                samples = assigner.assign_batch(
+                    list(map(parse_barcode, get_descs(fwds))))
+            if qc is not None:
+                with timer.stage("qc", n):
+                    qc.add_batch(samples, fwds, revs)
+            with timer.stage("write", n):
+                _consume(map(write, zip(fwds, revs), samples))
+
     @staticmethod
     def _parse_barcode(desc):
         """Parse barcode sequence from description line.
@@ -58,21 +182,403 @@ class NoIndexFastqSequenceFile(object):
         return barcode_seq
 
 
-class FastqRead(object):
-    def __init__(self, read):
-        self.desc, self.seq, self.qual = read
+def _read_batches(batches):
+    # Realign batches of records from each file, so that every item
+    # holds lists of the same records. Stops at the end of the
+    # shortest file.
+    batches = [iter(b) for b in batches]
+    bufs = [[] for _ in batches]
+    starts = [0] * len(batches)
+    while True:
+        for i, buf in enumerate(bufs):
+            if starts[i] == len(buf):
+                bufs[i] = next(batches[i], [])
+                starts[i] = 0
+        n = min(len(buf) - start for buf, start in zip(bufs, starts))
+        if not n:
+            return
+        yield [buf[start:start + n] for buf, start in zip(bufs, starts)]
+        starts = [start + n for start in starts]
+
+
+def use_passthrough(writer, qc=None):
+    """True if reads can be copied to the writer's output as raw records.
+
+    QC statistics need the parsed sequence and quality of each read.
+    """
+    return getattr(writer, "passthrough", False) and qc is None
+
+
+def _descs(reads):
+    return map(_get_desc, reads)
+
+
+def _raw_descs(records):
+    # Header line of each raw record, without the "@", found without
+    # a Python-level loop
+    ends = map(str.find, records, itertools.repeat("\n"))
+    headers = map(
+        operator.getitem, records, map(slice, itertools.repeat(1), ends))
+    return map(str.rstrip, headers)
+
+
+def _batch_reads(batches):
+    return len(batches[0])
+
+
+def _parse_in_threads(batches, labels, timer):
+    """Parse each input file on a thread of its own.
+
+    Parsed batches are passed on through bounded queues, so a reader
+    that gets ahead waits for the others. Time spent by each reader is
+    added to the timer as a "parse_<label>" stage once it is done,
+    with CPU time for its thread only. The "parse" stage of the main
+    thread is then the time spent waiting for the readers.
+    """
+    return [
+        _parse_in_thread(b, "parse_" + label, timer)
+        for b, label in zip(batches, labels)]
+
+
+def _parse_in_thread(batches, name, timer):
+    reader = StageTimer(cpu_clock=time.thread_time)
+    try:
+        yield from iter_in_thread(
+            reader.iterate(name, batches, len), READ_AHEAD_BATCHES)
+    finally:
+        timer.merge(reader.stages, reader.reads)
+
+
+def _consume(iterator):
+    # Run an iterator to the end without a Python-level loop
+    collections.deque(iterator, maxlen=0)
+
+
+_get_seq = operator.attrgetter("seq")
+_get_desc = operator.attrgetter("desc")
+_get_qual = operator.attrgetter("qual")
+
+
+class FastqRead(collections.namedtuple("FastqRead", "desc seq qual")):
+    __slots__ = ()
+
+
+def _read_text_blocks(f, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+    """Read a file in large blocks, yielding text ending on a newline.
+
+    Text files are read through their underlying binary buffer when
+    possible, and gzip input is decompressed. Blocks are only cut
+    after a newline byte, which never occurs inside a multi-byte UTF-8
+    character, so each block can be decoded on its own.
+    """
+    stream = open_input(f, threads)
+    carry = None
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        if carry:
+            block = carry + block
+        cut = block.rfind(b"\n" if isinstance(block, bytes) else "\n") + 1
+        carry = block[cut:]
+        block = block[:cut]
+        if block:
+            yield _as_text(block)
+    if carry:
+        yield _as_text(carry) + "\n"
+
+
+def _mapped_text_blocks(f, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield text blocks ending on a newline from a memory-mapped file.
+
+    Blocks are decoded straight from the mapping, without first being
+    copied into a bytes object. The kernel is told that the file is
+    read sequentially, and pages are released once parsed, so memory
+    use stays flat however large the file is. The file position is
+    moved to the end of the file when done.
+    """
+    f = getattr(f, "buffer", f)
+    start = f.tell()
+    size = os.fstat(f.fileno()).st_size
+    if start >= size:
+        return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        released = 0
+        while start < size:
+            cut = size
+            if start + block_size < size:
+                cut = mm.rfind(b"\n", start, start + block_size) + 1
+                if cut <= start:
+                    # A line longer than the block
+                    cut = (mm.find(b"\n", start + block_size) + 1) or size
+            block = str(view[start:cut], "utf-8")
+            if cut == size and not block.endswith("\n"):
+                block += "\n"
+            yield block
+            start = cut
+            done = start - start % mmap.PAGESIZE
+            if done > released and hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_DONTNEED, released, done - released)
+                released = done
+    finally:
+        view.release()
+        mm.close()
+    f.seek(size)
+
+
+def can_mmap(f):
+    """True if f is an uncompressed regular file, which can be mapped."""
+    stream = getattr(f, "buffer", f)
+    try:
+        mode = os.fstat(stream.fileno()).st_mode
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    if not stat.S_ISREG(mode) or not hasattr(stream, "peek"):
+        return False
+    return stream.peek(2)[:2] != GZIP_MAGIC
+
+
+def _as_text(block):
+    if isinstance(block, bytes):
+        return block.decode("utf-8")
+    return block
+
+
+_strip_at = operator.itemgetter(slice(1, None))
+
+
+def parse_fastq_batches(f, block_size=DEFAULT_BLOCK_SIZE, threads=None,
+                        use_mmap=False):
+    """Parse a FASTQ file, yielding lists of FastqRead objects.
+
+    Records split across block boundaries are carried over to the next
+    block. Each batch is checked in bulk for the "@" header, the "+"
+    separator, and matching sequence and quality lengths.
+
+    With use_mmap, uncompressed regular files are read through a
+    memory map; other input is read as usual.
+    """
+    return _parse_blocks(
+        _open_blocks(f, block_size, threads, use_mmap), _make_batch)
+
+
+def parse_fastq_records(f, block_size=DEFAULT_BLOCK_SIZE, threads=None,
+                        use_mmap=False):
+    """Parse a FASTQ file, yielding lists of raw record texts.
+
+    Records are checked as in parse_fastq_batches, but not split into
+    fields: each is the text of the record as found in the input, with
+    line endings converted to newlines.
+    """
+    return _parse_blocks(
+        _open_blocks(f, block_size, threads, use_mmap), _make_raw_batch)
+
+
+def _open_blocks(f, block_size, threads, use_mmap):
+    if use_mmap and can_mmap(f):
+        return _mapped_text_blocks(f, block_size)
+    return _read_text_blocks(f, block_size, threads)
+
+
+def _parse_blocks(blocks, make_batch):
+    leftover = []
+    for block in blocks:
+        if "\r" in block:
+            block = block.replace("\r\n", "\n")
+        lines = block.split("\n")
+        # The block ends with a newline, so the final item is empty
+        lines.pop()
+        if leftover:
+            lines[:0] = leftover
+        # Blank lines at the end of a block are held back until we
+        # know whether they are the end of the file.
+        end = _content_end(lines, len(lines))
+        n = end - (end % 4)
+        leftover = lines[n:]
+        if n:
+            yield make_batch(lines, n)
+    # Blank lines at the end of the file are tolerated, except those
+    # needed to complete a record with an empty sequence.
+    end = _content_end(leftover, len(leftover))
+    end = min(len(leftover), end + (-end % 4))
+    n = end - (end % 4)
+    if n:
+        yield make_batch(leftover, n)
+    if leftover[n:end]:
+        raise ValueError(
+            "Incomplete FASTQ record at end of file: %s" % leftover[n:end])
+
+
+def _content_end(lines, end):
+    while end and lines[end - 1] == "":
+        end -= 1
+    return end
+
+
+def _make_batch(lines, n):
+    descs = lines[0:n:4]
+    # Trailing whitespace was never part of the sequence or quality
+    seqs = list(map(str.rstrip, lines[1:n:4]))
+    seps = lines[2:n:4]
+    quals = list(map(str.rstrip, lines[3:n:4]))
+    if not all(map(str.startswith, descs, itertools.repeat("@"))):
+        _raise_bad_record(descs, seqs, seps, quals)
+    if not all(map(str.startswith, seps, itertools.repeat("+"))):
+        _raise_bad_record(descs, seqs, seps, quals)
+    if list(map(len, seqs)) != list(map(len, quals)):
+        _raise_bad_record(descs, seqs, seps, quals)
+    # Build the namedtuples without going through the Python-level
+    # __new__ generated for FastqRead
+    return list(map(
+        tuple.__new__, itertools.repeat(FastqRead),
+        zip(map(_strip_at, map(str.rstrip, descs)), seqs, quals)))
+
+
+def _make_raw_batch(lines, n):
+    descs = lines[0:n:4]
+    seqs = lines[1:n:4]
+    seps = lines[2:n:4]
+    quals = lines[3:n:4]
+    if not all(map(str.startswith, descs, itertools.repeat("@"))):
+        _raise_bad_record(descs, seqs, seps, quals)
+    if not all(map(str.startswith, seps, itertools.repeat("+"))):
+        _raise_bad_record(descs, seqs, seps, quals)
+    if list(map(len, seqs)) != list(map(len, quals)):
+        # Lengths are compared without trailing whitespace, as when
+        # the fields are parsed
+        stripped_seqs = list(map(str.rstrip, seqs))
+        stripped_quals = list(map(str.rstrip, quals))
+        if list(map(len, stripped_seqs)) != list(map(len, stripped_quals)):
+            _raise_bad_record(descs, stripped_seqs, seps, stripped_quals)
+    return list(map(_format_raw, zip(descs, seqs, seps, quals)))
+
+
+_format_raw = "%s\n%s\n%s\n%s\n".__mod__
+
+
+def _raise_bad_record(descs, seqs, seps, quals):
+    # Only called on failure, so we can afford to check each record
+    for desc, seq, sep, qual in zip(descs, seqs, seps, quals):
+        if not desc.startswith("@"):
+            raise ValueError(
+                "FASTQ header line does not start with @: %s" % desc)
+        if not sep.startswith("+"):
+            raise ValueError(
+                "FASTQ separator line does not start with + "
+                "(record %s): %s" % (desc, sep))
+        if len(seq) != len(qual):
+            raise ValueError(
+                "Sequence and quality lengths differ for record %s" % desc)
+
+
+def parse_fastq_lines(f, line, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+    """Yield lists of the header (line 0) or sequence (line 1) of reads.
+
+    Only the header lines are checked, and the other lines are not
+    looked at past finding where they end, so this is quicker than
+    parsing whole records when only one line of each is needed.
+    """
+    make_batch = functools.partial(_make_line_batch, line)
+    return _parse_blocks(
+        _read_text_blocks(f, block_size, threads), make_batch)
+
+
+def _make_line_batch(line, lines, n):
+    descs = lines[0:n:4]
+    if not all(map(str.startswith, descs, itertools.repeat("@"))):
+        _raise_bad_record(descs, lines[1:n:4], lines[2:n:4], lines[3:n:4])
+    result = list(map(str.rstrip, lines[line:n:4]))
+    if line == 0:
+        result = list(map(_strip_at, result))
+    return result
+
+
+def parse_fastq(f, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+    return itertools.chain.from_iterable(
+        parse_fastq_batches(f, block_size, threads))
+
+
+def read_record_chunks(files, n_records, block_size=DEFAULT_BLOCK_SIZE,
+                       threads=None, offsets=None):
+    """Read several FASTQ files in step, in chunks of raw records.
+
+    Each item is a list holding the unparsed text of the same n_records
+    records (fewer at the end) from every file. Only newlines are
+    counted, so this is much cheaper than parsing the records.
+    Reading stops at the end of the shortest file.
+
+    If offsets are given, reading starts that many bytes into the
+    (decompressed) data of each file.
+    """
+    streams = [open_input(f, threads) for f in files]
+    if offsets is not None:
+        for stream, offset in zip(streams, offsets):
+            _skip(stream, offset, block_size)
+    bufs = [stream.read(0) for stream in streams]
+    eof = [False] * len(streams)
+    while True:
+        for i, stream in enumerate(streams):
+            while not eof[i] and _count_lines(bufs[i]) < 4 * n_records:
+                block = stream.read(block_size)
+                if not block:
+                    eof[i] = True
+                    if bufs[i] and not bufs[i].endswith(_newline(bufs[i])):
+                        bufs[i] += _newline(bufs[i])
+                else:
+                    bufs[i] += block
+        n = min([n_records] + [_count_lines(buf) // 4 for buf in bufs])
+        if n == 0:
+            # Incomplete records left in every file are reported when
+            # they are parsed
+            if all(eof) and all(bufs):
+                yield bufs
+            return
+        chunks = []
+        for i, buf in enumerate(bufs):
+            end = _line_end(buf, 4 * n)
+            chunks.append(buf[:end])
+            bufs[i] = buf[end:]
+        yield chunks
+
+
+def _skip(stream, n, block_size):
+    # Uncompressed files are seeked; anything else, such as gzip input
+    # or a pipe, is read through.
+    if not isinstance(stream, io.TextIOBase) and stream.seekable():
+        stream.seek(n, io.SEEK_CUR)
+        return
+    while n:
+        block = stream.read(min(n, block_size))
+        if not block:
+            raise ValueError("Input file ended before the start offset")
+        n -= len(block)
+
+
+def _newline(buf):
+    return b"\n" if isinstance(buf, bytes) else "\n"
 
 
-def _grouper(iterable, n):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3) --> ABC DEF
-    args = [iter(iterable)] * n
-    return zip(*args)
+def _count_lines(buf):
+    return buf.count(_newline(buf))
 
 
-def parse_fastq(f):
-    for desc, seq, _, qual in _grouper(f, 4):
-        desc = desc.rstrip()[1:]
-        seq = seq.rstrip()
-        qual = qual.rstrip()
-        yield desc, seq, qual
+def _line_end(buf, n_lines, window=1 << 16):
+    # Position just past the n-th newline. Newlines are counted a
+    # window at a time, so only the last few lines are searched for
+    # one by one.
+    newline = _newline(buf)
+    start = 0
+    while True:
+        count = buf.count(newline, start, start + window)
+        if count >= n_lines:
+            break
+        n_lines -= count
+        start += window
+    pos = start
+    for _ in range(n_lines):
+        pos = buf.index(newline, pos) + 1
+    return pos
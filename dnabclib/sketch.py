@@ -0,0 +1,68 @@
+import heapq
+
+
+class SpaceSaving(object):
+    """Approximate counts of the most frequent items in a stream.
+
+    Uses the Space-Saving algorithm with a fixed number of counters.
+    When all counters are in use, a new item takes over the counter
+    with the smallest count. Counts are never underestimated, and the
+    overestimate for each item is at most its recorded error.
+    """
+    def __init__(self, capacity=1000):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive (got %s)" % capacity)
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Heap of (count, item), updated lazily: an entry may hold an
+        # old count, which is fixed when the entry reaches the top.
+        self._heap = []
+
+    def add(self, item, n=1):
+        counts = self.counts
+        if item in counts:
+            counts[item] += n
+        elif len(counts) < self.capacity:
+            counts[item] = n
+            self.errors[item] = 0
+            heapq.heappush(self._heap, (n, item))
+        else:
+            min_count, min_item = self._pop_min()
+            del counts[min_item]
+            del self.errors[min_item]
+            counts[item] = min_count + n
+            self.errors[item] = min_count
+            heapq.heappush(self._heap, (min_count + n, item))
+
+    def _pop_min(self):
+        heap = self._heap
+        while True:
+            count, item = heapq.heappop(heap)
+            current = self.counts[item]
+            if current == count:
+                return count, item
+            heapq.heappush(heap, (current, item))
+
+    def top(self, n):
+        """The n items with the highest counts, as (item, count, error)."""
+        items = heapq.nlargest(n, self.counts.items(), key=lambda x: x[1])
+        return [(item, count, self.errors[item]) for item, count in items]
+
+    def merge(self, other):
+        """Add the counts from another sketch of the same capacity."""
+        for item, count in other.counts.items():
+            if item in self.counts:
+                self.counts[item] += count
+                self.errors[item] += other.errors[item]
+            else:
+                self.counts[item] = count
+                self.errors[item] = other.errors[item]
+        if len(self.counts) > self.capacity:
+            keep = heapq.nlargest(
+                self.capacity, self.counts.items(), key=lambda x: x[1])
+            self.counts = dict(keep)
+            self.errors = dict(
+                (item, self.errors[item]) for item in self.counts)
+        self._heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self._heap)
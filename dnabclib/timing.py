@@ -0,0 +1,81 @@
+import collections
+import contextlib
+import resource
+import sys
+import time
+
+
+class StageTimer(object):
+    """Wall-clock and CPU time spent in each stage of a run.
+
+    Stages are timed around whole batches of reads, so the overhead
+    does not grow with the number of reads. CPU time is for the whole
+    process, including any compression or decompression threads,
+    unless another clock is given, such as time.thread_time for a
+    timer used on a single thread. Reads handled by each stage are
+    counted where given, for its throughput.
+    """
+    def __init__(self, cpu_clock=time.process_time):
+        self.stages = collections.OrderedDict()
+        self.reads = collections.Counter()
+        self.cpu_clock = cpu_clock
+
+    @contextlib.contextmanager
+    def stage(self, name, reads=0):
+        wall = time.perf_counter()
+        cpu = self.cpu_clock()
+        try:
+            yield
+        finally:
+            self.add(
+                name, time.perf_counter() - wall, self.cpu_clock() - cpu)
+            self.reads[name] += reads
+
+    def iterate(self, name, iterable, count=None):
+        """Yield items from iterable, timing how long each takes.
+
+        If given, count(item) is the number of reads in an item.
+        """
+        iterator = iter(iterable)
+        done = object()
+        while True:
+            with self.stage(name):
+                item = next(iterator, done)
+            if item is done:
+                return
+            if count is not None:
+                self.reads[name] += count(item)
+            yield item
+
+    def add(self, name, wall, cpu, batches=1):
+        totals = self.stages.setdefault(name, [0.0, 0.0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += batches
+
+    def merge(self, stages, reads=None):
+        for name, (wall, cpu, batches) in stages.items():
+            self.add(name, wall, cpu, batches)
+        if reads is not None:
+            self.reads.update(reads)
+
+    def get_stats(self):
+        stats = collections.OrderedDict()
+        for name, (wall, cpu, batches) in self.stages.items():
+            reads = self.reads[name]
+            stats[name] = {
+                "wall_seconds": wall,
+                "cpu_seconds": cpu,
+                "batches": batches,
+                "reads": reads,
+                "reads_per_second": reads / wall if wall else 0.0,
+                }
+        return stats
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return maxrss
+    return maxrss * 1024
@@ -1,71 +1,513 @@
+import collections
+import io
+import operator
 import os.path
+import resource
+import zlib
 
- 
-def _get_sample_fp(self, sample):
-    fn = "PCMP%s%s" % (sample.name, self.ext)
+from .compression import CompressionPool
+from .sample import Sample
+
+COMPRESSION_EXTENSIONS = {
+    None: "",
+    "gzip": ".gz",
+}
+
+
+# Stands in for a sample when writing unassigned reads. Sample names
+# are never "unassigned".
+UNASSIGNED_SAMPLE = Sample("unassigned", None)
+
+
+def _get_sample_fp(self, sample, chunk=None):
+    fn = "PCMP%s%s%s" % (sample.name, _chunk_label(chunk), self.ext)
     return os.path.join(self.output_dir, fn)
 
 
-def _get_sample_paired_fp(self, sample):
-    fn1 = "%s_R1%s" % (sample.name, self.ext)
-    fn2 = "%s_R2%s" % (sample.name, self.ext)
+def _get_sample_paired_fp(self, sample, chunk=None):
+    fn1 = "%s_R1%s%s" % (sample.name, _chunk_label(chunk), self.ext)
+    fn2 = "%s_R2%s%s" % (sample.name, _chunk_label(chunk), self.ext)
     return (
         os.path.join(self.output_dir, fn1),
         os.path.join(self.output_dir, fn2))
 
 
+def _get_sample_interleaved_fp(self, sample, chunk=None):
+    fn = "%s%s%s" % (sample.name, _chunk_label(chunk), self.ext)
+    return os.path.join(self.output_dir, fn)
+
+
+def _chunk_label(chunk):
+    # Numbered as Illumina numbers the files of a sample
+    return "" if chunk is None else "_%03d" % chunk
+
+
+class _OutputBuffer(list):
+    """Stands in for an output file, collecting records in memory."""
+    __slots__ = ("fp",)
+
+    write = list.append
+
+    def __init__(self, fp):
+        super(_OutputBuffer, self).__init__()
+        self.fp = fp
+
+    def size(self):
+        return sum(map(len, self))
+
+
+def default_max_open_files():
+    # Leave room under the soft limit for input files and the like
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return 4096
+    return max(8, soft_limit - 64)
+
+
 class _SequenceWriter(object):
-    """Base class for writers"""
+    """Base class for writers
 
-    def __init__(self, output_dir):
+    Records are collected in a buffer for each output file and written
+    in large chunks. When the buffers together exceed max_buffered
+    characters, the largest buffers are written out first. With
+    compression, written data waiting to be compressed is held by a
+    pool shared by all output files, up to compress_buffered bytes on
+    top of max_buffered.
+
+    At most max_open_files output files are open at once. The least
+    recently used file is closed to make room, and opened again in
+    append mode when it is next written.
+
+    With chunk_reads or chunk_bytes, the output of each sample is
+    split into numbered chunks. A chunk is finished once it holds
+    chunk_reads reads, or chunk_bytes characters of uncompressed
+    output, and the next read of the sample starts a new one.
+
+    Unassigned reads are dropped, unless unassigned_fraction is set.
+    That fraction of them is then written to an "unassigned" output,
+    up to unassigned_max_reads reads. Whether a read is kept depends
+    only on a hash of its ID, so the same reads are picked in every
+    run, and both reads of a pair are picked together.
+    """
+    # Lines written per read to each output file
+    lines_per_read = 4
+
+    def __init__(self, output_dir, compression=None, compresslevel=6,
+                 threads=None, max_buffered=64 << 20, max_open_files=None,
+                 chunk_reads=None, chunk_bytes=None,
+                 unassigned_fraction=None, unassigned_max_reads=None,
+                 compress_buffered=256 << 20):
         self.output_dir = output_dir
         self._open_files = {}
+        self._buffers = []
+        self._handles = collections.OrderedDict()
+        self._opened_fps = set()
+        self.buffered = 0
+        self.max_buffered = max_buffered
+        if max_open_files is None:
+            max_open_files = default_max_open_files()
+        self.max_open_files = max_open_files
+        self.flushes = 0
+        self.evictions = 0
+        self.reopens = 0
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(
+                "Unknown output compression: %s" % compression)
+        self.compression = compression
+        self.compresslevel = compresslevel
+        for limit in [chunk_reads, chunk_bytes]:
+            if limit is not None and limit < 1:
+                raise ValueError("Output chunk size must be at least 1")
+        self.chunk_reads = chunk_reads
+        self.chunk_bytes = chunk_bytes
+        self.chunked = chunk_reads is not None or chunk_bytes is not None
+        # Reads and characters in the open chunk of each sample
+        self._chunks = {}
+        # Finished chunks of each sample
+        self._manifest = collections.OrderedDict()
+        if unassigned_fraction is not None and not (
+                0 <= unassigned_fraction <= 1):
+            raise ValueError(
+                "Fraction of unassigned reads must be between 0 and 1 "
+                "(got %s)" % unassigned_fraction)
+        self.unassigned_fraction = unassigned_fraction
+        self.unassigned_max_reads = unassigned_max_reads
+        self.unassigned_written = 0
+        if unassigned_fraction is not None:
+            # Reads with a CRC-32 of the ID below this are kept
+            self._unassigned_below = int(unassigned_fraction * (1 << 32))
+        self.ext = self.ext + COMPRESSION_EXTENSIONS[compression]
+        if compression is None:
+            self._pool = None
+        else:
+            # Shared by all output files; compression runs off the
+            # main demultiplexing loop.
+            self._pool = CompressionPool(
+                threads, compresslevel, max_buffered=compress_buffered)
+
+    # Whether write_raw takes records as found in FASTQ input
+    passthrough = False
 
     def set_sff_header(self, header):
         pass
 
     def _get_output_file(self, sample):
-        f = self._open_files.get(sample)
+        # Samples are told apart by name, so that samples of the same
+        # name from several lanes share their output.
+        f = self._open_files.get(sample.name)
         if f is None:
-            fp = self._get_output_fp(sample)
+            if self.chunked:
+                chunk = len(self._manifest.get(sample.name, ())) + 1
+                fp = self._get_output_fp(sample, chunk)
+                self._chunks[sample.name] = [0, 0]
+            else:
+                fp = self._get_output_fp(sample)
             f = self._open_filepath(fp)
-            self._open_files[sample] = f
+            self._open_files[sample.name] = f
         return f
 
     def _open_filepath(self, fp):
-        return open(fp, "w")
+        buf = _OutputBuffer(fp)
+        self._buffers.append(buf)
+        return buf
+
+    def _get_handle(self, fp):
+        f = self._handles.get(fp)
+        if f is not None:
+            self._handles.move_to_end(fp)
+            return f
+        if len(self._handles) >= self.max_open_files:
+            _, lru_f = self._handles.popitem(last=False)
+            lru_f.close()
+            self.evictions += 1
+        if fp in self._opened_fps:
+            f = self._open_handle(fp, "a")
+            self.reopens += 1
+        else:
+            f = self._open_handle(fp, "w")
+            self._opened_fps.add(fp)
+        self._handles[fp] = f
+        return f
+
+    def _open_handle(self, fp, mode):
+        if self._pool is None:
+            return open(fp, mode)
+        # Appending starts a new gzip member, which is still valid gzip
+        gz = self._pool.open(open(fp, mode + "b"))
+        return io.TextIOWrapper(gz, encoding="utf-8")
 
     def write(self, read, sample):
-        if sample is not None:
+        if sample is None:
+            if self.unassigned_fraction is None or not self._keep_unassigned(
+                    self._read_desc(read)):
+                return
+            sample = UNASSIGNED_SAMPLE
+        f = self._get_output_file(sample)
+        size = self._write_to_file(f, read)
+        self.buffered += size
+        if self.chunked:
+            self._count_chunk(sample, 1, size)
+        if self.buffered > self.max_buffered:
+            self._flush_largest()
+
+    def write_raw(self, records, sample):
+        """Write records already in the output format, as they were read.
+
+        Only for writers with passthrough set.
+        """
+        if sample is None:
+            if self.unassigned_fraction is None or not self._keep_unassigned(
+                    _record_desc(self._first_record(records))):
+                return
+            sample = UNASSIGNED_SAMPLE
+        f = self._get_output_file(sample)
+        size = self._write_raw_to_file(f, records)
+        self.buffered += size
+        if self.chunked:
+            self._count_chunk(sample, 1, size)
+        if self.buffered > self.max_buffered:
+            self._flush_largest()
+
+    # The read, or first read of a pair, that unassigned reads are
+    # picked by
+    @staticmethod
+    def _read_desc(read):
+        return read.desc
+
+    @staticmethod
+    def _first_record(records):
+        return records
+
+    def _keep_unassigned(self, desc):
+        if (self.unassigned_max_reads is not None and
+                self.unassigned_written >= self.unassigned_max_reads):
+            return False
+        # The ID ends at the first space, before any comment that
+        # differs between the reads of a pair
+        read_id = desc.split(" ", 1)[0].rstrip()
+        if zlib.crc32(read_id.encode("utf-8")) >= self._unassigned_below:
+            return False
+        self.unassigned_written += 1
+        return True
+
+    def take_buffered(self):
+        """Remove and return buffered output as {name: [text, ...]}.
+
+        There is one text per output file of the sample. Used to move
+        formatted records from worker processes to the main writer.
+        """
+        result = {}
+        for name, f in self._open_files.items():
+            bufs = f if isinstance(f, tuple) else (f,)
+            if not any(bufs):
+                continue
+            result[name] = ["".join(buf) for buf in bufs]
+            for buf in bufs:
+                del buf[:]
+        self.buffered = 0
+        return result
+
+    def write_buffered(self, sample, texts):
+        if (sample.name == UNASSIGNED_SAMPLE.name and
+                self.unassigned_fraction is not None):
+            texts = self._cap_unassigned(texts)
+        if self.chunked:
+            self._write_buffered_chunks(sample, texts)
+            return
+        f = self._get_output_file(sample)
+        bufs = f if isinstance(f, tuple) else (f,)
+        for buf, text in zip(bufs, texts):
+            if text:
+                buf.write(text)
+                self.buffered += len(text)
+        if self.buffered > self.max_buffered:
+            self._flush_largest()
+
+    def _cap_unassigned(self, texts):
+        # Unassigned reads from workers are already sampled, but are
+        # only cut off at unassigned_max_reads here.
+        n = texts[0].count("\n") // self.lines_per_read
+        if self.unassigned_max_reads is not None:
+            left = self.unassigned_max_reads - self.unassigned_written
+            if n > left:
+                n = left
+                texts = [_head_lines(text, n * self.lines_per_read)
+                         for text in texts]
+        self.unassigned_written += n
+        return texts
+
+    def _write_buffered_chunks(self, sample, texts):
+        while any(texts):
             f = self._get_output_file(sample)
-            self._write_to_file(f, read)
+            reads, size = self._chunks[sample.name]
+            n = texts[0].count("\n") // self.lines_per_read
+            total = sum(map(len, texts))
+            if not self._chunk_full(reads + n, size + total):
+                cuts = list(map(len, texts))
+            else:
+                # Only done once per chunk, so the texts can be split
+                # into reads here
+                n, cuts = self._chunk_cut(texts, reads, size)
+                total = sum(cuts)
+            bufs = f if isinstance(f, tuple) else (f,)
+            for buf, text, cut in zip(bufs, texts, cuts):
+                if cut:
+                    buf.write(text[:cut])
+            self.buffered += total
+            texts = [text[cut:] for text, cut in zip(texts, cuts)]
+            self._count_chunk(sample, n, total)
+            if self.buffered > self.max_buffered:
+                self._flush_largest()
 
-    def close(self):
-        for f in self._open_files.values():
+    def _chunk_cut(self, texts, reads, size):
+        # Returns the number of reads that finish the chunk, and where
+        # they end in each text.
+        read_sizes = []
+        for text in texts:
+            lens = [len(line) + 1 for line in text.split("\n")[:-1]]
+            step = self.lines_per_read
+            read_sizes.append([
+                sum(lens[i:i + step]) for i in range(0, len(lens), step)])
+        n = 0
+        for n, read_size in enumerate(map(sum, zip(*read_sizes)), 1):
+            size += read_size
+            if self._chunk_full(reads + n, size):
+                break
+        return n, [sum(sizes[:n]) for sizes in read_sizes]
+
+    def _chunk_full(self, reads, size):
+        return (
+            (self.chunk_reads is not None and reads >= self.chunk_reads) or
+            (self.chunk_bytes is not None and size >= self.chunk_bytes))
+
+    def _count_chunk(self, sample, reads, size):
+        counts = self._chunks[sample.name]
+        counts[0] += reads
+        counts[1] += size
+        if self._chunk_full(*counts):
+            self._finish_chunk(sample.name)
+
+    def _finish_chunk(self, name):
+        f = self._open_files.pop(name)
+        bufs = f if isinstance(f, tuple) else (f,)
+        for buf in bufs:
+            self._flush_buffer(buf)
+            self._buffers.remove(buf)
+            handle = self._handles.pop(buf.fp, None)
+            if handle is not None:
+                handle.close()
+        reads, _ = self._chunks.pop(name)
+        self._manifest.setdefault(name, []).append(
+            {"files": [buf.fp for buf in bufs], "reads": reads})
+
+    def get_manifest(self):
+        """Return the chunks of each sample as {name: [chunk, ...]}.
+
+        Each chunk gives its output files and number of reads.
+        """
+        manifest = collections.OrderedDict(
+            (name, list(chunks)) for name, chunks in self._manifest.items())
+        for name, (reads, _) in self._chunks.items():
+            f = self._open_files[name]
+            bufs = f if isinstance(f, tuple) else (f,)
+            manifest.setdefault(name, []).append(
+                {"files": [buf.fp for buf in bufs], "reads": reads})
+        return manifest
+
+    def _flush_largest(self):
+        # Write out the largest buffers until we are well under the
+        # budget, so that the next flush is not on the next read.
+        target = self.max_buffered // 2
+        by_size = sorted(self._buffers, key=_OutputBuffer.size, reverse=True)
+        for buf in by_size:
+            if self.buffered <= target:
+                break
+            self._flush_buffer(buf)
+
+    def _flush_buffer(self, buf):
+        if not buf:
+            return
+        f = self._get_handle(buf.fp)
+        data = "".join(buf)
+        f.write(data)
+        self.flushes += 1
+        self.buffered -= len(data)
+        del buf[:]
+
+    def flush(self):
+        for buf in self._buffers:
+            self._flush_buffer(buf)
+
+    def sync(self):
+        """Write out everything, returning the size of each output file.
+
+        Open files are closed, so compressed output ends on a gzip
+        member boundary and can be truncated back to these sizes.
+        """
+        self.flush()
+        handles = list(self._handles.values())
+        self._handles.clear()
+        for f in handles:
             f.close()
+        return dict((fp, os.path.getsize(fp)) for fp in self._opened_fps)
+
+    def restore(self, sizes, unassigned_written=0):
+        """Truncate output files to the sizes given by sync.
+
+        The files are then appended to, rather than overwritten, when
+        written again. unassigned_written is the number of unassigned
+        reads in the files at those sizes.
+        """
+        self.unassigned_written = unassigned_written
+        for fp, size in sizes.items():
+            if not os.path.exists(fp) or os.path.getsize(fp) < size:
+                raise ValueError(
+                    "Output file is missing or shorter than expected: %s"
+                    % fp)
+            with open(fp, "r+b") as f:
+                f.truncate(size)
+            self._opened_fps.add(fp)
+
+    def get_stats(self):
+        return {
+            "unassigned_written": self.unassigned_written,
+            "max_open_files": self.max_open_files,
+            "flushes": self.flushes,
+            "evictions": self.evictions,
+            "reopens": self.reopens,
+            "reopen_rate": (
+                float(self.reopens) / self.flushes if self.flushes else 0.0),
+            "bytes_written": sum(
+                os.path.getsize(fp) for fp in self._opened_fps
+                if os.path.exists(fp)),
+            }
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._close_files(self._handles.values())
+
+    def _close_files(self, files):
+        # Every file is closed and the pool shut down even if closing
+        # one of them fails; the first error is raised afterwards.
+        error = None
+        for f in files:
+            try:
+                f.close()
+            except Exception as e:
+                if error is None:
+                    error = e
+        if self._pool is not None:
+            self._pool.shutdown()
+        if error is not None:
+            raise error
+
+
+def _first_desc(readpair):
+    return readpair[0].desc
+
+
+def _record_desc(record):
+    return record[1:record.index("\n")]
+
+
+def _head_lines(text, n_lines):
+    # The first n_lines lines of the text
+    end = 0
+    for _ in range(n_lines):
+        end = text.find("\n", end) + 1
+        if not end:
+            return text
+    return text[:end]
 
 
 class FastaWriter(_SequenceWriter):
     ext = ".fasta"
+    lines_per_read = 2
     _get_output_fp = _get_sample_fp
 
     def _write_to_file(self, f, read):
-        f.write(">%s\n%s\n" % (read.desc, read.seq))
+        data = ">%s\n%s\n" % (read.desc, read.seq)
+        f.write(data)
+        return len(data)
 
 
 class FastqWriter(_SequenceWriter):
     ext = ".fastq"
     _get_output_fp = _get_sample_fp
 
-    def _open_filepath(self, fp):
-        return open(fp, "w")
-
     def _write_to_file(self, f, read):
-        f.write("@%s\n%s\n+\n%s\n" % (read.desc, read.seq, read.qual))
+        data = "@%s\n%s\n+\n%s\n" % (read.desc, read.seq, read.qual)
+        f.write(data)
+        return len(data)
 
 
 class PairedFastqWriter(FastqWriter):
     _get_output_fp = _get_sample_paired_fp
+    passthrough = True
+    _read_desc = staticmethod(_first_desc)
+    _first_record = staticmethod(operator.itemgetter(0))
 
     def _open_filepath(self, fps):
         fp1, fp2 = fps
@@ -76,12 +518,43 @@ class PairedFastqWriter(FastqWriter):
     def _write_to_file(self, filepair, readpair):
         f1, f2 = filepair
         r1, r2 = readpair
-        super(PairedFastqWriter, self)._write_to_file(f1, r1)
-        super(PairedFastqWriter, self)._write_to_file(f2, r2)
+        # Formatted here rather than through the superclass, to save
+        # two method calls per read pair
+        data1 = "@%s\n%s\n+\n%s\n" % (r1.desc, r1.seq, r1.qual)
+        data2 = "@%s\n%s\n+\n%s\n" % (r2.desc, r2.seq, r2.qual)
+        f1.write(data1)
+        f2.write(data2)
+        return len(data1) + len(data2)
 
-    def close(self):
-        for f1, f2 in self._open_files.values():
-            f1.close()
-            f2.close()
+    def _write_raw_to_file(self, filepair, recordpair):
+        f1, f2 = filepair
+        r1, r2 = recordpair
+        f1.write(r1)
+        f2.write(r2)
+        return len(r1) + len(r2)
 
 
+class InterleavedFastqWriter(FastqWriter):
+    """Writes each read pair to one file per sample, R1 before R2.
+
+    Needs half the open files of PairedFastqWriter, and each pair is
+    written to the same place on disk.
+    """
+    _get_output_fp = _get_sample_interleaved_fp
+    passthrough = True
+    lines_per_read = 8
+    _read_desc = staticmethod(_first_desc)
+    _first_record = staticmethod(operator.itemgetter(0))
+
+    def _write_to_file(self, f, readpair):
+        r1, r2 = readpair
+        data = "@%s\n%s\n+\n%s\n@%s\n%s\n+\n%s\n" % (
+            r1.desc, r1.seq, r1.qual, r2.desc, r2.seq, r2.qual)
+        f.write(data)
+        return len(data)
+
+    def _write_raw_to_file(self, f, recordpair):
+        r1, r2 = recordpair
+        f.write(r1)
+        f.write(r2)
+        return len(r1) + len(r2)
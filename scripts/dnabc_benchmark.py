@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+import sys
+from dnabclib.benchmark import main
+sys.exit(main())
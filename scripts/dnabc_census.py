@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+from dnabclib.main import census_main
+census_main()
@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+from dnabclib.main import lanes_main
+lanes_main()
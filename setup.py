@@ -17,5 +17,8 @@ setup(
         'scripts/dnabc.py',
         'scripts/split_samplelanes.py',
         'scripts/make_index.py',
-        'scripts/get_sample_names.py'],
+        'scripts/get_sample_names.py',
+        'scripts/dnabc_benchmark.py',
+        'scripts/dnabc_lanes.py',
+        'scripts/dnabc_census.py'],
     )
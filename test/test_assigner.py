@@ -1,13 +1,18 @@
 from collections import namedtuple
 from io import StringIO
 import os
+import random
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
+from dnabclib import assigner
 from dnabclib.assigner import (
-    BarcodeAssigner, deambiguate, reverse_complement,
+    BarcodeAssigner, DualBarcodeAssigner, make_assigner, deambiguate,
+    reverse_complement,
     )
+from dnabclib.sample import Sample
 
 
 MockRead = namedtuple("Read", "seq")
@@ -42,6 +47,302 @@ class BarcodeAssignerTests(unittest.TestCase):
         self.assertEqual(a.assign("GTCAAAT"), None)
         self.assertEqual(a.read_counts, {"Abc": 2, 'unassigned':1})
 
+    def test_two_mismatches(self):
+        s = MockSample("Abc", "ACCTGAC")
+        a = BarcodeAssigner([s], mismatches=2, revcomp=False)
+        self.assertEqual(a.assign("ACCTGAC"), s)
+        self.assertEqual(a.assign("ACCTGAA"), s)
+        self.assertEqual(a.assign("TCCTGAA"), s)
+        self.assertEqual(a.assign("TGCTGAA"), None)
+        self.assertEqual(a.read_counts, {"Abc": 3, 'unassigned':1})
+        # 1 + 7 * 3 + 21 * 9 barcodes within two mismatches
+        self.assertEqual(a.index_stats["entries"], 211)
+
+    def test_ambiguous_barcodes(self):
+        s1 = MockSample("S1", "AAAA")
+        s2 = MockSample("S2", "AACC")
+        s3 = MockSample("S3", "AAAT")
+        a = BarcodeAssigner([s1, s2, s3], mismatches=1, revcomp=False)
+        # Exact match beats a one-mismatch neighbor of another sample
+        self.assertEqual(a.assign("AAAT"), s3)
+        # One mismatch from both S1 and S3
+        self.assertEqual(a.assign("AAAG"), None)
+        # One mismatch from both S1 (pos 3) and S2 (pos 4)
+        self.assertEqual(a.assign("AACA"), None)
+        self.assertEqual(a.assign("AACG"), s2)
+        self.assertEqual(a.read_counts, {
+            "S1": 0, "S2": 1, "S3": 1, "unassigned": 2})
+        self.assertEqual(a.ambiguous_reads, 2)
+        self.assertGreater(a.index_stats["ambiguous_entries"], 0)
+
+    def test_closest_barcode_wins(self):
+        s1 = MockSample("S1", "AAAA")
+        s2 = MockSample("S2", "AACC")
+        a = BarcodeAssigner([s1, s2], mismatches=2, revcomp=False)
+        # One mismatch from S2, two from S1
+        self.assertEqual(a.assign("AACT"), s2)
+
+    def test_merge_counts(self):
+        s = MockSample("Abc", "ACCTGAC")
+        a = BarcodeAssigner([s], mismatches=0, revcomp=False)
+        b = BarcodeAssigner([s], mismatches=0, revcomp=False)
+        a.assign("ACCTGAC")
+        b.assign("ACCTGAC")
+        b.assign("AAAAAAA")
+        a.merge_counts(b.get_counts())
+        self.assertEqual(a.read_counts, {"Abc": 2, "unassigned": 1})
+        b.reset_counts()
+        self.assertEqual(b.read_counts, {"Abc": 0, "unassigned": 0})
+
+    def test_min_quality(self):
+        s = MockSample("Abc", "ACCTGAC")
+        a = BarcodeAssigner([s], mismatches=1, revcomp=False, min_quality=20)
+        self.assertEqual(a.assign("ACCTGAC", "IIIIIII"), s)
+        # Quality 19 at the first base
+        self.assertEqual(a.assign("ACCTGAC", "4IIIIII"), None)
+        self.assertEqual(a.assign("ACCTGAC"), s)
+        self.assertEqual(a.read_counts, {"Abc": 2, "unassigned": 1})
+        self.assertEqual(a.quality_rejected, 1)
+
+        a = BarcodeAssigner(
+            [s], mismatches=1, revcomp=False, min_quality=20,
+            quality_check="mismatches")
+        # Low quality at a matching base is accepted
+        self.assertEqual(a.assign("ACCTGAC", "4IIIIII"), s)
+        # Low quality at the mismatched base is rejected
+        self.assertEqual(a.assign("TCCTGAC", "4IIIIII"), None)
+        self.assertEqual(a.assign("TCCTGAC", "I4IIIII"), s)
+        self.assertEqual(a.get_stats()["quality_rejected"], 1)
+        self.assertRaises(
+            ValueError, BarcodeAssigner, [s], quality_check="other")
+
+    def test_negative_mismatches(self):
+        self.assertRaises(ValueError, BarcodeAssigner, [], mismatches=-1)
+
+    def test_unassigned_barcodes(self):
+        s = MockSample("Abc", "ACCTGAC")
+        a = BarcodeAssigner(
+            [s], revcomp=False, top_unassigned=2, sketch_size=4)
+        seqs = ["AAAAAAA"] * 5 + ["CCCCCCC"] * 3 + ["ACCTGAC"]
+        seqs += ["GGGGGG%s" % c for c in "ACGT"]
+        for seq in seqs:
+            a.assign(seq)
+        top = a.get_stats()["unassigned_barcodes"]
+        self.assertEqual(
+            [x["barcode"] for x in top], ["AAAAAAA", "CCCCCCC"])
+        self.assertEqual(top[0]["count"], 5)
+
+
+def random_barcodes(rng, barcodes, n):
+    # Mostly sample barcodes with a few errors, plus odd barcodes
+    seqs = []
+    for _ in range(n):
+        bc = list(rng.choice(barcodes))
+        for _ in range(rng.randrange(3)):
+            bc[rng.randrange(len(bc))] = rng.choice("ACGTN")
+        seqs.append("".join(bc))
+    return seqs + ["", "ACG", barcodes[0] + "A", "é" * len(barcodes[0])]
+
+
+class AssignBatchTests(unittest.TestCase):
+    def check_batch(self, make, with_quals=False):
+        rng = random.Random(0)
+        a = make()
+        b = make()
+        barcodes = [s.barcode.replace("-", "") for s in a.samples]
+        if a.revcomp:
+            barcodes = [reverse_complement(bc) for bc in barcodes]
+        seqs = random_barcodes(rng, barcodes, 2000)
+        if with_quals:
+            quals = ["".join(rng.choice("#5?I") for _ in seq) for seq in seqs]
+            self.assertEqual(
+                a.assign_batch(seqs, quals), list(map(b.assign, seqs, quals)))
+            self.assertGreater(b.quality_rejected, 0)
+        else:
+            self.assertEqual(
+                a.assign_batch(seqs), list(map(b.assign, seqs)))
+        self.assertEqual(a.get_counts()["read_counts"], b.read_counts)
+        self.assertEqual(
+            a.unassigned_barcodes.counts, b.unassigned_barcodes.counts)
+        stats_a, stats_b = a.get_stats(), b.get_stats()
+        for key in ["build_seconds", "unassigned_barcodes"]:
+            del stats_a[key], stats_b[key]
+        self.assertEqual(stats_a, stats_b)
+        self.assertGreater(b.ambiguous_reads, 0)
+
+    def test_assign_batch(self):
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["ACCTGACA", "ACCTGTCA", "GGTTAACC", "TTTTCCCC"])]
+        self.check_batch(lambda: BarcodeAssigner(samples, mismatches=1))
+
+    def test_assign_batch_sorted_table(self):
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["ACCTGACAGGTTAA", "ACCTGTCAGGTTAA", "GGTTAACCTTAAGG"])]
+        with mock.patch.object(assigner, "_DENSE_TABLE_SIZE", 0):
+            self.check_batch(lambda: BarcodeAssigner(
+                samples, mismatches=2, revcomp=False))
+
+    def test_assign_batch_dual(self):
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["AAAAC-CCCCC", "AAAAC-CCCCG", "GGGTT-TTTTT",
+                 "AAAAC-TTTTT"])]
+        for revcomp in [False, True]:
+            self.check_batch(lambda: DualBarcodeAssigner(
+                samples, mismatches=(1, 1), revcomp=revcomp))
+            a = DualBarcodeAssigner(samples, revcomp=False)
+            a.assign_batch(["AAAACCCCCC", "GGGTTCCCCC"])
+            self.assertEqual(a.pair_counts, [[1, 0, 0], [1, 0, 0]])
+
+    def test_assign_batch_quality(self):
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["ACCTGACA", "ACCTGTCA", "GGTTAACC", "TTTTCCCC"])]
+        for check in ["bases", "mismatches"]:
+            self.check_batch(lambda: BarcodeAssigner(
+                samples, mismatches=1, min_quality=20, quality_check=check),
+                with_quals=True)
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["AAAAC-CCCCC", "AAAAC-CCCCG", "GGGTT-TTTTT"])]
+        self.check_batch(lambda: DualBarcodeAssigner(
+            samples, mismatches=1, min_quality=30,
+            quality_check="mismatches"), with_quals=True)
+
+    def test_assign_batch_without_numpy(self):
+        s = MockSample("Abc", "ACCTGAC")
+        with mock.patch.object(assigner, "np", None):
+            a = BarcodeAssigner([s], revcomp=False)
+            self.assertEqual(
+                a.assign_batch(["ACCTGAC", "AAAAAAA"]), [s, None])
+
+
+class BarcodeCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def check_cache(self, make):
+        rng = random.Random(0)
+        ref = make()
+        built = make(cache_dir=self.cache_dir)
+        self.assertFalse(built.index_stats["cached"])
+        with mock.patch.object(assigner, "build_barcode_table") as build:
+            loaded = make(cache_dir=self.cache_dir)
+            loaded_each = make(cache_dir=self.cache_dir)
+            self.assertFalse(build.called)
+        self.assertTrue(loaded.index_stats["cached"])
+        barcodes = [s.barcode.replace("-", "") for s in ref.samples]
+        if ref.revcomp:
+            barcodes = [reverse_complement(bc) for bc in barcodes]
+        seqs = random_barcodes(rng, barcodes, 2000)
+        expected = list(map(ref.assign, seqs))
+        self.assertEqual(loaded.assign_batch(seqs), expected)
+        # The tables are only turned into dicts for single lookups
+        self.assertNotIn(loaded._table_names[0], vars(loaded_each))
+        self.assertEqual(list(map(loaded_each.assign, seqs)), expected)
+        for a in [loaded, loaded_each]:
+            self.assertEqual(a.read_counts, ref.read_counts)
+            self.assertEqual(
+                a.unassigned_barcodes.counts, ref.unassigned_barcodes.counts)
+            self.assertEqual(a.ambiguous_reads, ref.ambiguous_reads)
+            stats, ref_stats = a.get_stats(), ref.get_stats()
+            for key in ["build_seconds", "cached", "unassigned_barcodes"]:
+                del stats[key], ref_stats[key]
+            self.assertEqual(stats, ref_stats)
+
+    def test_cache(self):
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["ACCTGACA", "ACCTGTCA", "GGTTAACC", "TTTTCCCC"])]
+        self.check_cache(lambda **kwargs: BarcodeAssigner(
+            samples, mismatches=1, **kwargs))
+        # Other options are saved separately
+        self.check_cache(lambda **kwargs: BarcodeAssigner(
+            samples, mismatches=2, revcomp=False, **kwargs))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_cache_sorted_table(self):
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["ACCTGACAGGTTAA", "ACCTGTCAGGTTAA", "GGTTAACCTTAAGG"])]
+        with mock.patch.object(assigner, "_DENSE_TABLE_SIZE", 0):
+            self.check_cache(lambda **kwargs: BarcodeAssigner(
+                samples, mismatches=2, revcomp=False, **kwargs))
+
+    def test_cache_dual(self):
+        samples = [
+            Sample("S%d" % n, bc) for n, bc in enumerate(
+                ["AAAAC-CCCCC", "AAAAC-CCCCG", "GGGTT-TTTTT",
+                 "AAAAC-TTTTT"])]
+        for revcomp in [False, True]:
+            self.check_cache(lambda **kwargs: DualBarcodeAssigner(
+                samples, mismatches=(1, 1), revcomp=revcomp, **kwargs))
+
+    def test_cache_mixed_lengths(self):
+        # Tables that cannot be packed are only saved as barcodes
+        samples = [Sample("S1", "ACGTAC"), Sample("S2", "GGTTAAC")]
+        self.check_cache(lambda **kwargs: BarcodeAssigner(
+            samples, mismatches=1, **kwargs))
+
+
+class DualBarcodeAssignerTests(unittest.TestCase):
+    def setUp(self):
+        self.s1 = Sample("S1", "AAAA-CCCCCC")
+        self.s2 = Sample("S2", "GGGG-TTTTTT")
+        self.s3 = Sample("S3", "AAAA-TTTTTT")
+
+    def test_assign(self):
+        a = DualBarcodeAssigner(
+            [self.s1, self.s2, self.s3], mismatches=(1, 0), revcomp=False)
+        self.assertEqual(a.assign("AAAACCCCCC"), self.s1)
+        # One mismatch allowed in i7 only
+        self.assertEqual(a.assign("AAATCCCCCC"), self.s1)
+        self.assertEqual(a.assign("AAAACCCCCT"), None)
+        self.assertEqual(a.assign("GGGGTTTTTT"), self.s2)
+        # Index hopping: GGGG is only paired with TTTTTT
+        self.assertEqual(a.assign("GGGGCCCCCC"), None)
+        self.assertEqual(a.read_counts, {
+            "S1": 2, "S2": 1, "S3": 0, "unassigned": 2})
+        self.assertEqual(a.i7_barcodes, ["AAAA", "GGGG"])
+        self.assertEqual(a.i5_barcodes, ["CCCCCC", "TTTTTT"])
+        self.assertEqual(a.pair_counts, [[2, 0], [1, 1]])
+        stats = a.get_stats()
+        self.assertEqual(stats["index_pairs"]["counts"], [[2, 0], [1, 1]])
+
+    def test_revcomp(self):
+        a = DualBarcodeAssigner([self.s1, self.s2], revcomp=True)
+        seq = reverse_complement("AAAACCCCCC")
+        self.assertEqual(a.assign(seq), self.s1)
+        self.assertEqual(a.pair_counts, [[1, 0], [0, 0]])
+
+    def test_merge_counts(self):
+        a = DualBarcodeAssigner([self.s1, self.s2], revcomp=False)
+        b = DualBarcodeAssigner([self.s1, self.s2], revcomp=False)
+        a.assign("AAAACCCCCC")
+        b.assign("AAAATTTTTT")
+        a.merge_counts(b.get_counts())
+        self.assertEqual(a.pair_counts, [[1, 1], [0, 0]])
+        self.assertEqual(a.read_counts["unassigned"], 1)
+
+    def test_make_assigner(self):
+        a = make_assigner([self.s1, self.s2], mismatches=[1, 2])
+        self.assertTrue(isinstance(a, DualBarcodeAssigner))
+        self.assertEqual(a.mismatches, (1, 2))
+        single = Sample("S4", "ACGT")
+        a = make_assigner([single])
+        self.assertFalse(isinstance(a, DualBarcodeAssigner))
+        self.assertRaises(ValueError, make_assigner, [single], [1, 1])
+
+    def test_unequal_lengths(self):
+        s4 = Sample("S4", "AAAAA-CCCCCC")
+        self.assertRaises(
+            ValueError, DualBarcodeAssigner, [self.s1, s4], revcomp=False)
+
 
 class FunctionTests(unittest.TestCase):
     def test_deambiguate(self):
@@ -0,0 +1,70 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from dnabclib.benchmark import (
+    make_barcodes, make_run, run_benchmarks, compare_results, main,
+    )
+from dnabclib.seqfile import parse_fastq
+
+
+class BenchmarkTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_make_barcodes(self):
+        bcs = make_barcodes(random.Random(0), 20, 8, min_distance=3)
+        self.assertEqual(len(set(bcs)), 20)
+        for a in bcs:
+            for b in bcs:
+                if a != b:
+                    self.assertGreaterEqual(
+                        sum(x != y for x, y in zip(a, b)), 3)
+
+    def test_make_run(self):
+        fps = make_run(
+            self.temp_dir, "header", reads=50, read_length=20, samples=4,
+            barcode_length=8)
+        self.assertNotIn("index_reads", fps)
+        with open(fps["forward_reads"]) as f:
+            reads = list(parse_fastq(f))
+        self.assertEqual(len(reads), 50)
+        self.assertEqual(len(reads[0].seq), 20)
+        self.assertEqual(len(reads[0].desc.rpartition(":")[2]), 8)
+
+    def test_run_benchmarks(self):
+        params = {"reads": 100, "read_length": 20, "samples": 4}
+        res = run_benchmarks(self.temp_dir, params, repeat=1)
+        self.assertEqual(res["params"]["reads"], 100)
+        self.assertIn("end_to_end", res["results"])
+        self.assertEqual(compare_results(res, res), [])
+        slow = json.loads(json.dumps(res))
+        slow["results"]["parse_fastq"]["seconds"] += 10
+        self.assertEqual(
+            [name for name, _, _ in compare_results(slow, res)],
+            ["parse_fastq"])
+        slow["layout"] = "header"
+        self.assertRaises(ValueError, compare_results, slow, res)
+
+    def test_main(self):
+        output_fp = os.path.join(self.temp_dir, "results.json")
+        argv = [
+            "--reads", "100", "--samples", "4", "--repeat", "1",
+            "--work-dir", self.temp_dir]
+        self.assertEqual(main(argv + ["--output-file", output_fp]), 0)
+        with open(output_fp) as f:
+            res = json.load(f)
+        self.assertEqual(res["layout"], "index")
+        self.assertEqual(
+            main(argv + ["--baseline-file", output_fp,
+                         "--tolerance", "1000"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
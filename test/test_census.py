@@ -0,0 +1,134 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dnabclib.assigner import make_assigner
+from dnabclib.benchmark import make_run
+from dnabclib.census import count_barcodes
+from dnabclib.main import census_main, main
+from dnabclib.sample import Sample
+from dnabclib.seqfile import (
+    IndexFastqSequenceFile, NoIndexFastqSequenceFile,
+    )
+
+
+class CensusTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_run(self, layout):
+        fps = make_run(
+            self.temp_dir, layout=layout, reads=2000, read_length=20,
+            samples=4, barcode_length=8)
+        with open(fps["barcode_file"]) as f:
+            samples = list(Sample.load(f))
+        return fps, samples
+
+    def expected_counts(self, fps, layout):
+        # Counts from a full run
+        summary_fp = os.path.join(self.temp_dir, "full.json")
+        argv = [
+            "--forward-reads", fps["forward_reads"],
+            "--reverse-reads", fps["reverse_reads"],
+            "--barcode-file", fps["barcode_file"],
+            "--output-dir", os.path.join(self.temp_dir, "output"),
+            "--summary-file", summary_fp,
+            ]
+        if layout == "index":
+            argv += ["--index-reads", fps["index_reads"]]
+        main(argv)
+        with open(summary_fp) as f:
+            return json.load(f)["data"]
+
+    def test_count_barcodes(self):
+        for layout in ["index", "header"]:
+            fps, samples = self.make_run(layout)
+            expected = self.expected_counts(fps, layout)
+            if layout == "index":
+                f = open(fps["index_reads"], "rb")
+                seq_file = IndexFastqSequenceFile(None, None, f)
+            else:
+                f = open(fps["forward_reads"], "rb")
+                seq_file = NoIndexFastqSequenceFile(f, None)
+            with f:
+                assigner = make_assigner(samples, revcomp=layout == "index")
+                stats = count_barcodes(seq_file, assigner)
+            self.assertEqual(assigner.read_counts, expected)
+            self.assertEqual(stats["reads"], 2000)
+            self.assertTrue(stats["complete"])
+            self.assertNotIn("projected_reads", stats)
+
+    def test_max_reads(self):
+        fps, samples = self.make_run("index")
+        expected = self.expected_counts(fps, "index")
+        with open(fps["index_reads"], "rb") as f:
+            assigner = make_assigner(samples)
+            stats = count_barcodes(
+                IndexFastqSequenceFile(None, None, f), assigner,
+                max_reads=500, block_size=4096)
+        self.assertEqual(sum(assigner.read_counts.values()), 500)
+        self.assertFalse(stats["complete"])
+        # All index records have the same length
+        self.assertAlmostEqual(stats["projected_reads"], 2000, delta=100)
+        projected = stats["projected_counts"]
+        self.assertEqual(sorted(projected), sorted(expected))
+        for name, n in expected.items():
+            self.assertAlmostEqual(projected[name], n, delta=150)
+
+    def test_max_reads_gzip(self):
+        fps = make_run(
+            self.temp_dir, reads=20000, read_length=20, samples=4,
+            barcode_length=8)
+        with open(fps["barcode_file"]) as f:
+            samples = list(Sample.load(f))
+        index_fp = fps["index_reads"] + ".gz"
+        with open(fps["index_reads"], "rb") as f:
+            with gzip.open(index_fp, "wb") as g:
+                g.write(f.read())
+        with open(index_fp, "rb") as f:
+            stats = count_barcodes(
+                IndexFastqSequenceFile(None, None, f), make_assigner(samples),
+                max_reads=5000, block_size=4096)
+        # The whole file is inflated ahead of the reads parsed
+        self.assertAlmostEqual(stats["projected_reads"], 20000, delta=1000)
+
+    def test_census_main(self):
+        fps, samples = self.make_run("index")
+        expected = self.expected_counts(fps, "index")
+        index_fp = fps["index_reads"] + ".gz"
+        with open(fps["index_reads"], "rb") as f:
+            with gzip.open(index_fp, "wb") as g:
+                g.write(f.read())
+        summary_fp = os.path.join(self.temp_dir, "census.json")
+        census_main([
+            "--index-reads", index_fp,
+            "--barcode-file", fps["barcode_file"],
+            "--summary-file", summary_fp,
+            ])
+        with open(summary_fp) as f:
+            res = json.load(f)
+        self.assertEqual(res["data"], expected)
+        self.assertEqual(res["stats"]["census"]["reads"], 2000)
+        self.assertEqual(res["stats"]["run"]["reads"], 2000)
+
+        census_main([
+            "--index-reads", index_fp,
+            "--barcode-file", fps["barcode_file"],
+            "--summary-file", summary_fp,
+            "--max-reads", "100",
+            ])
+        with open(summary_fp) as f:
+            res = json.load(f)
+        self.assertEqual(sum(res["data"].values()), 100)
+        self.assertFalse(res["stats"]["census"]["complete"])
+        self.assertIn("projected_reads", res["stats"]["census"])
+
+
+if __name__ == "__main__":
+    unittest.main()
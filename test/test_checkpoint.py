@@ -0,0 +1,140 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from dnabclib.benchmark import make_run
+from dnabclib.checkpoint import (
+    Checkpointer, CHECKPOINT_FILENAME, load_checkpoint,
+    )
+from dnabclib.main import main
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(n_chunks):
+    advance = Checkpointer.advance
+    calls = []
+
+    # The chunk's output is already with the writer, and gets written
+    # out past the last checkpoint when the writer is closed.
+    def interrupted_advance(self, sizes, reads):
+        calls.append(reads)
+        if len(calls) == n_chunks:
+            raise Interrupted()
+        advance(self, sizes, reads)
+    return mock.patch.object(Checkpointer, "advance", interrupted_advance)
+
+
+class ResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.fps = make_run(
+            self.temp_dir, reads=2000, read_length=30, samples=8,
+            barcode_length=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_main(self, name, config, *args):
+        output_dir = os.path.join(self.temp_dir, name)
+        summary_fp = os.path.join(self.temp_dir, name + ".json")
+        config_fp = os.path.join(self.temp_dir, name + "_config.json")
+        with open(config_fp, "w") as f:
+            json.dump(config, f)
+        main([
+            "--forward-reads", self.fps["forward_reads"],
+            "--reverse-reads", self.fps["reverse_reads"],
+            "--index-reads", self.fps["index_reads"],
+            "--barcode-file", self.fps["barcode_file"],
+            "--output-dir", output_dir,
+            "--summary-file", summary_fp,
+            "--config-file", config_fp,
+            ] + list(args))
+        with open(summary_fp) as f:
+            return output_dir, json.load(f)
+
+    def read_outputs(self, output_dir):
+        contents = {}
+        for fn in os.listdir(output_dir):
+            with open(os.path.join(output_dir, fn), "rb") as f:
+                data = f.read()
+            if fn.endswith(".gz"):
+                data = gzip.decompress(data)
+            contents[fn] = data
+        return contents
+
+    def check_resume(self, config, workers):
+        config = dict(config, mismatches=1, qc_stats=True)
+        expected_dir, expected = self.run_main("expected", config)
+
+        config["checkpoint_reads"] = 300
+        output_dir = os.path.join(self.temp_dir, "resumed")
+        with interrupt_after(4):
+            self.assertRaises(
+                Interrupted, self.run_main, "resumed", config,
+                "--workers", workers)
+        checkpoint_fp = os.path.join(output_dir, CHECKPOINT_FILENAME)
+        self.assertEqual(load_checkpoint(checkpoint_fp)["reads"], 900)
+        _, observed = self.run_main(
+            "resumed", config, "--workers", workers, "--resume")
+
+        self.assertFalse(os.path.exists(checkpoint_fp))
+        self.assertEqual(observed["data"], expected["data"])
+        for key in ["qc", "assigner"]:
+            observed["stats"][key].pop("build_seconds", None)
+            expected["stats"][key].pop("build_seconds", None)
+            self.assertEqual(observed["stats"][key], expected["stats"][key])
+        self.assertEqual(observed["stats"]["checkpoint"]["resumed_reads"], 900)
+        self.assertEqual(
+            observed["stats"]["run"]["reads"],
+            sum(expected["data"].values()) - 900)
+        self.assertEqual(
+            self.read_outputs(output_dir), self.read_outputs(expected_dir))
+
+    def test_resume(self):
+        self.check_resume({}, "1")
+
+    def test_resume_workers(self):
+        self.check_resume({}, "2")
+
+    def test_resume_gzip_output(self):
+        self.check_resume({"output_compression": "gzip"}, "1")
+
+    def test_resume_unassigned_max_reads(self):
+        # Some unassigned reads are written before the checkpoint, and
+        # the cap is reached after it.
+        config = {"unassigned_max_reads": 60}
+        for workers in ["1", "2"]:
+            self.check_resume(config, workers)
+            with open(os.path.join(
+                    self.temp_dir, "resumed", "unassigned_R1.fastq")) as f:
+                self.assertEqual(f.read().count("\n"), 4 * 60)
+            shutil.rmtree(os.path.join(self.temp_dir, "resumed"))
+
+    def test_resume_without_checkpoint(self):
+        expected_dir, expected = self.run_main("expected", {})
+        output_dir, observed = self.run_main("resumed", {}, "--resume")
+        self.assertEqual(observed["data"], expected["data"])
+        self.assertEqual(observed["stats"]["checkpoint"]["resumed_reads"], 0)
+        self.assertEqual(
+            self.read_outputs(output_dir), self.read_outputs(expected_dir))
+
+    def test_resume_other_inputs(self):
+        config = {"checkpoint_reads": 300}
+        with interrupt_after(2):
+            self.assertRaises(
+                Interrupted, self.run_main, "resumed", config)
+        self.fps["forward_reads"], self.fps["reverse_reads"] = (
+            self.fps["reverse_reads"], self.fps["forward_reads"])
+        self.assertRaises(
+            ValueError, self.run_main, "resumed", config, "--resume")
+
+
+if __name__ == "__main__":
+    unittest.main()
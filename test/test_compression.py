@@ -0,0 +1,118 @@
+import gzip
+from io import BytesIO
+import struct
+import unittest
+import zlib
+
+from dnabclib.compression import (
+    CompressionPool, open_input, is_bgzf,
+    )
+
+
+def bgzf_compress(data, block_size=10):
+    blocks = []
+    for i in range(0, len(data), block_size):
+        blocks.append(bgzf_block(data[i:i + block_size]))
+    # BGZF files end with an empty block
+    blocks.append(bgzf_block(b""))
+    return b"".join(blocks)
+
+
+def bgzf_block(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack(
+        "<BBBBIBBHBBHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2,
+        len(cdata) + 25)
+    trailer = struct.pack("<II", zlib.crc32(data), len(data))
+    return header + cdata + trailer
+
+
+class OpenInputTests(unittest.TestCase):
+    contents = b"@a\nACGT\n+\n####\n@b\nGGCC\n+\n####\n" * 20
+
+    def test_plain(self):
+        f = open_input(BytesIO(self.contents))
+        self.assertEqual(f.read(), self.contents)
+
+    def test_gzip(self):
+        f = open_input(BytesIO(gzip.compress(self.contents)))
+        self.assertEqual(f.read(), self.contents)
+
+    def test_multi_member_gzip(self):
+        data = gzip.compress(self.contents[:100])
+        data += gzip.compress(self.contents[100:])
+        f = open_input(BytesIO(data))
+        self.assertEqual(f.read(), self.contents)
+
+    def test_truncated_gzip(self):
+        data = gzip.compress(self.contents)[:-10]
+        f = open_input(BytesIO(data))
+        self.assertRaises(ValueError, f.read)
+
+    def test_gzip_zero_padding(self):
+        data = gzip.compress(self.contents) + b"\x00" * 512
+        f = open_input(BytesIO(data))
+        self.assertEqual(f.read(), self.contents)
+
+    def test_gzip_trailing_garbage(self):
+        data = gzip.compress(self.contents) + b"garbage"
+        f = open_input(BytesIO(data))
+        self.assertRaises(ValueError, f.read)
+
+    def test_bgzf(self):
+        data = bgzf_compress(self.contents)
+        self.assertTrue(is_bgzf(data))
+        self.assertFalse(is_bgzf(gzip.compress(self.contents)))
+        for threads in [1, 3]:
+            f = open_input(BytesIO(data), threads=threads)
+            self.assertEqual(f.read(), self.contents)
+
+    def test_corrupt_bgzf(self):
+        data = bytearray(bgzf_compress(self.contents))
+        # Flip a bit in the CRC of the first block
+        data[bgzf_block(self.contents[:10]).__len__() - 8] ^= 1
+        f = open_input(BytesIO(bytes(data)))
+        self.assertRaises(ValueError, f.read)
+
+    def test_truncated_bgzf(self):
+        data = bgzf_compress(self.contents)
+        for size in [15, 30, len(data) - 30]:
+            f = open_input(BytesIO(data[:size]))
+            self.assertRaises(ValueError, f.read)
+
+
+class ThreadedGzipWriterTests(unittest.TestCase):
+    def test_write(self):
+        pool = CompressionPool(threads=2, chunk_size=10)
+        out = BytesIO()
+        out.close = lambda: None
+        gz = pool.open(out)
+        for i in range(100):
+            gz.write(b"line %d\n" % i)
+        # Flushing does not force out a partial chunk
+        gz.flush()
+        gz.close()
+        pool.shutdown()
+        self.assertEqual(
+            gzip.decompress(out.getvalue()),
+            b"".join(b"line %d\n" % i for i in range(100)))
+        self.assertEqual(pool.buffered, 0)
+
+    def test_memory_budget(self):
+        pool = CompressionPool(threads=1, chunk_size=1000, max_buffered=50)
+        outs = [BytesIO() for _ in range(5)]
+        gzs = [pool.open(out) for out in outs]
+        for _ in range(20):
+            for gz in gzs:
+                gz.write(b"ACGT")
+                self.assertLessEqual(pool.buffered, 50)
+        for out, gz in zip(outs, gzs):
+            gz.submit()
+            gz.write_pending(wait=True)
+            self.assertEqual(gzip.decompress(out.getvalue()), b"ACGT" * 20)
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
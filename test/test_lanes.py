@@ -0,0 +1,177 @@
+import collections
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dnabclib.benchmark import make_run
+from dnabclib.lanes import find_lane_files, load_sample_sheet
+from dnabclib.main import lanes_main, main
+
+
+def records(text):
+    lines = text.split("\n")
+    return list(zip(lines[0::4], lines[1::4], lines[3::4]))
+
+
+class LaneFilesTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def touch(self, *fns):
+        for fn in fns:
+            open(os.path.join(self.temp_dir, fn), "w").close()
+
+    def test_find_lane_files(self):
+        self.touch(
+            "Undetermined_S0_L001_R1_001.fastq.gz",
+            "Undetermined_S0_L001_R2_001.fastq.gz",
+            "Undetermined_S0_L001_I1_001.fastq.gz",
+            "Undetermined_S0_L002_R1_001.fastq",
+            "Undetermined_S0_L002_R2_001.fastq",
+            "Sample1_S1_L001_R1_001.fastq.gz",
+            "notes.txt")
+        lanes = find_lane_files(self.temp_dir)
+        self.assertEqual(sorted(lanes), [1, 2])
+        self.assertEqual(sorted(lanes[1]), ["I1", "R1", "R2"])
+        self.assertEqual(sorted(lanes[2]), ["R1", "R2"])
+        self.assertEqual(
+            lanes[2]["R2"],
+            os.path.join(self.temp_dir, "Undetermined_S0_L002_R2_001.fastq"))
+
+    def test_find_lane_files_missing_reads(self):
+        self.touch("Undetermined_S0_L003_R1_001.fastq")
+        self.assertRaises(ValueError, find_lane_files, self.temp_dir)
+
+    def test_load_sample_sheet(self):
+        sheet = StringIO(
+            "[Data]\n"
+            "FCID,Lane,SampleID,SampleRef,Index,Description\n"
+            "FC1,1,Sample A,hg19,ACGTACGT-TTGGCCAA,\n"
+            "FC1,1,SampleB,hg19,AAAACCCC-GGGGTTTT,\n"
+            "FC1,2,SampleA,hg19,ACGTACGT-TTGGCCAA,\n"
+            "\n")
+        lanes = load_sample_sheet(sheet)
+        self.assertEqual(sorted(lanes), [1, 2])
+        self.assertEqual(
+            [(s.name, s.barcode) for s in lanes[1]],
+            [("SampleA", "ACGTACGTTTGGCCAA"), ("SampleB", "AAAACCCCGGGGTTTT")])
+
+    def test_load_sample_sheet_duplicates(self):
+        sheet = StringIO(
+            "FC1,1,SampleA,hg19,ACGTACGT,\n"
+            "FC1,1,SampleA,hg19,AAAACCCC,\n")
+        self.assertRaises(ValueError, load_sample_sheet, sheet)
+
+
+class LanesMainTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.temp_dir, "input")
+        os.mkdir(self.input_dir)
+        sheet_rows = ["FCID,Lane,SampleID,SampleRef,Index,Description"]
+        self.barcode_fps = {}
+        for lane, seed in [(1, 0), (2, 1)]:
+            run_dir = os.path.join(self.temp_dir, "run%d" % lane)
+            os.mkdir(run_dir)
+            fps = make_run(
+                run_dir, reads=500, read_length=20, samples=4,
+                barcode_length=8, seed=seed)
+            for key, read in [
+                    ("forward_reads", "R1"), ("reverse_reads", "R2"),
+                    ("index_reads", "I1")]:
+                os.rename(fps[key], os.path.join(
+                    self.input_dir,
+                    "Undetermined_S0_L%03d_%s_001.fastq" % (lane, read)))
+            with open(fps["barcode_file"]) as f:
+                for line in f:
+                    name, barcode = line.split()
+                    sheet_rows.append(
+                        "FC1,%d,%s,hg19,%s," % (lane, name, barcode))
+            self.barcode_fps[lane] = fps["barcode_file"]
+        self.sheet_fp = os.path.join(self.temp_dir, "SampleSheet.csv")
+        with open(self.sheet_fp, "w") as f:
+            f.write("\n".join(sheet_rows) + "\n")
+        self.output_dir = os.path.join(self.temp_dir, "output")
+        self.summary_fp = os.path.join(self.temp_dir, "summary.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_lanes(self, *args):
+        lanes_main([
+            "--sample-sheet", self.sheet_fp,
+            "--input-dir", self.input_dir,
+            "--output-dir", self.output_dir,
+            "--summary-file", self.summary_fp,
+            ] + list(args))
+        with open(self.summary_fp) as f:
+            return json.load(f)
+
+    def run_lane(self, lane):
+        output_dir = os.path.join(self.temp_dir, "lane%d" % lane)
+        summary_fp = os.path.join(self.temp_dir, "lane%d.json" % lane)
+        fp = os.path.join(
+            self.input_dir, "Undetermined_S0_L%03d_%%s_001.fastq" % lane)
+        main([
+            "--forward-reads", fp % "R1",
+            "--reverse-reads", fp % "R2",
+            "--index-reads", fp % "I1",
+            "--barcode-file", self.barcode_fps[lane],
+            "--output-dir", output_dir,
+            "--summary-file", summary_fp,
+            ])
+        with open(summary_fp) as f:
+            return output_dir, json.load(f)["data"]
+
+    def read_dir(self, output_dir):
+        contents = {}
+        for fn in os.listdir(output_dir):
+            with open(os.path.join(output_dir, fn)) as f:
+                contents[fn] = f.read()
+        return contents
+
+    def test_lanes(self):
+        expected = dict((lane, self.run_lane(lane)) for lane in [1, 2])
+        for workers in ["1", "2"]:
+            res = self.run_lanes("--workers", workers)
+            total = collections.Counter()
+            for lane, (lane_dir, counts) in expected.items():
+                lane_stats = res["stats"]["lanes"][str(lane)]
+                self.assertEqual(lane_stats["data"], counts)
+                self.assertEqual(
+                    self.read_dir(
+                        os.path.join(self.output_dir, "L%03d" % lane)),
+                    self.read_dir(lane_dir))
+                total.update(counts)
+            self.assertEqual(res["data"], dict(total))
+            self.assertEqual(res["stats"]["run"]["reads"], 1000)
+            shutil.rmtree(self.output_dir)
+
+    def test_merge_lanes(self):
+        expected = dict((lane, self.run_lane(lane)) for lane in [1, 2])
+        res = self.run_lanes(
+            "--merge-lanes", "--workers", "2", "--lanes", "1", "2")
+        self.assertIn("writer", res["stats"])
+        merged = self.read_dir(self.output_dir)
+        lane_dirs = [self.read_dir(expected[lane][0]) for lane in [1, 2]]
+        self.assertEqual(
+            sorted(merged), sorted(set(lane_dirs[0]) | set(lane_dirs[1])))
+        for fn, text in merged.items():
+            # Each sample's reads from both lanes are in one file
+            self.assertEqual(
+                sorted(records(text)),
+                sorted(records(lane_dirs[0].get(fn, "")) +
+                       records(lane_dirs[1].get(fn, ""))))
+
+    def test_missing_lane(self):
+        self.assertRaises(SystemExit, self.run_lanes, "--lanes", "3")
+
+
+if __name__ == "__main__":
+    unittest.main()
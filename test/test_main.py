@@ -1,11 +1,13 @@
+import gzip
 import json
 import os
+import pstats
 import shutil
 import tempfile
 import unittest
 
 from dnabclib.main import (
-    main, get_config, get_sample_names_main,
+    main, get_config, get_sample_names_main, make_writer,
 )
 
 
@@ -26,6 +28,20 @@ class ConfigTests(unittest.TestCase):
         config = get_config(None)
         self.assertEqual(config["output_format"], u"SOMECRAZYVALUE")
 
+    def test_make_writer_share(self):
+        config = get_config(None)
+        config.update({
+            "output_compression": "gzip", "compress_threads": 4,
+            "write_buffer_mb": 64, "compress_buffer_mb": 256,
+            "max_open_files": 100,
+            })
+        w = make_writer(config, self.temp_home_dir, share=4)
+        self.assertEqual(w.max_buffered, 16 << 20)
+        self.assertEqual(w._pool.max_buffered, 64 << 20)
+        self.assertEqual(w.max_open_files, 25)
+        self.assertEqual(w._pool._executor._max_workers, 1)
+        w.close()
+
 
 class FastqDemultiplexTests(unittest.TestCase):
     def setUp(self):
@@ -80,6 +96,265 @@ class FastqDemultiplexTests(unittest.TestCase):
             res = json.load(f)
             self.assertEqual(res["data"], {"SampleA": 1, "SampleB": 1, "unassigned":1})
 
+    def test_run_stats_and_profile(self):
+        profile_fp = os.path.join(self.temp_dir, "dnabc.prof")
+        main([
+            "--forward-reads", self.forward_fp,
+            "--reverse-reads", self.reverse_fp,
+            "--index-reads", self.index_fp,
+            "--barcode-file", self.barcode_fp,
+            "--output-dir", self.output_dir,
+            "--summary-file", self.summary_fp,
+            "--profile", profile_fp,
+            ])
+        with open(self.summary_fp) as f:
+            run = json.load(f)["stats"]["run"]
+        self.assertEqual(run["reads"], 3)
+        self.assertEqual(
+            run["bytes_read"],
+            sum(os.path.getsize(fp) for fp in [
+                self.forward_fp, self.reverse_fp, self.index_fp]))
+        self.assertGreater(run["peak_rss_bytes"], 0)
+        self.assertEqual(
+            list(run["stages"]), ["parse", "assign", "write", "close"])
+        self.assertEqual(run["stages"]["assign"]["batches"], 1)
+        stats = pstats.Stats(profile_fp)
+        self.assertTrue(stats.total_calls)
+
+    def test_workers(self):
+        main([
+            "--forward-reads", self.forward_fp,
+            "--reverse-reads", self.reverse_fp,
+            "--index-reads", self.index_fp,
+            "--barcode-file", self.barcode_fp,
+            "--output-dir", self.output_dir,
+            "--summary-file", self.summary_fp,
+            "--workers", "2",
+            ])
+        with open(self.summary_fp) as f:
+            res = json.load(f)
+            self.assertEqual(res["data"], {"SampleA": 1, "SampleB": 1, "unassigned":1})
+            top = res["stats"]["assigner"]["unassigned_barcodes"]
+            self.assertEqual([x["count"] for x in top], [1])
+        fp = os.path.join(self.output_dir, "SampleB_R2.fastq")
+        with open(fp) as f:
+            self.assertEqual(
+                f.read(), "@a\nCATACGACGACTACGACTCAG\n+\nkjfhda987123GA;,.;,..\n")
+
+    def test_gzip_output(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({"output_compression": "gzip"}, f)
+        main([
+            "--forward-reads", self.forward_fp,
+            "--reverse-reads", self.reverse_fp,
+            "--index-reads", self.index_fp,
+            "--barcode-file", self.barcode_fp,
+            "--output-dir", self.output_dir,
+            "--summary-file", self.summary_fp,
+            "--config-file", config_fp,
+            ])
+        fp = os.path.join(self.output_dir, "SampleB_R1.fastq.gz")
+        with gzip.open(fp, "rt") as f:
+            self.assertEqual(
+                f.read(), "@a\nGACTGCAGACGACTACGACGT\n+\n8A7T4C2G3CkAjThCeArG;\n")
+        with open(self.summary_fp) as f:
+            res = json.load(f)
+        self.assertEqual(res["config"]["output_compression"], "gzip")
+        self.assertEqual(res["stats"]["writer"]["reopens"], 0)
+
+    def test_min_index_quality(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({"min_index_quality": 20}, f)
+        main([
+            "--forward-reads", self.forward_fp,
+            "--reverse-reads", self.reverse_fp,
+            "--index-reads", self.index_fp,
+            "--barcode-file", self.barcode_fp,
+            "--output-dir", self.output_dir,
+            "--summary-file", self.summary_fp,
+            "--config-file", config_fp,
+            ])
+        with open(self.summary_fp) as f:
+            res = json.load(f)
+        # The index read for SampleB has a base with quality 16
+        self.assertEqual(
+            res["data"], {"SampleA": 1, "SampleB": 0, "unassigned": 2})
+        self.assertEqual(res["stats"]["assigner"]["quality_rejected"], 1)
+
+    def test_mmap_input(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({"mmap_input": True}, f)
+        main([
+            "--forward-reads", self.forward_fp,
+            "--reverse-reads", self.reverse_fp,
+            "--index-reads", self.index_fp,
+            "--barcode-file", self.barcode_fp,
+            "--output-dir", self.output_dir,
+            "--summary-file", self.summary_fp,
+            "--config-file", config_fp,
+            ])
+        with open(self.summary_fp) as f:
+            res = json.load(f)
+        self.assertEqual(
+            res["data"], {"SampleA": 1, "SampleB": 1, "unassigned": 1})
+        self.assertEqual(
+            res["stats"]["run"]["bytes_read"],
+            sum(os.path.getsize(fp) for fp in [
+                self.forward_fp, self.reverse_fp, self.index_fp]))
+
+    def test_interleaved_output(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({"output_format": "interleaved_fastq"}, f)
+        for workers in ["1", "2"]:
+            main([
+                "--forward-reads", self.forward_fp,
+                "--reverse-reads", self.reverse_fp,
+                "--index-reads", self.index_fp,
+                "--barcode-file", self.barcode_fp,
+                "--output-dir", self.output_dir,
+                "--summary-file", self.summary_fp,
+                "--config-file", config_fp,
+                "--workers", workers,
+                ])
+            self.assertEqual(
+                sorted(os.listdir(self.output_dir)),
+                ["SampleA.fastq", "SampleB.fastq"])
+            with open(os.path.join(self.output_dir, "SampleB.fastq")) as f:
+                self.assertEqual(f.read(), (
+                    "@a\nGACTGCAGACGACTACGACGT\n+\n8A7T4C2G3CkAjThCeArG;\n"
+                    "@a\nCATACGACGACTACGACTCAG\n+\nkjfhda987123GA;,.;,..\n"))
+
+    def test_output_chunks(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({"output_chunk_reads": 1}, f)
+        with open(self.index_fp, "a") as f:
+            f.write("@d\nCCTTCCTT\n+\nkjafd;;;\n")
+        with open(self.forward_fp, "a") as f:
+            f.write("@d\nACGT\n+\n####\n")
+        with open(self.reverse_fp, "a") as f:
+            f.write("@d\nTTTT\n+\n####\n")
+        manifests = []
+        for workers in ["1", "2"]:
+            main([
+                "--forward-reads", self.forward_fp,
+                "--reverse-reads", self.reverse_fp,
+                "--index-reads", self.index_fp,
+                "--barcode-file", self.barcode_fp,
+                "--output-dir", self.output_dir,
+                "--summary-file", self.summary_fp,
+                "--config-file", config_fp,
+                "--workers", workers,
+                ])
+            with open(self.summary_fp) as f:
+                res = json.load(f)
+            manifests.append(res["manifest"])
+            chunks = res["manifest"]["SampleA"]
+            self.assertEqual([c["reads"] for c in chunks], [1, 1])
+            with open(chunks[1]["files"][0]) as f:
+                self.assertEqual(f.read(), "@d\nACGT\n+\n####\n")
+        self.assertEqual(manifests[0], manifests[1])
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)), [
+                "SampleA_R1_001.fastq", "SampleA_R1_002.fastq",
+                "SampleA_R2_001.fastq", "SampleA_R2_002.fastq",
+                "SampleB_R1_001.fastq", "SampleB_R2_001.fastq"])
+
+    def test_barcode_cache(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({
+                "barcode_cache_dir": os.path.join(self.temp_dir, "cache"),
+                "mismatches": 1}, f)
+        for cached in [False, True]:
+            main([
+                "--forward-reads", self.forward_fp,
+                "--reverse-reads", self.reverse_fp,
+                "--index-reads", self.index_fp,
+                "--barcode-file", self.barcode_fp,
+                "--output-dir", self.output_dir,
+                "--summary-file", self.summary_fp,
+                "--config-file", config_fp,
+                ])
+            with open(self.summary_fp) as f:
+                res = json.load(f)
+            self.assertEqual(
+                res["data"], {"SampleA": 1, "SampleB": 1, "unassigned": 1})
+            self.assertEqual(res["stats"]["assigner"]["cached"], cached)
+
+    def test_unassigned_output(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({"unassigned_max_reads": 5}, f)
+        for workers in ["1", "2"]:
+            main([
+                "--forward-reads", self.forward_fp,
+                "--reverse-reads", self.reverse_fp,
+                "--index-reads", self.index_fp,
+                "--barcode-file", self.barcode_fp,
+                "--output-dir", self.output_dir,
+                "--summary-file", self.summary_fp,
+                "--config-file", config_fp,
+                "--workers", workers,
+                ])
+            fp = os.path.join(self.output_dir, "unassigned_R2.fastq")
+            with open(fp) as f:
+                self.assertEqual(
+                    f.read(), "@b\nGTNNNNNNNNNNNNNNNNNNN\n+\n"
+                    "#####################\n")
+            with open(self.summary_fp) as f:
+                res = json.load(f)
+            self.assertEqual(res["data"]["unassigned"], 1)
+            self.assertEqual(res["stats"]["writer"]["unassigned_written"], 1)
+
+    def test_qc_stats(self):
+        config_fp = os.path.join(self.temp_dir, "config.json")
+        with open(config_fp, "w") as f:
+            json.dump({"qc_stats": True}, f)
+        results = []
+        for workers in ["1", "2"]:
+            main([
+                "--forward-reads", self.forward_fp,
+                "--reverse-reads", self.reverse_fp,
+                "--index-reads", self.index_fp,
+                "--barcode-file", self.barcode_fp,
+                "--output-dir", self.output_dir,
+                "--summary-file", self.summary_fp,
+                "--config-file", config_fp,
+                "--workers", workers,
+                ])
+            with open(self.summary_fp) as f:
+                results.append(json.load(f)["stats"]["qc"])
+        self.assertEqual(results[0], results[1])
+        qc = results[0]
+        self.assertEqual(
+            qc["SampleB"]["R1"]["length_histogram"], {"21": 1})
+        self.assertEqual(qc["SampleB"]["R2"]["gc_fraction"], 11.0 / 21)
+        self.assertEqual(qc["unassigned"]["R2"]["n_fraction"], 19.0 / 21)
+
+    def test_gzip_input(self):
+        gzip_fps = []
+        for fp in [self.forward_fp, self.reverse_fp, self.index_fp]:
+            with open(fp, "rb") as f_in:
+                with gzip.open(fp + ".gz", "wb") as f_out:
+                    f_out.write(f_in.read())
+            gzip_fps.append(fp + ".gz")
+        main([
+            "--forward-reads", gzip_fps[0],
+            "--reverse-reads", gzip_fps[1],
+            "--index-reads", gzip_fps[2],
+            "--barcode-file", self.barcode_fp,
+            "--output-dir", self.output_dir,
+            "--summary-file", self.summary_fp,
+            ])
+        with open(self.summary_fp) as f:
+            res = json.load(f)
+            self.assertEqual(res["data"], {"SampleA": 1, "SampleB": 1, "unassigned":1})
+
 
 class SampleNameTests(unittest.TestCase):
     def test_get_sample_names_main(self):
@@ -0,0 +1,83 @@
+import gzip
+from io import BytesIO
+import os
+import shutil
+import tempfile
+import unittest
+
+from dnabclib import make_index
+from dnabclib.make_index import (
+    reverse_complement, index_blocks, write_index, main,
+    )
+from dnabclib.seqfile import parse_fastq
+
+READS = (
+    b"@M03543:47:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGTN\n"
+    b"GGGGGGGGGG\n+\nIIIIIIIIII\n"
+    b"@M03543:47:C8LJ2ANXX:1:2209:1085:2044 1:N:0:AACCG\n"
+    b"TTTTTTTTTT\n+\nIIIIIIIIII\n"
+    b"@M03543:47:C8LJ2ANXX:1:2209:1086:2044 1:N:0:ACGTN\n"
+    b"CCCCCCCCCC\n+\nIIIIIIIIII\n")
+
+INDEX = (
+    "@M03543:47:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGTN\nNACGT\n+\nEEEEE\n"
+    "@M03543:47:C8LJ2ANXX:1:2209:1085:2044 1:N:0:AACCG\nCGGTT\n+\nEEEEE\n"
+    "@M03543:47:C8LJ2ANXX:1:2209:1086:2044 1:N:0:ACGTN\nNACGT\n+\nEEEEE\n")
+
+
+class MakeIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_reverse_complement(self):
+        self.assertEqual(reverse_complement("AACGTN"), "NACGTT")
+        self.assertEqual(reverse_complement("AC GT"), "ACGT")
+        self.assertRaises(ValueError, reverse_complement, "ACGX")
+
+    def test_index_blocks(self):
+        self.assertEqual("".join(index_blocks(BytesIO(READS))), INDEX)
+        # Records split across blocks
+        self.assertEqual(
+            "".join(index_blocks(BytesIO(READS), block_size=7)), INDEX)
+
+    def test_write_index(self):
+        out = BytesIO()
+        self.assertEqual(write_index(BytesIO(gzip.compress(READS)), out), 2)
+        self.assertEqual(out.getvalue().decode(), INDEX)
+
+    def test_max_cached_barcodes(self):
+        old_max = make_index.MAX_CACHED_BARCODES
+        make_index.MAX_CACHED_BARCODES = 1
+        try:
+            out = BytesIO()
+            self.assertEqual(write_index(BytesIO(READS), out), 1)
+        finally:
+            make_index.MAX_CACHED_BARCODES = old_max
+        self.assertEqual(out.getvalue().decode(), INDEX)
+
+    def test_bad_record(self):
+        out = BytesIO()
+        self.assertRaises(
+            ValueError, write_index, BytesIO(READS[1:]), out)
+
+    def test_main(self):
+        reads_fp = os.path.join(self.temp_dir, "reads.fastq.gz")
+        with open(reads_fp, "wb") as f:
+            f.write(gzip.compress(READS))
+        for fn in ["index.fastq", "index.fastq.gz"]:
+            out_fp = os.path.join(self.temp_dir, fn)
+            main(["--reads", reads_fp, "--output", out_fp])
+            with open(out_fp, "rb") as f:
+                data = f.read()
+            if fn.endswith(".gz"):
+                data = gzip.decompress(data)
+            self.assertEqual(data.decode(), INDEX)
+            reads = list(parse_fastq(BytesIO(data)))
+            self.assertEqual(reads[1].seq, "CGGTT")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+from io import StringIO
+import os
+import shutil
+import tempfile
+import unittest
+
+from dnabclib.assigner import BarcodeAssigner
+from dnabclib.parallel import demultiplex_parallel
+from dnabclib.sample import Sample
+from dnabclib.seqfile import (
+    IndexFastqSequenceFile, NoIndexFastqSequenceFile,
+    )
+from dnabclib.writer import PairedFastqWriter
+
+
+def make_fastq(n, seq_fn):
+    return "".join(
+        "@read%d\n%s\n+\n%s\n" % (i, seq_fn(i), "#" * len(seq_fn(i)))
+        for i in range(n))
+
+
+class DemultiplexParallelTests(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.serial_dir = os.path.join(self.output_dir, "serial")
+        self.parallel_dir = os.path.join(self.output_dir, "parallel")
+        os.mkdir(self.serial_dir)
+        os.mkdir(self.parallel_dir)
+        self.barcodes = ["AAAA", "CCCC", "GGGG"]
+        self.samples = [
+            Sample("S%d" % i, bc) for i, bc in enumerate(self.barcodes)]
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _compare(self, seq_file_fn):
+        # Serial and parallel runs give the same counts and files
+        a1 = BarcodeAssigner(self.samples, revcomp=False)
+        w1 = PairedFastqWriter(self.serial_dir)
+        exp_counts = seq_file_fn().demultiplex(a1, w1)
+        w1.close()
+
+        a2 = BarcodeAssigner(self.samples, revcomp=False)
+        w2 = PairedFastqWriter(self.parallel_dir)
+        obs_counts = demultiplex_parallel(
+            seq_file_fn(), a2, w2, workers=2, chunk_reads=7)
+        w2.close()
+
+        self.assertEqual(obs_counts, exp_counts)
+        self.assertEqual(sum(obs_counts.values()), 100)
+        for fn in sorted(os.listdir(self.serial_dir)):
+            with open(os.path.join(self.serial_dir, fn)) as f:
+                exp = f.read()
+            with open(os.path.join(self.parallel_dir, fn)) as f:
+                self.assertEqual(f.read(), exp)
+        self.assertEqual(
+            sorted(os.listdir(self.serial_dir)),
+            sorted(os.listdir(self.parallel_dir)))
+
+    def test_index_file(self):
+        idx = make_fastq(100, lambda i: (self.barcodes + ["TTTT"])[i % 4])
+        fwd = make_fastq(100, lambda i: "ACGT" * (i % 5 + 1))
+        rev = make_fastq(100, lambda i: "TTGA" * (i % 3 + 1))
+        self._compare(lambda: IndexFastqSequenceFile(
+            StringIO(fwd), StringIO(rev), StringIO(idx)))
+
+    def test_no_index_file(self):
+        desc_fwd = "".join(
+            "@read%d 1:N:0:%s\nACGT\n+\n####\n" % (
+                i, (self.barcodes + ["TTTT"])[i % 4])
+            for i in range(100))
+        rev = make_fastq(100, lambda i: "TTGA" * (i % 3 + 1))
+        self._compare(lambda: NoIndexFastqSequenceFile(
+            StringIO(desc_fwd), StringIO(rev)))
+
+
+if __name__ == "__main__":
+    unittest.main()
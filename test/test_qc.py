@@ -0,0 +1,58 @@
+import collections
+import unittest
+
+from dnabclib.qc import ReadQC
+from dnabclib.seqfile import FastqRead
+
+MockSample = collections.namedtuple("MockSample", "name barcode")
+
+
+class ReadQCTests(unittest.TestCase):
+    def setUp(self):
+        self.a = MockSample("A", "AAAA")
+        self.b = MockSample("B", "CCCC")
+
+    def test_add_batch(self):
+        qc = ReadQC([self.a, self.b])
+        fwds = [
+            FastqRead("r1", "ACGN", "IIII"),
+            FastqRead("r2", "GG", "##"),
+            FastqRead("r3", "AAAAA", "+++++"),
+            ]
+        revs = [FastqRead(r.desc, "TT", "II") for r in fwds]
+        qc.add_batch([self.a, self.a, None], fwds, revs)
+        stats = qc.get_stats()
+        r1 = stats["A"]["R1"]
+        self.assertEqual(r1["reads"], 2)
+        self.assertEqual(r1["length_histogram"], {"2": 1, "4": 1})
+        # Quality 40 for "I", 2 for "#"
+        self.assertEqual(r1["mean_quality"], [21.0, 21.0, 40.0, 40.0])
+        self.assertAlmostEqual(r1["gc_fraction"], 4.0 / 6)
+        self.assertAlmostEqual(r1["n_fraction"], 1.0 / 6)
+        self.assertEqual(stats["A"]["R2"]["length_histogram"], {"2": 2})
+        self.assertEqual(stats["B"]["R1"]["reads"], 0)
+        self.assertEqual(stats["B"]["R1"]["mean_quality"], [])
+        self.assertEqual(stats["unassigned"]["R1"]["mean_quality"], [10.0] * 5)
+
+    def test_max_length(self):
+        qc = ReadQC([self.a], mates=1, max_length=3)
+        qc.add_batch([self.a], [FastqRead("r1", "ACGTA", "IIII#")])
+        stats = qc.get_stats()["A"]["R1"]
+        self.assertEqual(stats["length_histogram"], {"3": 1})
+        self.assertEqual(stats["mean_quality"], [40.0] * 3)
+
+    def test_merge_counts(self):
+        qc1 = ReadQC([self.a], mates=1)
+        qc2 = ReadQC([self.a], mates=1)
+        qc1.add_batch([self.a], [FastqRead("r1", "ACG", "III")])
+        qc2.add_batch([self.a], [FastqRead("r2", "ACGT", "####")])
+        qc1.merge_counts(qc2.get_counts())
+        stats = qc1.get_stats()["A"]["R1"]
+        self.assertEqual(stats["length_histogram"], {"3": 1, "4": 1})
+        self.assertEqual(stats["mean_quality"], [21.0, 21.0, 21.0, 2.0])
+        qc2.reset_counts()
+        self.assertEqual(qc2.get_stats()["A"]["R1"]["reads"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
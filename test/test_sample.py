@@ -7,6 +7,14 @@ class SampleTests(unittest.TestCase):
     def test_prefixes(self):
         s = Sample("a", "agct")
         self.assertEqual(s.barcode, "AGCT")
+        self.assertEqual(s.barcodes, ("AGCT",))
+
+    def test_dual_index(self):
+        s = Sample("a", "acgt-ttgg")
+        self.assertEqual(s.barcode, "ACGTTTGG")
+        self.assertEqual(s.barcodes, ("ACGT", "TTGG"))
+        s = Sample("a", "ACGT+TTGG")
+        self.assertEqual(s.barcodes, ("ACGT", "TTGG"))
 
 
 if __name__ == "__main__":
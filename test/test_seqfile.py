@@ -1,13 +1,19 @@
 import collections
-from io import StringIO
+import gzip
+from io import BytesIO, StringIO
 import os.path
 import shutil
 import tempfile
 import unittest
 
 from dnabclib.seqfile import (
-    IndexFastqSequenceFile, NoIndexFastqSequenceFile, parse_fastq,
+    FastqRead, IndexFastqSequenceFile, NoIndexFastqSequenceFile,
+    can_mmap, parse_fastq, parse_fastq_batches, parse_fastq_lines,
+    parse_fastq_records, read_record_chunks, use_passthrough,
     )
+from dnabclib.qc import ReadQC
+from dnabclib.timing import StageTimer
+from dnabclib.writer import PairedFastqWriter
 from dnabclib.assigner import BarcodeAssigner
 
 
@@ -56,6 +62,50 @@ class IndexFastqSequenceFileTests(unittest.TestCase):
         self.assertEqual(r2.seq, "GTNNNNNNNNNNNNNNNNNNN")
         self.assertEqual(r2.qual, "#####################")
 
+    def test_demultiplex_reader_threads(self):
+        fastqs = [fastq_with_barcode_fwd, fastq_with_barcode_rev, fastq1]
+        s1 = MockSample("SampleS1", "GCTNNNNNNNNNNNNNNN")
+        written = []
+        for reader_threads in [False, True]:
+            x = IndexFastqSequenceFile(
+                *map(StringIO, fastqs), reader_threads=reader_threads)
+            w = MockWriter()
+            a = BarcodeAssigner([s1], mismatches=0, revcomp=False)
+            timer = StageTimer()
+            x.demultiplex(a, w, timer)
+            written.append(w.written)
+        self.assertEqual(written[0], written[1])
+        self.assertEqual(len(written[1]["SampleS1"]), 1)
+        self.assertEqual(len(written[1][None]), 1)
+        stats = timer.get_stats()
+        # The shortest file ends the run
+        self.assertEqual(stats["parse_I1"]["reads"], 2)
+        self.assertEqual(stats["write"]["reads"], 2)
+
+        # Errors in a reader thread are raised in the main thread
+        x = IndexFastqSequenceFile(
+            StringIO(fastq_with_barcode_fwd), StringIO("@a\nACG\n+\n#\n"),
+            StringIO(fastq_with_barcode_fwd), reader_threads=True)
+        self.assertRaises(ValueError, x.demultiplex, a, MockWriter())
+
+    def test_demultiplex_uneven_batches(self):
+        # Batches from each file hold different numbers of records
+        reads = [FastqRead("r%d" % n, "ACGT", "####") for n in range(10)]
+        idxs = [FastqRead("r%d" % n, "AAAA" if n % 3 else "CCCC", "####")
+                for n in range(9)]
+        batches = [
+            [idxs[:2], idxs[2:7], idxs[7:]],
+            [reads[:5], reads[5:]],
+            [reads[:1], reads[1:4], reads[4:8], reads[8:]],
+            ]
+        w = MockWriter()
+        s1 = MockSample("SampleS1", "CCCC")
+        a = BarcodeAssigner([s1], mismatches=0, revcomp=False)
+        IndexFastqSequenceFile.demultiplex_reads(a, w, batches)
+        self.assertEqual(
+            [r1[0] for r1, _ in w.written["SampleS1"]], ["r0", "r3", "r6"])
+        self.assertEqual(len(w.written[None]), 6)
+
 
 class NoIndexFastqSequenceFileTests(unittest.TestCase):
     def test_demultiplex(self):
@@ -96,6 +146,53 @@ class NoIndexFastqSequenceFileTests(unittest.TestCase):
             "11?:=FDEGBGGGG/EB<==@DDFGBEGC00C:>>D.FCG<CDGGGBGGBGGE=E..DGGE/C")
 
 
+class PassthroughTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def demultiplex(self, qc=None):
+        output_dir = os.path.join(self.temp_dir, "qc" if qc else "raw")
+        os.mkdir(output_dir)
+        x = NoIndexFastqSequenceFile(
+            StringIO(fastq_with_barcode_fwd), StringIO(fastq_with_barcode_rev))
+        s1 = MockSample("SampleS1", "GTTTCGCCCTAGTACA")
+        a = BarcodeAssigner([s1], mismatches=0, revcomp=False)
+        w = PairedFastqWriter(output_dir)
+        x.demultiplex(a, w, qc=qc)
+        w.close()
+        with open(os.path.join(output_dir, "SampleS1_R1.fastq")) as f:
+            return f.read()
+
+    def test_demultiplex_passthrough(self):
+        self.assertTrue(use_passthrough(PairedFastqWriter(self.temp_dir)))
+        # The same output as when reads are parsed and formatted again
+        qc = ReadQC([MockSample("SampleS1", "GTTTCGCCCTAGTACA")])
+        self.assertFalse(use_passthrough(PairedFastqWriter(self.temp_dir), qc))
+        obs = self.demultiplex()
+        self.assertEqual(obs, self.demultiplex(qc))
+        self.assertTrue(obs.startswith(
+            "@HWI-D00727:9:C6JHHANXX:8:1101:1786:2183 1:N:0:GTTTCGCCCTAGTACA"
+            "\nACAATCAACC"))
+
+    def test_parse_fastq_records(self):
+        records = [
+            r for b in parse_fastq_records(StringIO(fastq_with_barcode_fwd))
+            for r in b]
+        self.assertEqual(records, [
+            "@%s\n%s\n+\n%s\n" % r
+            for r in parse_fastq(StringIO(fastq_with_barcode_fwd))])
+        # Records are kept as they are, apart from line endings
+        obs = list(parse_fastq_records(
+            StringIO("@a x \r\nACG \r\n+a\r\n###\r\n")))
+        self.assertEqual(obs, [["@a x \nACG \n+a\n###\n"]])
+        self.assertRaises(
+            ValueError, list,
+            parse_fastq_records(StringIO("@a\nACG\n+\n##\n")))
+
+
 class FunctionTests(unittest.TestCase):
     def test_parse_fastq(self):
         obs = parse_fastq(StringIO(fastq1))
@@ -105,6 +202,147 @@ class FunctionTests(unittest.TestCase):
             "Seq2:with spaces", "GCTNNNNNNNNNNNNNNN", "##################"))
         self.assertRaises(StopIteration, next, obs)
 
+    def test_parse_fastq_small_blocks(self):
+        # Records are split across many block boundaries
+        exp = list(parse_fastq(StringIO(fastq_with_barcode_fwd)))
+        for block_size in [1, 7, 100]:
+            f = BytesIO(fastq_with_barcode_fwd.encode("ascii"))
+            obs = list(parse_fastq(f, block_size=block_size))
+            self.assertEqual(obs, exp)
+        self.assertEqual(len(exp), 5)
+
+    def test_parse_fastq_lines(self):
+        exp = list(parse_fastq(StringIO(fastq_with_barcode_fwd)))
+        for block_size in [7, 100]:
+            for line, field in [(0, "desc"), (1, "seq")]:
+                f = BytesIO(fastq_with_barcode_fwd.encode("ascii"))
+                obs = parse_fastq_lines(f, line, block_size=block_size)
+                self.assertEqual(
+                    [x for batch in obs for x in batch],
+                    [getattr(read, field) for read in exp])
+        f = StringIO("@a\nACGT\n+\n####\nb\nACGT\n+\n####\n")
+        self.assertRaises(ValueError, list, parse_fastq_lines(f, 1))
+
+    def test_parse_fastq_batches(self):
+        f = BytesIO(fastq1.encode("ascii"))
+        obs = list(parse_fastq_batches(f))
+        self.assertEqual(len(obs), 1)
+        self.assertEqual([r.desc for r in obs[0]], ["YesYes", "Seq2:with spaces"])
+
+    def test_parse_fastq_crlf_no_final_newline(self):
+        f = StringIO("@a\r\nACG\r\n+\r\n###\r\n@b\nTT\n+\n##")
+        obs = list(parse_fastq(f, block_size=5))
+        self.assertEqual(obs, [("a", "ACG", "###"), ("b", "TT", "##")])
+
+    def test_parse_fastq_trailing_whitespace(self):
+        f = StringIO("@a \nACG \n+\n###\t\n")
+        self.assertEqual(list(parse_fastq(f)), [("a", "ACG", "###")])
+
+    def test_parse_fastq_trailing_blank_lines(self):
+        for n_blank in range(1, 9):
+            contents = "@a\nACG\n+\n###\n" + "\n" * n_blank
+            for block_size in [3, 1000]:
+                obs = parse_fastq(StringIO(contents), block_size=block_size)
+                self.assertEqual(list(obs), [("a", "ACG", "###")])
+
+    def test_parse_fastq_empty_sequence(self):
+        f = StringIO("@a\nACG\n+\n###\n@b\n\n+\n\n")
+        for block_size in [3, 1000]:
+            obs = parse_fastq(f, block_size=block_size)
+            self.assertEqual(list(obs), [("a", "ACG", "###"), ("b", "", "")])
+            f.seek(0)
+
+    def test_read_record_chunks(self):
+        fwd = BytesIO(fastq_with_barcode_fwd.encode("ascii"))
+        rev = StringIO(fastq_with_barcode_rev)
+        chunks = list(read_record_chunks([fwd, rev], 2, block_size=50))
+        self.assertEqual([len(c) for c in chunks], [2, 2, 2])
+        obs_fwd = [r for c in chunks for r in parse_fastq(BytesIO(c[0]))]
+        obs_rev = [r for c in chunks for r in parse_fastq(StringIO(c[1]))]
+        self.assertEqual(
+            obs_fwd, list(parse_fastq(StringIO(fastq_with_barcode_fwd))))
+        self.assertEqual(
+            obs_rev, list(parse_fastq(StringIO(fastq_with_barcode_rev))))
+        self.assertEqual(len(obs_fwd), 5)
+        # Records are aligned between files in every chunk
+        for fwd_chunk, rev_chunk in chunks:
+            fwd_ids = [r.desc.split()[0] for r in parse_fastq(BytesIO(fwd_chunk))]
+            rev_ids = [r.desc.split()[0] for r in parse_fastq(StringIO(rev_chunk))]
+            self.assertEqual(fwd_ids, rev_ids)
+
+    def test_read_record_chunks_offsets(self):
+        fwd = fastq_with_barcode_fwd.encode("ascii")
+        rev = fastq_with_barcode_rev
+        first = next(read_record_chunks([BytesIO(fwd), StringIO(rev)], 2))
+        offsets = [len(text) for text in first]
+        rest = list(read_record_chunks(
+            [BytesIO(fwd), StringIO(rev)], 2, offsets=offsets))
+        self.assertEqual(first[0] + b"".join(c[0] for c in rest), fwd)
+        self.assertEqual(first[1] + "".join(c[1] for c in rest), rev)
+        # Compressed input is read through up to the offset
+        rest_gz = list(read_record_chunks(
+            [BytesIO(gzip.compress(fwd)), StringIO(rev)], 2,
+            offsets=offsets))
+        self.assertEqual(rest_gz, rest)
+
+    def test_read_record_chunks_shortest_file(self):
+        short = StringIO(fastq1)
+        chunks = list(read_record_chunks(
+            [short, StringIO(fastq_with_barcode_fwd)], 10))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(len(list(parse_fastq(StringIO(chunks[0][1])))), 2)
+
+    def test_parse_fastq_bad_records(self):
+        bad_header = "@a\nACG\n+\n###\nb\nACG\n+\n###\n"
+        bad_sep = "@a\nACG\n-\n###\n"
+        bad_length = "@a\nACG\n+\n##\n"
+        truncated = "@a\nACG\n+\n###\n@b\nACG\n"
+        for contents in [bad_header, bad_sep, bad_length, truncated]:
+            obs = parse_fastq(StringIO(contents))
+            self.assertRaises(ValueError, list, obs)
+
+
+class MmapTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, data):
+        fp = os.path.join(self.temp_dir, "reads.fastq")
+        with open(fp, "wb") as f:
+            f.write(data)
+        return fp
+
+    def parse(self, fp, **kwargs):
+        with open(fp, "rb") as f:
+            reads = [r for b in parse_fastq_batches(f, **kwargs) for r in b]
+            self.assertEqual(f.tell(), os.path.getsize(fp))
+        return reads
+
+    def test_parse_fastq_mmap(self):
+        data = fastq_with_barcode_fwd.encode("ascii")
+        exp = list(parse_fastq(StringIO(fastq_with_barcode_fwd)))
+        # Without a final newline, and with lines longer than a block
+        for contents in [data, data.rstrip(b"\n")]:
+            fp = self.write(contents)
+            for block_size in [7, 50, 1 << 20]:
+                self.assertEqual(
+                    self.parse(fp, block_size=block_size, use_mmap=True),
+                    exp)
+
+    def test_mmap_fallback(self):
+        data = fastq_with_barcode_fwd.encode("ascii")
+        exp = list(parse_fastq(StringIO(fastq_with_barcode_fwd)))
+        # Compressed files can't be mapped
+        fp = self.write(gzip.compress(data))
+        with open(fp, "rb") as f:
+            self.assertFalse(can_mmap(f))
+        self.assertEqual(self.parse(fp, use_mmap=True), exp)
+        self.assertFalse(can_mmap(StringIO(fastq_with_barcode_fwd)))
+        self.assertEqual(self.parse(self.write(b""), use_mmap=True), [])
+
 
 fastq1 = """\
 @YesYes
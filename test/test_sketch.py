@@ -0,0 +1,47 @@
+import random
+import unittest
+
+from dnabclib.sketch import SpaceSaving
+
+
+class SpaceSavingTests(unittest.TestCase):
+    def test_exact_under_capacity(self):
+        s = SpaceSaving(10)
+        for item in "abacab":
+            s.add(item)
+        self.assertEqual(s.top(2), [("a", 3, 0), ("b", 2, 0)])
+
+    def test_heavy_hitters(self):
+        rng = random.Random(0)
+        items = ["x"] * 500 + ["y"] * 300
+        items += ["n%d" % rng.randrange(2000) for _ in range(2000)]
+        rng.shuffle(items)
+        s = SpaceSaving(50)
+        for item in items:
+            s.add(item)
+        self.assertEqual(len(s.counts), 50)
+        top = s.top(2)
+        self.assertEqual([x[0] for x in top], ["x", "y"])
+        for item, count, error in top:
+            true_count = items.count(item)
+            self.assertGreaterEqual(count, true_count)
+            self.assertLessEqual(count - error, true_count)
+
+    def test_merge(self):
+        a = SpaceSaving(2)
+        b = SpaceSaving(2)
+        for item in "aaab":
+            a.add(item)
+        for item in "aacc":
+            b.add(item)
+        a.merge(b)
+        self.assertEqual(a.top(2), [("a", 5, 0), ("c", 2, 0)])
+        a.add("d")
+        self.assertEqual(len(a.counts), 2)
+
+    def test_bad_capacity(self):
+        self.assertRaises(ValueError, SpaceSaving, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import time
+import unittest
+
+from dnabclib.timing import StageTimer, peak_rss_bytes
+
+
+class StageTimerTests(unittest.TestCase):
+    def test_stages(self):
+        t = StageTimer()
+        items = list(t.iterate("parse", [1, 2, 3]))
+        self.assertEqual(items, [1, 2, 3])
+        with t.stage("write"):
+            sum(range(1000))
+        stats = t.get_stats()
+        self.assertEqual(list(stats), ["parse", "write"])
+        # One call per item, plus the call that finds the end
+        self.assertEqual(stats["parse"]["batches"], 4)
+        self.assertGreaterEqual(stats["write"]["wall_seconds"], 0)
+
+    def test_merge(self):
+        a = StageTimer()
+        b = StageTimer()
+        a.add("parse", 1.0, 0.5)
+        b.add("parse", 2.0, 1.0)
+        b.add("assign", 1.0, 1.0)
+        a.merge(b.stages)
+        self.assertEqual(a.stages["parse"], [3.0, 1.5, 2])
+        self.assertEqual(list(a.stages), ["parse", "assign"])
+
+    def test_throughput(self):
+        t = StageTimer(cpu_clock=time.thread_time)
+        items = list(t.iterate("parse", [[1, 2], [3]], len))
+        self.assertEqual(items, [[1, 2], [3]])
+        with t.stage("write", 3):
+            time.sleep(0.01)
+        other = StageTimer()
+        other.add("write", 1.0, 1.0)
+        other.reads["write"] += 5
+        t.merge(other.stages, other.reads)
+        stats = t.get_stats()
+        self.assertEqual(stats["parse"]["reads"], 3)
+        self.assertEqual(stats["write"]["reads"], 8)
+        self.assertLess(stats["write"]["reads_per_second"], 8)
+        # Sleeping takes no CPU time on this thread
+        self.assertLess(stats["write"]["cpu_seconds"], 1.005)
+
+    def test_peak_rss(self):
+        self.assertGreater(peak_rss_bytes(), 1 << 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,14 @@
 from collections import namedtuple
+import gzip
 import os.path
 import shutil
 import tempfile
 import unittest
 
-from dnabclib.writer import FastaWriter, FastqWriter, PairedFastqWriter
+from dnabclib.writer import (
+    FastaWriter, FastqWriter, PairedFastqWriter, InterleavedFastqWriter,
+    UNASSIGNED_SAMPLE,
+    )
 
 
 class FastaWriterTests(unittest.TestCase):
@@ -57,6 +61,18 @@ class FastqWriterTests(unittest.TestCase):
 
         self.assertFalse(os.path.exists(w._get_output_fp(s2)))
 
+    def test_write_gzip(self):
+        s1 = self.Sample("h56")
+        w = FastqWriter(self.output_dir, compression="gzip")
+        w.write(self.Read("Read0", "ACCTTGG", "#######"), s1)
+        w.close()
+
+        fp = w._get_output_fp(s1)
+        self.assertTrue(fp.endswith(".fastq.gz"))
+        with gzip.open(fp, "rt") as f:
+            obs_output = f.read()
+        self.assertEqual(obs_output, "@Read0\nACCTTGG\n+\n#######\n")
+
 
 class PairedFastqWriterTests(unittest.TestCase):
     def setUp(self):
@@ -92,6 +108,299 @@ class PairedFastqWriterTests(unittest.TestCase):
         self.assertFalse(any(
             os.path.exists(fp) for fp in w._get_output_fp(s2)))
 
+    def test_write_gzip(self):
+        s1 = self.Sample("ghj")
+        w = PairedFastqWriter(
+            self.output_dir, compression="gzip", compresslevel=1, threads=2)
+        # Force several gzip members per file
+        w._pool.chunk_size = 100
+
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        for _ in range(1000):
+            w.write(readpair, s1)
+        w.close()
+
+        fp1, fp2 = w._get_output_fp(s1)
+        self.assertTrue(fp1.endswith("ghj_R1.fastq.gz"))
+
+        with gzip.open(fp1, "rt") as f:
+            obs1 = f.read()
+        self.assertEqual(obs1, "@Read0\nACCTTGG\n+\n#######\n" * 1000)
+
+        with gzip.open(fp2, "rt") as f:
+            obs2 = f.read()
+        self.assertEqual(obs2, "@Read1\nGCTAGCT\n+\n;342dfA\n" * 1000)
+
+    def test_memory_budget(self):
+        samples = [self.Sample("s%d" % i) for i in range(10)]
+        w = PairedFastqWriter(self.output_dir, max_buffered=500)
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        for n in range(20):
+            for s in samples[n % 3:]:
+                w.write(readpair, s)
+                self.assertLessEqual(w.buffered, 500)
+        # Samples with the most reads were written out first
+        fp1, _ = w._get_output_fp(samples[0])
+        self.assertTrue(os.path.exists(fp1))
+        w.close()
+        self.assertEqual(w.buffered, 0)
+
+        for i, s in enumerate(samples):
+            fp1, fp2 = w._get_output_fp(s)
+            n_reads = len([n for n in range(20) if n % 3 <= i])
+            with open(fp1) as f:
+                self.assertEqual(
+                    f.read(), "@Read0\nACCTTGG\n+\n#######\n" * n_reads)
+            with open(fp2) as f:
+                self.assertEqual(
+                    f.read(), "@Read1\nGCTAGCT\n+\n;342dfA\n" * n_reads)
+
+    def test_max_open_files(self):
+        samples = [self.Sample("s%d" % i) for i in range(5)]
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        for compression in [None, "gzip"]:
+            w = PairedFastqWriter(
+                self.output_dir, compression=compression, max_buffered=0,
+                max_open_files=3)
+            for _ in range(4):
+                for s in samples:
+                    w.write(readpair, s)
+                    self.assertLessEqual(len(w._handles), 3)
+            w.close()
+            stats = w.get_stats()
+            self.assertEqual(stats["flushes"], 40)
+            self.assertEqual(stats["evictions"], 37)
+            self.assertEqual(stats["reopens"], 30)
+
+            for s in samples:
+                fp1, fp2 = w._get_output_fp(s)
+                opener = gzip.open if compression else open
+                with opener(fp1, "rt") as f:
+                    self.assertEqual(
+                        f.read(), "@Read0\nACCTTGG\n+\n#######\n" * 4)
+
+    def test_compress_buffered(self):
+        s = self.Sample("s")
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        w = PairedFastqWriter(
+            self.output_dir, compression="gzip", max_buffered=0,
+            compress_buffered=100)
+        self.assertEqual(w._pool.max_buffered, 100)
+        for _ in range(20):
+            w.write(readpair, s)
+            self.assertLessEqual(w._pool.buffered, 100)
+        w.close()
+        fp1, fp2 = w._get_output_fp(s)
+        with gzip.open(fp1, "rt") as f:
+            self.assertEqual(f.read(), "@Read0\nACCTTGG\n+\n#######\n" * 20)
+
+    def test_sync_and_restore(self):
+        s = self.Sample("s")
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        for compression in [None, "gzip"]:
+            w = PairedFastqWriter(self.output_dir, compression=compression)
+            w.write(readpair, s)
+            sizes = w.sync()
+            self.assertEqual(sorted(sizes), sorted(w._get_output_fp(s)))
+            w.write(readpair, s)
+            w.close()
+
+            w = PairedFastqWriter(self.output_dir, compression=compression)
+            w.restore(sizes)
+            w.write(readpair, s)
+            w.write(readpair, s)
+            w.close()
+            fp1, _ = w._get_output_fp(s)
+            opener = gzip.open if compression else open
+            with opener(fp1, "rt") as f:
+                self.assertEqual(
+                    f.read(), "@Read0\nACCTTGG\n+\n#######\n" * 3)
+
+            os.remove(fp1)
+            self.assertRaises(ValueError, w.restore, sizes)
+
+    def test_chunks(self):
+        s1 = self.Sample("ghj")
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        w = PairedFastqWriter(self.output_dir, chunk_reads=2)
+        for _ in range(5):
+            w.write(readpair, s1)
+        w.close()
+
+        manifest = w.get_manifest()
+        self.assertEqual([c["reads"] for c in manifest["ghj"]], [2, 2, 1])
+        for n, chunk in enumerate(manifest["ghj"], 1):
+            self.assertEqual(chunk["files"], list(w._get_output_fp(s1, n)))
+            self.assertTrue(
+                chunk["files"][0].endswith("ghj_R1_%03d.fastq" % n))
+            with open(chunk["files"][1]) as f:
+                self.assertEqual(
+                    f.read(),
+                    "@Read1\nGCTAGCT\n+\n;342dfA\n" * chunk["reads"])
+        self.assertFalse(os.path.exists(w._get_output_fp(s1, 4)[0]))
+
+    def test_chunks_buffered(self):
+        s1 = self.Sample("ghj")
+        r1 = "@Read0\nACCTTGG\n+\n#######\n"
+        r2 = "@Read1\nGCT\n+\n;34\n"
+        # Output from worker processes arrives several reads at a time
+        for kwargs, expected in [
+                ({"chunk_reads": 3}, [3, 3, 3, 1]),
+                ({"chunk_bytes": 84}, [2, 2, 2, 2, 2]),
+                ({"chunk_bytes": 85}, [3, 3, 3, 1]),
+                ({"chunk_reads": 1, "chunk_bytes": 1000}, [1] * 10)]:
+            w = PairedFastqWriter(self.output_dir, **kwargs)
+            w.write_buffered(s1, [r1 * 4, r2 * 4])
+            w.write_buffered(s1, [r1 * 6, r2 * 6])
+            w.close()
+            chunks = w.get_manifest()["ghj"]
+            self.assertEqual([c["reads"] for c in chunks], expected)
+            for chunk in chunks:
+                fp1, fp2 = chunk["files"]
+                with open(fp1) as f:
+                    self.assertEqual(f.read(), r1 * chunk["reads"])
+                with open(fp2) as f:
+                    self.assertEqual(f.read(), r2 * chunk["reads"])
+
+    def test_unassigned(self):
+        reads = [(
+            self.Read("Read%d 1:N:0" % i, "ACGT", "####"),
+            self.Read("Read%d 2:N:0" % i, "TTGG", "####"))
+            for i in range(1000)]
+        records = [tuple(
+            "@%s\n%s\n+\n%s\n" % r for r in pair) for pair in reads]
+        w = PairedFastqWriter(self.output_dir)
+        w.write(reads[0], None)
+        w.close()
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+        outputs = []
+        for raw in [False, True]:
+            w = PairedFastqWriter(self.output_dir, unassigned_fraction=0.25)
+            for pair, recordpair in zip(reads, records):
+                if raw:
+                    w.write_raw(recordpair, None)
+                else:
+                    w.write(pair, None)
+            w.close()
+            self.assertTrue(200 < w.unassigned_written < 300)
+            self.assertEqual(
+                w.get_stats()["unassigned_written"], w.unassigned_written)
+            fp1, fp2 = w._get_output_fp(UNASSIGNED_SAMPLE)
+            with open(fp1) as f1, open(fp2) as f2:
+                outputs.append((f1.read(), f2.read()))
+        # The same reads are picked either way, and pairs stay together
+        self.assertEqual(outputs[0], outputs[1])
+        r1, r2 = outputs[0]
+        self.assertEqual(r1.count("\n"), 4 * w.unassigned_written)
+        self.assertEqual(
+            r1.replace(" 1:N:0", ""),
+            r2.replace(" 2:N:0", "").replace("TTGG", "ACGT"))
+
+    def test_unassigned_max_reads(self):
+        reads = [(
+            self.Read("Read%d" % i, "ACGT", "####"),
+            self.Read("Read%d" % i, "TTGG", "####"))
+            for i in range(10)]
+        w = PairedFastqWriter(
+            self.output_dir, unassigned_fraction=1, unassigned_max_reads=3)
+        for pair in reads[:2]:
+            w.write(pair, None)
+        # Output from worker processes is cut off at the limit
+        w.write_buffered(UNASSIGNED_SAMPLE, [
+            "@Read2\nACGT\n+\n####\n@Read3\nACGT\n+\n####\n",
+            "@Read2\nTTGG\n+\n####\n@Read3\nTTGG\n+\n####\n"])
+        w.write(reads[4], None)
+        w.close()
+        fp1, fp2 = w._get_output_fp(UNASSIGNED_SAMPLE)
+        with open(fp1) as f:
+            self.assertEqual(
+                f.read(), "@Read0\nACGT\n+\n####\n"
+                "@Read1\nACGT\n+\n####\n@Read2\nACGT\n+\n####\n")
+        with open(fp2) as f:
+            self.assertEqual(f.read().count("TTGG"), 3)
+        self.assertEqual(w.unassigned_written, 3)
+        self.assertRaises(
+            ValueError, PairedFastqWriter, self.output_dir,
+            unassigned_fraction=1.5)
+
+    def test_bad_chunk_size(self):
+        self.assertRaises(
+            ValueError, PairedFastqWriter, self.output_dir, chunk_reads=0)
+
+    def test_unknown_compression(self):
+        self.assertRaises(
+            ValueError, PairedFastqWriter, self.output_dir, compression="xz")
+
+
+class InterleavedFastqWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.Sample = namedtuple("Sample", "name")
+        self.Read = namedtuple("Read", "desc seq qual")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_write(self):
+        s1 = self.Sample("ghj")
+        w = InterleavedFastqWriter(self.output_dir)
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        w.write(readpair, s1)
+        w.write_raw(("@Read2\nAC\n+\n##\n", "@Read3\nGT\n+\n;;\n"), s1)
+        w.write(readpair, None)
+        w.close()
+
+        fp = w._get_output_fp(s1)
+        self.assertTrue(fp.endswith("ghj.fastq"))
+        with open(fp) as f:
+            self.assertEqual(f.read(), (
+                "@Read0\nACCTTGG\n+\n#######\n"
+                "@Read1\nGCTAGCT\n+\n;342dfA\n"
+                "@Read2\nAC\n+\n##\n"
+                "@Read3\nGT\n+\n;;\n"))
+
+    def test_write_gzip(self):
+        s1 = self.Sample("ghj")
+        w = InterleavedFastqWriter(
+            self.output_dir, compression="gzip", threads=2)
+        w._pool.chunk_size = 100
+        readpair = (
+            self.Read("Read0", "ACCTTGG", "#######"),
+            self.Read("Read1", "GCTAGCT", ";342dfA"),
+            )
+        for _ in range(100):
+            w.write(readpair, s1)
+        w.close()
+
+        fp = w._get_output_fp(s1)
+        self.assertTrue(fp.endswith("ghj.fastq.gz"))
+        with gzip.open(fp, "rt") as f:
+            self.assertEqual(f.read(), (
+                "@Read0\nACCTTGG\n+\n#######\n"
+                "@Read1\nGCTAGCT\n+\n;342dfA\n") * 100)
+
 
 if __name__ == '__main__':
     unittest.main()